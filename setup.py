@@ -9,4 +9,5 @@ setup(name='svgpygcode',
       packages=find_packages(),
       zip_safe=False,
       install_requires=[],
+      extras_require={'simulation': ['numpy']},
       include_package_data=True)
@@ -1,8 +1,669 @@
 # svgpygcode
 
+import json
 import math
+import mmap
+import os
+import re
+import shutil
+import tempfile
 from decimal import Decimal
 
+try:
+    # only needed by the Simulator
+    import numpy
+except ImportError:
+    numpy = None
+
+class GcodeWriter:
+    def __init__(self, stream = None, flush_size = 10000):
+        '''
+            arguments:
+                - stream:file opened text file where the gcode is written as it comes. None keeps everything in memory (cf self.getvalue)
+                - flush_size:int number of pieces of gcode kept before writing them to the stream
+        '''
+        # pieces of gcode waiting to be joined. Joining once at the end is much cheaper than growing a string line after line
+        self.buffer = []
+        self.stream = stream
+        self.flush_size = flush_size
+        # size (in bytes, gcode being ascii) and number of lines of the gcode written so far. Used to index the program (cf Machining.program_index)
+        self.size = 0
+        self.lines = 0
+
+    def write(self, text):
+        '''
+        Adds a piece of gcode (one or several lines) at the end of the program.
+            arguments:
+                - text:str gcode lines, each one ending with a new line character
+        '''
+        self.buffer.append(text)
+        self.size += len(text)
+        self.lines += text.count('\n')
+        if self.stream is not None and len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the pieces of gcode waiting in the buffer to the stream (does nothing without stream).
+        '''
+        if self.stream is not None:
+            self.stream.write("".join(self.buffer))
+            self.buffer = []
+
+    def getvalue(self):
+        '''
+        Returns the whole gcode program as a single string.
+        '''
+        result = "".join(self.buffer)
+        self.buffer = [result]
+        return result
+
+class SpatialIndex:
+    def __init__(self, cell_size):
+        # size of a grid cell. Each point is stored in the cell it falls into
+        self.cell_size = float(cell_size) if cell_size > 0 else 1.0
+        # only non empty cells are stored : {(cell_x, cell_y): [[x, y, item], ...]}
+        self.cells = {}
+        # points stored for each item, to be able to remove them all at once : {item: [[cell, point], ...]}
+        self.items = {}
+        # bounds of the cells used since the creation of the index (as [min_x, min_y, max_x, max_y])
+        self.bounds = None
+
+    def insert(self, item, x, y):
+        '''
+        Stores a point belonging to the given item. An item can own several points (all the entry points of a contour, for instance).
+            arguments:
+                - item:any identifier of the item owning the point (usually the index of a contour)
+                - x:float x coordinate of the point
+                - y:float y coordinate of the point
+        '''
+        cell = (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+        point = [float(x), float(y), item]
+        self.cells.setdefault(cell, []).append(point)
+        self.items.setdefault(item, []).append([cell, point])
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            self.bounds = [min(self.bounds[0], cell[0]), min(self.bounds[1], cell[1]), max(self.bounds[2], cell[0]), max(self.bounds[3], cell[1])]
+
+    def remove(self, item):
+        '''
+        Removes every point of the given item from the index.
+            arguments:
+                - item:any identifier used when inserting the points
+        '''
+        for cell, point in self.items.pop(item, []):
+            points = self.cells[cell]
+            points.remove(point)
+            if len(points) == 0:
+                del self.cells[cell]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def nearest(self, x, y):
+        '''
+        Returns the closest point to the given position, as [x, y, item, distance], or None if the index is empty.
+        Cells are browsed ring after ring around the position, so only the neighbourhood of the position is visited most of the time.
+            arguments:
+                - x:float x coordinate of the position
+                - y:float y coordinate of the position
+        '''
+        if len(self.cells) == 0:
+            return None
+        x = float(x)
+        y = float(y)
+        cx = int(math.floor(x / self.cell_size))
+        cy = int(math.floor(y / self.cell_size))
+        max_ring = max(abs(cx - self.bounds[0]), abs(self.bounds[2] - cx), abs(cy - self.bounds[1]), abs(self.bounds[3] - cy))
+        best = None
+        best_d = -1
+        ring = 0
+        while ring <= max_ring:
+            # every point of the ring is at least (ring - 1) cells away from the position, no need to go further
+            if best is not None and (ring - 1) * self.cell_size > best_d:
+                break
+            if 8 * ring > len(self.cells):
+                # the ring is bigger than the remaining cells : faster to check every remaining cell
+                cells = [points for cell, points in self.cells.items() if max(abs(cell[0] - cx), abs(cell[1] - cy)) >= ring]
+                ring = max_ring
+            elif ring == 0:
+                cells = [self.cells.get((cx, cy), [])]
+            else:
+                cells = []
+                for i in range(-ring, ring + 1):
+                    cells.append(self.cells.get((cx + i, cy - ring), []))
+                    cells.append(self.cells.get((cx + i, cy + ring), []))
+                for j in range(-ring + 1, ring):
+                    cells.append(self.cells.get((cx - ring, cy + j), []))
+                    cells.append(self.cells.get((cx + ring, cy + j), []))
+            for points in cells:
+                for point in points:
+                    d = math.sqrt((point[0] - x)**2 + (point[1] - y)**2)
+                    if best is None or d < best_d:
+                        best = point
+                        best_d = d
+            ring += 1
+        return [best[0], best[1], best[2], best_d]
+
+class RTree:
+    def __init__(self, items, node_size = 16):
+        '''
+        Static R-tree, bulk loaded with the Sort-Tile-Recursive method. Used to find quickly the bounding boxes intersecting a given box.
+            arguments:
+                - items:list list of [box, item], box being [min_x, min_y, max_x, max_y]
+                - node_size:int maximum number of children of a node
+        '''
+        self.node_size = node_size
+        # a node is [box, children, is_leaf]. The children of a leaf are the [box, item] given at the creation
+        level = [[box, item] for box, item in items]
+        leaf = True
+        while True:
+            level = self.pack(level, leaf)
+            leaf = False
+            if len(level) <= 1:
+                break
+        self.root = level[0] if len(level) == 1 else None
+
+    def pack(self, entries, leaf):
+        '''
+        Groups the entries (sorted by x, then by y inside vertical slices) into nodes of self.node_size entries.
+            arguments:
+                - entries:list list of [box, ...] to group
+                - leaf:bool True if the entries are the items themselves
+        '''
+        if len(entries) == 0:
+            return []
+        node_count = int(math.ceil(len(entries) / float(self.node_size)))
+        slice_count = int(math.ceil(math.sqrt(node_count)))
+        slice_size = slice_count * self.node_size
+        entries = sorted(entries, key = lambda entry: entry[0][0] + entry[0][2])
+        nodes = []
+        for s in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[s:s + slice_size], key = lambda entry: entry[0][1] + entry[0][3])
+            for n in range(0, len(vertical_slice), self.node_size):
+                children = vertical_slice[n:n + self.node_size]
+                box = [min([child[0][0] for child in children]), min([child[0][1] for child in children]), max([child[0][2] for child in children]), max([child[0][3] for child in children])]
+                nodes.append([box, children, leaf])
+        return nodes
+
+    def query(self, box):
+        '''
+        Returns the list of items whose bounding box intersects the given box.
+            arguments:
+                - box:[float, float, float, float] box defined as [min_x, min_y, max_x, max_y]
+        '''
+        result = []
+        if self.root is None:
+            return result
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            for child in node[1]:
+                b = child[0]
+                if b[0] <= box[2] and b[2] >= box[0] and b[1] <= box[3] and b[3] >= box[1]:
+                    if node[2]:
+                        result.append(child[1])
+                    else:
+                        stack.append(child)
+        return result
+
+class PostProcessor:
+    '''
+    Writes the gcode lines for a given controller dialect. The machining code only calls the emitters (rapid, line, arc_cw...) and never writes gcode text itself.
+    A dialect is a subclass overriding the templates below. The templates are turned once into format functions (cf self.build),
+    so that writing a line costs a single call, without any test on the dialect.
+    '''
+    # name of the dialect
+    name = 'generic'
+    # False for controllers without cutter radius compensation (G41 / G42)
+    supports_compensation = True
+    # templates : {p} is replaced by the number format, arguments are given in the order of the emitter
+    header_template = "G21\nG90\nG17\n"
+    footer_template = "M5\nM2\n"
+    rapid_template = "G0 X{0:{p}} Y{1:{p}} Z{2:{p}}\n"
+    # rapid along Z only, where the head is : the first move of a program, whose position is unknown
+    retract_template = "G0 Z{0:{p}}\n"
+    line_template = "G1 X{0:{p}} Y{1:{p}} Z{2:{p}}\n"
+    arc_cw_template = "G2 X{0:{p}} Y{1:{p}} I{2:{p}} J{3:{p}}\n"
+    arc_ccw_template = "G3 X{0:{p}} Y{1:{p}} I{2:{p}} J{3:{p}}\n"
+    helix_cw_template = "G2 X{0:{p}} Y{1:{p}} Z{2:{p}} I{3:{p}} J{4:{p}}\n"
+    helix_ccw_template = "G3 X{0:{p}} Y{1:{p}} Z{2:{p}} I{3:{p}} J{4:{p}}\n"
+    tool_change_template = "T{0} M6\n"
+    spindle_on_template = "M3 S{0}\n"
+    spindle_off_template = "M5\n"
+    compensation_left_template = "G41 D{0} G1 X{1:{p}} Y{2:{p}} Z{3:{p}}\n"
+    compensation_right_template = "G42 D{0} G1 X{1:{p}} Y{2:{p}} Z{3:{p}}\n"
+    compensation_off_template = "G40 G1 X{0:{p}} Y{1:{p}} Z{2:{p}}\n"
+    feed_template = "F{0:g}\n"
+    comment_template = "({0})\n"
+    # written after the footer and the subprograms placed at the end of the program (cf subprograms_at_end)
+    end_of_file_template = ""
+    # subprograms (cf Machining.find_congruent_parts) : None for controllers without subprograms, the repeated parts are then written in full
+    subprogram_start_template = None
+    subprogram_end_template = None
+    call_template = None
+    # True if the subprograms are written after the end of the main program, False if they are defined where they are first called
+    subprograms_at_end = False
+    # shift of the coordinates (the origin of the part), and rotation around the shifted origin. None for controllers without rotation
+    shift_template = "G52 X{0:{p}} Y{1:{p}}\n"
+    shift_off_template = "G52 X0 Y0\n"
+    rotation_template = None
+    rotation_off_template = None
+
+    def __init__(self, precision = 4):
+        '''
+            arguments:
+                - precision:int number of decimals written for the coordinates
+        '''
+        self.precision = precision
+        self.build()
+
+    def build(self):
+        '''
+        Builds the emitters from the templates. Each emitter is the format method of its template : calling it returns the gcode line(s).
+        '''
+        number = '.{}f'.format(self.precision)
+        for emitter in ['rapid', 'retract', 'line', 'arc_cw', 'arc_ccw', 'helix_cw', 'helix_ccw', 'tool_change', 'spindle_on', 'spindle_off', 'compensation_left', 'compensation_right', 'compensation_off', 'feed', 'comment',
+        'subprogram_start', 'subprogram_end', 'call', 'shift', 'shift_off', 'rotation', 'rotation_off']:
+            template = getattr(self, emitter + '_template')
+            setattr(self, emitter, None if template is None else template.replace('{p}', number).format)
+
+    def header(self):
+        '''
+        Returns the beginning of the program (units, absolute coordinates, plane...).
+        '''
+        return self.header_template
+
+    def footer(self):
+        '''
+        Returns the end of the program (spindle stop, program end).
+        '''
+        return self.footer_template
+
+    def end_of_file(self):
+        '''
+        Returns what ends the file, after the main program and the subprograms written at the end.
+        '''
+        return self.end_of_file_template
+
+    def subprogram(self, number, body):
+        '''
+        Returns the definition of a subprogram.
+            arguments:
+                - number:int number of the subprogram
+                - body:str gcode of the subprogram
+        '''
+        return self.subprogram_start(number) + body + self.subprogram_end(number)
+
+class LinuxCncPostProcessor(PostProcessor):
+    name = 'linuxcnc'
+    header_template = "G21 G90 G17 G40 G49\n"
+    footer_template = "M5\nM2\n"
+    tool_change_template = "T{0} M6\nG43 H{0}\n"
+    # the definition of a subroutine is skipped when the program runs through it : it's written just before its first call
+    subprogram_start_template = "o{0} sub\n"
+    subprogram_end_template = "o{0} endsub\n"
+    call_template = "o{0} call\n"
+
+class GrblPostProcessor(PostProcessor):
+    # grbl has no tool changer, no cutter radius compensation and no subprograms : the program stops and waits for the operator to change the tool
+    name = 'grbl'
+    supports_compensation = False
+    header_template = "G21 G90 G17\n"
+    footer_template = "M5\nM2\n"
+    tool_change_template = "(change tool : T{0})\nM0\n"
+    shift_template = None
+    shift_off_template = None
+
+class FanucPostProcessor(PostProcessor):
+    name = 'fanuc'
+    header_template = "%\nO0001\nG21 G90 G17 G40 G49 G80\n"
+    footer_template = "M5\nG91 G28 Z0\nG90\nM30\n"
+    end_of_file_template = "%\n"
+    tool_change_template = "T{0} M6\nG43 H{0}\n"
+    compensation_left_template = "G1 G41 D{0} X{1:{p}} Y{2:{p}} Z{3:{p}}\n"
+    compensation_right_template = "G1 G42 D{0} X{1:{p}} Y{2:{p}} Z{3:{p}}\n"
+    compensation_off_template = "G1 G40 X{0:{p}} Y{1:{p}} Z{2:{p}}\n"
+    # the subprograms follow the main program in the same file
+    subprogram_start_template = "O{0}\n"
+    subprogram_end_template = "M99\n"
+    call_template = "M98 P{0}\n"
+    subprograms_at_end = True
+    rotation_template = "G68 X0 Y0 R{0:{p}}\n"
+    rotation_off_template = "G69\n"
+
+class Simulator:
+    def __init__(self, machining, resolution = 0.5, tolerance = 0.05):
+        '''
+        Stock removal simulator, used to check a program before running it. The stock is a heightmap (one height per cell of a grid),
+        and each move of the program lowers the cells swept by the tool. Requires numpy.
+        The programmed path is simulated : moves using the controller compensation (G41 / G42) are simulated on the nominal contour.
+            arguments:
+                - machining:Machining machining whose gcode has been calculated (cf Machining.calculate)
+                - resolution:float size of a cell of the heightmap
+                - tolerance:float height difference ignored when looking for gouges and uncut areas
+        '''
+        if numpy is None:
+            raise ImportError('the Simulator needs numpy')
+        self.machining = machining
+        self.resolution = float(resolution)
+        self.tolerance = tolerance
+        # heightmap, origin of its first cell and top of the stock (set by self.run)
+        self.heights = None
+        self.origin = [0, 0]
+        self.stock_surface = 0
+
+    def run(self):
+        '''
+        Simulates the program and returns a report, as a dict :
+            - 'removed_volume' : {operation index: volume removed by the operation}
+            - 'gouges' : list of [operation index, x, y, depth] for each holding tab cut below its top
+            - 'uncut_area' : {operation index: area of the pocket left above the target depth}
+        '''
+        moves = self.parse_gcode(self.machining.gcode)
+        tools = self.machining.tool_table
+        radius = max([tool['drill_radius'] for tool in tools.values()] + [0])
+        self.stock_surface = max([self.machining.define_properties(contour[2])['stock_surface'] for contour in self.machining.contours] + [0])
+        xs = [move[1][0] for move in moves] + [move[2][0] for move in moves]
+        ys = [move[1][1] for move in moves] + [move[2][1] for move in moves]
+        if len(xs) == 0:
+            return {'removed_volume': {}, 'gouges': [], 'uncut_area': {}}
+        self.origin = [min(xs) - radius - self.resolution, min(ys) - radius - self.resolution]
+        width = int(math.ceil((max(xs) - min(xs) + 2 * radius) / self.resolution)) + 3
+        height = int(math.ceil((max(ys) - min(ys) + 2 * radius) / self.resolution)) + 3
+        self.heights = numpy.full((height, width), float(self.stock_surface), dtype = numpy.float32)
+
+        removed = {}
+        cell_area = self.resolution**2
+        for operation, start, end, tool in moves:
+            if tool is None or tool not in tools or min(start[2], end[2]) >= self.stock_surface:
+                continue
+            volume = self.sweep(start, end, tools[tool]['drill_radius'], tools[tool]['drill_type'])
+            removed[operation] = removed.get(operation, 0) + volume * cell_area
+        return {'removed_volume': removed, 'gouges': self.find_gouges(), 'uncut_area': self.find_uncut_areas()}
+
+    def parse_gcode(self, gcode):
+        '''
+        Returns the list of cutting moves of a program as [operation index, start, end, tool], start and end being [x, y, z].
+        Arcs (G2 / G3) are replaced by small lines whose distance to the arc is under a quarter of a cell.
+        Subprogram calls are replaced by the subprograms, and the shifts (G52) and rotations (G68) of the coordinates are applied (cf Machining.find_congruent_parts).
+            arguments:
+                - gcode:str program written by Machining.calculate (any dialect)
+        '''
+        moves = []
+        position = [0.0, 0.0, 0.0]
+        motion = 0
+        tool = None
+        operation = None
+        # the coordinates written are turned by angle around the origin, then shifted by origin
+        origin = [0.0, 0.0]
+        angle = 0.0
+        words = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+        for line in self.expand_subprograms(gcode):
+            comment = re.search(r'operation (\d+)', line)
+            if comment is not None:
+                operation = int(comment.group(1))
+            # grbl has no tool changer : the tool to load is only given in a comment (cf GrblPostProcessor)
+            comment = re.search(r'change tool : T(\d+)', line)
+            if comment is not None:
+                tool = int(comment.group(1))
+            line = re.sub(r'\(.*?\)', '', line).split(';')[0].upper()
+            values = {}
+            codes = []
+            for letter, value in words.findall(line):
+                if letter in ['G', 'M']:
+                    codes.append(letter + str(int(float(value))))
+                else:
+                    values[letter] = float(value)
+            if 'G52' in codes:
+                origin = [values.get('X', 0.0), values.get('Y', 0.0)]
+                continue
+            if 'G68' in codes:
+                angle = math.radians(values.get('R', 0.0))
+                continue
+            if 'G69' in codes:
+                angle = 0.0
+                continue
+            for code in codes:
+                if code in ['G0', 'G1', 'G2', 'G3']:
+                    motion = int(code[1:])
+            if 'T' in values and 'M6' in codes:
+                tool = int(values['T'])
+            if not any([axis in values for axis in ['X', 'Y', 'Z']]):
+                continue
+            # back to the coordinates written, for the axes which are not given
+            dx = position[0] - origin[0]
+            dy = position[1] - origin[1]
+            x = values.get('X', dx * math.cos(angle) + dy * math.sin(angle))
+            y = values.get('Y', -dx * math.sin(angle) + dy * math.cos(angle))
+            end = [origin[0] + x * math.cos(angle) - y * math.sin(angle), origin[1] + x * math.sin(angle) + y * math.cos(angle), values.get('Z', position[2])]
+            if motion in [2, 3] and ('I' in values or 'J' in values):
+                i = values.get('I', 0.0)
+                j = values.get('J', 0.0)
+                for point in self.arc_points(position, end, i * math.cos(angle) - j * math.sin(angle), i * math.sin(angle) + j * math.cos(angle), motion == 2):
+                    moves.append([operation, position, point, tool])
+                    position = point
+            else:
+                moves.append([operation, position, end, tool])
+            position = end
+        return moves
+
+    def expand_subprograms(self, gcode):
+        '''
+        Returns the lines of a program, each subprogram call (o<n> call, M98 P<n>) being replaced by the lines of the subprogram, and the definitions being removed.
+            arguments:
+                - gcode:str program written by Machining.calculate (any dialect)
+        '''
+        main = []
+        subprograms = {}
+        current = None
+        ended = False
+        for line in gcode.split('\n'):
+            word = line.strip().upper()
+            start = re.match(r'O(\d+)\s+SUB$', word)
+            if start is None and ended:
+                # after the end of the main program, each O<n> begins a subprogram ending with M99
+                start = re.match(r'O(\d+)$', word)
+            if start is not None:
+                current = int(start.group(1))
+                subprograms[current] = []
+            elif current is not None:
+                if re.match(r'O\d+\s+ENDSUB$', word) or word == 'M99':
+                    current = None
+                else:
+                    subprograms[current].append(line)
+            else:
+                main.append(line)
+                if word in ['M30', 'M2']:
+                    ended = True
+        def expand(lines, depth):
+            result = []
+            for line in lines:
+                word = line.strip().upper()
+                call = re.match(r'O(\d+)\s+CALL$', word) or re.match(r'M98\s*P(\d+)$', word)
+                if call is not None and int(call.group(1)) in subprograms and depth < 10:
+                    result += expand(subprograms[int(call.group(1))], depth + 1)
+                else:
+                    result.append(line)
+            return result
+        return expand(main, 0)
+
+    def arc_points(self, start, end, i, j, clockwise):
+        '''
+        Returns the points of the small lines replacing an arc, the last one being the end of the arc.
+            arguments:
+                - start:[float, float, float] starting point of the arc
+                - end:[float, float, float] ending point of the arc
+                - i:float x offset of the center from the starting point
+                - j:float y offset of the center from the starting point
+                - clockwise:bool True for G2, False for G3
+        '''
+        cx = start[0] + i
+        cy = start[1] + j
+        r = math.sqrt(i**2 + j**2)
+        a0 = math.atan2(start[1] - cy, start[0] - cx)
+        a1 = math.atan2(end[1] - cy, end[0] - cx)
+        delta = a1 - a0
+        if clockwise and delta >= 0:
+            delta -= 2 * math.pi
+        if not clockwise and delta <= 0:
+            delta += 2 * math.pi
+        error = self.resolution / 4
+        step = 2 * math.acos(max(1 - error / r, -1)) if r > error else math.pi
+        n = max(int(math.ceil(abs(delta) / step)), 1)
+        points = []
+        for k in range(1, n):
+            a = a0 + delta * k / n
+            points.append([cx + r * math.cos(a), cy + r * math.sin(a), start[2] + (end[2] - start[2]) * k / n])
+        points.append(end)
+        return points
+
+    def sweep(self, start, end, radius, drill_type = 'straight'):
+        '''
+        Lowers the heightmap under a straight move of the tool, and returns the removed volume (in cell units : heights times number of cells).
+        Long moves are cut in pieces, to keep the window of cells computed at once small.
+            arguments:
+                - start:[float, float, float] starting point of the tool tip
+                - end:[float, float, float] ending point of the tool tip
+                - radius:float radius of the tool
+                - drill_type:str 'ball' for a ball end mill, anything else for a flat end mill
+        '''
+        length = math.sqrt((end[0] - start[0])**2 + (end[1] - start[1])**2)
+        piece = max(2 * radius, 32 * self.resolution)
+        n = max(int(math.ceil(length / piece)), 1)
+        volume = 0
+        for k in range(0, n):
+            a = [start[c] + (end[c] - start[c]) * k / n for c in range(0, 3)]
+            b = [start[c] + (end[c] - start[c]) * (k + 1) / n for c in range(0, 3)]
+            volume += self.sweep_piece(a, b, radius, drill_type)
+        return volume
+
+    def sweep_piece(self, start, end, radius, drill_type):
+        '''
+        Same as self.sweep, for a short move : every cell of the window around the move is computed at once.
+            arguments:
+                - start:[float, float, float] starting point of the tool tip
+                - end:[float, float, float] ending point of the tool tip
+                - radius:float radius of the tool
+                - drill_type:str 'ball' for a ball end mill, anything else for a flat end mill
+        '''
+        res = self.resolution
+        i0 = max(int(math.floor((min(start[0], end[0]) - radius - self.origin[0]) / res)), 0)
+        i1 = min(int(math.ceil((max(start[0], end[0]) + radius - self.origin[0]) / res)) + 1, self.heights.shape[1])
+        j0 = max(int(math.floor((min(start[1], end[1]) - radius - self.origin[1]) / res)), 0)
+        j1 = min(int(math.ceil((max(start[1], end[1]) + radius - self.origin[1]) / res)) + 1, self.heights.shape[0])
+        if i1 <= i0 or j1 <= j0:
+            return 0
+        # coordinates of the centers of the cells of the window
+        x = self.origin[0] + (numpy.arange(i0, i1) + 0.5) * res
+        y = self.origin[1] + (numpy.arange(j0, j1) + 0.5) * res
+        px = x[numpy.newaxis, :] - start[0]
+        py = y[:, numpy.newaxis] - start[1]
+        dx = end[0] - start[0]
+        dy = end[1] - start[1]
+        dz = end[2] - start[2]
+        length2 = dx**2 + dy**2
+        if length2 > 0:
+            # closest position of the tool along the move, and distance from the cell to the axis of the tool
+            t = numpy.clip((px * dx + py * dy) / length2, 0, 1)
+            d2 = (px - t * dx)**2 + (py - t * dy)**2
+            # the tool covers the cell between t - h and t + h : the lowest point of the tool over the cell is at one of these ends
+            h = numpy.sqrt(numpy.maximum(radius**2 - d2, 0) / length2)
+            if dz < 0:
+                t = numpy.minimum(t + h, 1)
+            elif dz > 0:
+                t = numpy.maximum(t - h, 0)
+            z = start[2] + t * dz
+        else:
+            d2 = px**2 + py**2
+            z = numpy.full(d2.shape, min(start[2], end[2]))
+        inside = d2 <= radius**2
+        if drill_type == 'ball':
+            z = z + radius - numpy.sqrt(numpy.maximum(radius**2 - d2, 0))
+        window = self.heights[j0:j1, i0:i1]
+        cut = numpy.where(inside, numpy.minimum(window, z), window)
+        volume = float(numpy.sum(window - cut))
+        self.heights[j0:j1, i0:i1] = cut
+        return volume
+
+    def height_at(self, x, y, radius = 0):
+        '''
+        Returns the lowest height of the heightmap in the disc of the given center and radius (at least the cell containing the center).
+            arguments:
+                - x:float x coordinate of the center
+                - y:float y coordinate of the center
+                - radius:float radius of the disc
+        '''
+        res = self.resolution
+        i0 = max(int(math.floor((x - radius - self.origin[0]) / res)), 0)
+        i1 = min(int(math.floor((x + radius - self.origin[0]) / res)) + 1, self.heights.shape[1])
+        j0 = max(int(math.floor((y - radius - self.origin[1]) / res)), 0)
+        j1 = min(int(math.floor((y + radius - self.origin[1]) / res)) + 1, self.heights.shape[0])
+        if i1 <= i0 or j1 <= j0:
+            return self.stock_surface
+        return float(numpy.min(self.heights[j0:j1, i0:i1]))
+
+    def find_gouges(self):
+        '''
+        Returns the holding tabs (cf Machining.holding_tabs) whose plateau has been cut below the top of the tab, as [operation index, x, y, depth under the top].
+        Only the plateau shrunk by the drill radius is looked at : around it, the tool going up and down the ramps of the tab cuts lower on purpose.
+        '''
+        gouges = []
+        for operation, x, y, top, plateau in self.machining.holding_tabs:
+            if plateau is None:
+                continue
+            # the cells straddling the ends of the plateau can be touched by the ramps
+            length = self.machining.distance(plateau[0], plateau[1])
+            if length < 2 * self.resolution:
+                continue
+            count = int(length / self.resolution)
+            points = [[plateau[0][0] + (plateau[1][0] - plateau[0][0]) * k / count, plateau[0][1] + (plateau[1][1] - plateau[0][1]) * k / count] for k in range(1, count)]
+            height = min([self.height_at(point[0], point[1]) for point in points])
+            if height < top - self.tolerance:
+                gouges.append([operation, x, y, top - height])
+        return gouges
+
+    def find_uncut_areas(self):
+        '''
+        Returns, for each pocket operation, the area inside the pocket contour still above the target depth.
+        Inner corners can not be reached by a round tool : they are part of this area.
+        '''
+        result = {}
+        res = self.resolution
+        for i in range(0, len(self.machining.contours)):
+            type, profile, properties = self.machining.contours[i]
+            if type not in ['pocket_inside', 'pocket_adaptive', 'pocket_rest'] or isinstance(profile, str):
+                continue
+            properties = self.machining.define_properties(properties)
+            polygon = self.machining.flatten_path(profile)
+            box = self.machining.bounding_box(polygon)
+            i0 = max(int(math.floor((box[0] - self.origin[0]) / res)), 0)
+            i1 = min(int(math.ceil((box[2] - self.origin[0]) / res)) + 1, self.heights.shape[1])
+            j0 = max(int(math.floor((box[1] - self.origin[1]) / res)), 0)
+            j1 = min(int(math.ceil((box[3] - self.origin[1]) / res)) + 1, self.heights.shape[0])
+            if i1 <= i0 or j1 <= j0:
+                result[i] = (box[2] - box[0]) * (box[3] - box[1])
+                continue
+            x = self.origin[0] + (numpy.arange(i0, i1) + 0.5) * res
+            y = self.origin[1] + (numpy.arange(j0, j1) + 0.5) * res
+            x, y = numpy.meshgrid(x, y)
+            # vectorized ray casting (cf Machining.point_in_polygon)
+            inside = numpy.zeros(x.shape, dtype = bool)
+            for k in range(0, len(polygon)):
+                xi, yi = polygon[k]
+                xj, yj = polygon[k - 1]
+                if yi == yj:
+                    continue
+                crossing = ((yi > y) != (yj > y)) & (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+                inside ^= crossing
+            uncut = inside & (self.heights[j0:j1, i0:i1] > properties['target_depth'] + self.tolerance)
+            result[i] = float(numpy.sum(uncut)) * res**2
+        return result
+
 class Machining:
     def __init__(self):
         # list of contours
@@ -13,208 +674,1787 @@ class Machining:
         self.order = []
         # current position of the machining head. Used during the calculation to minimize machine travelling
         self.current_position = [0, 0]
+        # height of the machining head above the current position when it is known to be up (between the operations), None otherwise (cf self.travel)
+        self.current_height = None
+        # False at the beginning of a program : the machining head can be anywhere, self.current_position is only a guess
+        self.position_known = False
+        # point the machining head last went to from an unknown position (cf self.travel) : the entry of a part planned for its copies (cf self.congruent_operation)
+        self.entry_position = None
+        # gcode writer used during the calculation (cf GcodeWriter)
+        self.writer = GcodeWriter()
+        # tools of the machine : {number: {'drill_radius': float, 'drill_type': str, 'change_time': float}} (cf self.define_tool)
+        self.tool_table = {}
+        # number of the tool in the spindle, None if unknown
+        self.current_tool = None
+        # speed the spindle is turning at, None if stopped
+        self.spindle_speed = None
+        # feedrate the controller is set to (F is modal), None if unknown
+        self.current_feedrate = None
+        # fastest cutting feedrate of the machine, in mm/min. The feedrates written are never above it. None for no limit
+        self.max_feedrate = None
+        # dialect of the controller the gcode is written for (cf PostProcessor and its subclasses)
+        self.post_processor = LinuxCncPostProcessor()
+        # index (in self.contours) of the operation being written
+        self.current_operation = None
+        # holding tabs written during the calculation, as [operation index, x, y, top of the tab, plateau] (cf self.record_holding_tabs). Used to check the program (cf Simulator)
+        self.holding_tabs = []
+        # time (in seconds) needed for a tool change, when not given for the tool itself
+        self.tool_change_time = 20
+        # travelling speed of the machining head (G0), in mm/min. Used to compare travelling times with tool change times
+        self.rapid_feedrate = 5000
+        # size of the grid the geometry is snapped to (0.001 for 1 micrometer). Orientation and intersection tests are then exact integer computations.
+        # None keeps float coordinates
+        self.resolution = None
+        # True to cut the edges shared by neighbouring 'profile_outside' contours only once (cf self.find_common_lines)
+        self.common_line_cutting = False
+        # open paths left to machine for the contours sharing edges with contours machined before them : {operation index: [paths]}
+        self.common_lines = {}
+        # True to plan repeated contours once and write them as a subprogram called for each copy (cf self.find_congruent_parts)
+        self.congruent_parts = False
+        # True to find the copies turned by any angle too (otherwise only translated copies are found)
+        self.congruent_rotation = False
+        # operations which are copies of a part : {operation index: [key, origin, angle]} (cf self.find_congruent_parts)
+        self.congruent = {}
+        # parts planned once : {key: {'profile', 'number', 'body', 'entry', 'end', 'feedrate', 'tabs', 'defined'}}
+        self.subprograms = {}
+        # definitions of the subprograms written at the end of the program (cf PostProcessor.subprograms_at_end)
+        self.subprogram_definitions = []
+        # where each operation begins in the program, with the state of the machine there, to restart the program from any operation (cf self.save_index, self.restart_program)
+        # 'operations' : list of {'operation', 'offset', 'line', 'position', 'tool', 'spindle_speed', 'feedrate', 'clearance'}, 'subprograms' : list of {'number', 'start', 'end'} (offsets of the definitions)
+        self.program_index = {'operations': [], 'subprograms': []}
+        # opened text file where the index is written as it comes, instead of being kept in self.program_index (cf self.calculate_windowed)
+        self.index_stream = None
 
     def add_operation(self, svg_path, operation_type, properties):
         '''
         Add machining operations to the machining process.
             arguments:
                 - svg_path:str 'd' attribute of your path component
-                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
-                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'pocket_adaptive', 'pocket_rest', 'engraving'
+                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, finishing_depth, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width, compensation, lead_length, spindle_speed, stepover, rest_radius, adaptive_feed
         '''
         self.contours.append([operation_type, svg_path, properties])
 
+    def define_tool(self, drill_radius, drill_type = 'straight', number = None, change_time = None):
+        '''
+        Adds a tool to the tool table and returns its number. Operations using this drill_radius / drill_type will be machined with this tool.
+            arguments:
+                - drill_radius:float radius of the tool
+                - drill_type:str type of the tool (same as the drill_type property of the operations)
+                - number:int number of the tool in the tool changer (T number). Default : first free number
+                - change_time:float time (in seconds) needed to load this tool. Default : self.tool_change_time
+        '''
+        if number is None:
+            number = 1
+            while number in self.tool_table:
+                number += 1
+        self.tool_table[number] = {
+        'drill_radius' : float(drill_radius),
+        'drill_type' : drill_type,
+        'change_time' : self.tool_change_time if change_time is None else change_time
+        }
+        return number
+
+    def get_tool(self, properties):
+        '''
+        Returns the number of the tool used by an operation, adding the tool to the tool table if it is not there yet.
+            arguments:
+                - properties:dict properties of the operation (cf self.add_operation)
+        '''
+        properties = self.define_properties(properties)
+        for number in sorted(self.tool_table.keys()):
+            tool = self.tool_table[number]
+            if tool['drill_radius'] == float(properties['drill_radius']) and tool['drill_type'] == properties['drill_type']:
+                return number
+        return self.define_tool(properties['drill_radius'], properties['drill_type'])
+
+    def change_tool(self, properties):
+        '''
+        Writes a tool change if the operation needs another tool than the one in the spindle, and starts the spindle at the speed of the operation.
+            arguments:
+                - properties:dict properties of the operation (cf self.add_operation)
+        '''
+        tool = self.get_tool(properties)
+        properties = self.define_properties(properties)
+        temp = ""
+        if tool != self.current_tool:
+            # the tool is changed where the head is, once it's up
+            if self.current_height != properties['clearance_pane']:
+                temp += self.post_processor.retract(properties['clearance_pane'])
+            # the spindle is stopped only if it was started
+            if self.spindle_speed is not None:
+                temp += self.post_processor.spindle_off()
+            temp += self.post_processor.tool_change(tool)
+            self.current_tool = tool
+            self.current_height = properties['clearance_pane']
+            self.spindle_speed = None
+        if properties['spindle_speed'] != self.spindle_speed:
+            temp += self.post_processor.spindle_on(properties['spindle_speed'])
+            self.spindle_speed = properties['spindle_speed']
+        self.writer.write(temp)
+
+    def travel(self, x, y, properties):
+        '''
+        Returns the gcode bringing the machining head from the current position to above (x, y), at the clearance plane of the operation.
+        The head goes up first, where it is, then across. The moves to where the head already is are left out.
+        The head is then expected to go down : its height is no more known.
+            arguments:
+                - x:float X coordinate of the point
+                - y:float Y coordinate of the point
+                - properties:dict properties of the operation, as returned by self.define_properties
+        '''
+        temp = ""
+        if self.current_height != properties['clearance_pane']:
+            temp += self.post_processor.retract(properties['clearance_pane'])
+        if not self.position_known or float(x) != float(self.current_position[0]) or float(y) != float(self.current_position[1]):
+            temp += self.post_processor.rapid(x, y, properties['clearance_pane'])
+        if not self.position_known:
+            self.entry_position = [x, y]
+        self.position_known = True
+        self.current_height = None
+        return temp
+
     def calculate(self, priority = []):
         '''
         Calculates the gcode for the operations defined, following the chosen order or priority.
+        The gcode is written in the dialect of self.post_processor (cf PostProcessor).
             arguments:
                 - prioritys:[str] list of string, first element type will be machined first, etc. Default : engraving -> pockets -> profiles
         '''
+        # the operations are checked before anything is written
+        for contour in self.contours:
+            self.check_operation(contour[0], contour[2])
         # setting gcode file header
-        self.gcode = "G90\n"
+        self.writer = GcodeWriter()
+        self.writer.write(self.post_processor.header())
+        # the state of the machine is unknown at the beginning of the program
+        self.current_position = [0, 0]
+        self.current_height = None
+        self.position_known = False
+        self.current_tool = None
+        self.spindle_speed = None
+        self.current_feedrate = None
+        self.program_index = {'operations': [], 'subprograms': []}
+        self.subprograms = {}
+        self.subprogram_definitions = []
         self.determine_order(priority)
+        self.common_lines = self.find_common_lines() if self.common_line_cutting else {}
+        self.congruent = self.find_congruent_parts() if self.congruent_parts else {}
+        self.holding_tabs = []
+        for i in self.order:
+            self.machine_operation(i, i)
+        self.writer.write(self.post_processor.footer())
+        self.writer.write("".join(self.subprogram_definitions))
+        self.writer.write(self.post_processor.end_of_file())
+        self.spindle_speed = None
+        self.gcode = self.writer.getvalue()
+
+    def check_operation(self, operation_type, properties):
+        '''
+        Raises a ValueError if the operation can't be written for the controller (cf self.post_processor), so that no partial program is written.
+            arguments:
+                - operation_type:str description of the operation (cf self.add_operation)
+                - properties:dict properties of the operation (cf self.add_operation)
+        '''
+        if operation_type in ['profile_inside', 'profile_outside'] and self.define_properties(properties)['compensation'] == 'controller' and not self.post_processor.supports_compensation:
+            raise ValueError('the controller does not support cutter radius compensation (G41 / G42) : use the host compensation instead')
+
+    def machine_operation(self, i, operation_id):
+        '''
+        Writes the gcode of one operation (tool change included if needed).
+            arguments:
+                - i:int index of the operation in self.contours
+                - operation_id:int number of the operation written in the program
+        '''
+        self.current_operation = operation_id
+        # the state of the machine before the operation, to be able to restart from here
+        self.add_to_index('operations', {
+        'operation' : operation_id,
+        'offset' : self.writer.size,
+        'line' : self.writer.lines + 1,
+        'position' : [float(self.current_position[0]), float(self.current_position[1])],
+        'tool' : self.current_tool,
+        'spindle_speed' : self.spindle_speed,
+        'feedrate' : self.current_feedrate,
+        'clearance' : self.define_properties(self.contours[i][2])['clearance_pane']
+        })
+        self.change_tool(self.contours[i][2])
+        self.writer.write(self.post_processor.comment('operation {} : {}'.format(operation_id, self.contours[i][0])))
+        if i in self.common_lines:
+            self.common_line_profile(self.common_lines[i], self.contours[i][2])
+            return
+        if i in self.congruent:
+            self.congruent_operation(i)
+            return
+        self.machine_contour(self.contours[i][1], self.contours[i][0], self.contours[i][2])
+
+    def machine_contour(self, profile, type, properties):
+        '''
+        Writes the gcode of an operation, without the tool change.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'pocket_adaptive', 'pocket_rest', 'engraving'
+                - properties:dict contains the machining characteristics (cf self.add_operation)
+        '''
+        if type == 'pocket_inside':
+            self.pocket(profile, type, properties)
+        if type == 'pocket_outside':
+            self.pocket(profile, type, properties)
+        if type == 'pocket_adaptive':
+            self.pocket(profile, type, properties)
+        if type == 'pocket_rest':
+            self.rest_pocket(profile, type, properties)
+        if type == 'profile_inside':
+            self.profile(profile, type, properties)
+        if type == 'profile_outside':
+            self.profile(profile, type, properties)
+        if type == 'engraving':
+            self.engrave(profile, type, properties)
+
+    def congruent_operation(self, i):
+        '''
+        Writes the gcode of an operation which is a copy of a part (cf self.find_congruent_parts).
+        The part is planned once, at the origin, the first time one of its copies comes. For each copy, the head goes to the entry of the copy, then the subprogram is called with the coordinates shifted
+        (and turned) to the copy, or the gcode of the part moved to the copy for controllers without subprograms (or without rotation, for a turned copy).
+            arguments:
+                - i:int index of the operation in self.contours
+        '''
+        key, origin, angle = self.congruent[i]
+        part = self.subprograms[key]
+        properties = self.define_properties(self.contours[i][2])
+        if part['body'] is None:
+            # planning the part at the origin, in a gcode of its own, from the start of its path with the head up
+            writer = self.writer
+            position = self.current_position
+            tabs = len(self.holding_tabs)
+            height = self.current_height
+            known = self.position_known
+            self.writer = GcodeWriter()
+            self.current_position = part['profile'][0][1]
+            self.current_height = properties['clearance_pane']
+            self.position_known = False
+            self.current_feedrate = None
+            self.machine_contour(part['profile'], self.contours[i][0], self.contours[i][2])
+            part['body'] = self.writer.getvalue()
+            # the rapid to the entry is left to each copy : the head comes there from wherever it is
+            part['entry'] = self.entry_position
+            rapid = self.post_processor.rapid(part['entry'][0], part['entry'][1], properties['clearance_pane'])
+            if part['body'].startswith(rapid):
+                part['body'] = part['body'][len(rapid):]
+            part['end'] = self.current_position
+            part['feedrate'] = self.current_feedrate
+            part['tabs'] = self.holding_tabs[tabs:]
+            del self.holding_tabs[tabs:]
+            self.writer = writer
+            self.current_position = position
+            self.current_height = height
+            self.position_known = known
+
+        turned = abs(angle) > 0.000000001
+        x, y = self.transform_point(part['entry'], origin, angle)
+        temp = self.travel(x, y, properties)
+        if self.post_processor.call is None or (turned and self.post_processor.rotation is None):
+            temp += self.transform_gcode(part['body'], origin, angle)
+        else:
+            if not part['defined']:
+                definition = self.post_processor.subprogram(part['number'], part['body'])
+                if self.post_processor.subprograms_at_end:
+                    self.subprogram_definitions.append(definition)
+                else:
+                    # a restart after this point still needs the definition (cf self.restart_program)
+                    self.writer.write(temp)
+                    temp = ""
+                    self.add_to_index('subprograms', {'number': part['number'], 'start': self.writer.size, 'end': self.writer.size + len(definition)})
+                    self.writer.write(definition)
+                part['defined'] = True
+            temp += self.post_processor.shift(origin[0], origin[1])
+            if turned:
+                temp += self.post_processor.rotation(math.degrees(angle))
+            temp += self.post_processor.call(part['number'])
+            if turned:
+                temp += self.post_processor.rotation_off()
+            temp += self.post_processor.shift_off()
+        self.writer.write(temp)
+        self.current_feedrate = part['feedrate']
+        self.current_position = self.transform_point(part['end'], origin, angle)
+        self.current_height = properties['clearance_pane']
+        for tab in part['tabs']:
+            x, y = self.transform_point(tab[1:3], origin, angle)
+            plateau = [self.transform_point(point, origin, angle) for point in tab[4]] if tab[4] is not None else None
+            self.holding_tabs.append([self.current_operation, x, y, tab[3], plateau])
+
+    def transform_point(self, point, origin, angle):
+        '''
+        Returns the point of a part placed at origin and turned by angle (cf self.find_congruent_parts), from its coordinates in the part.
+            arguments:
+                - point:[float, float] coordinates in the part
+                - origin:[float, float] position of the origin of the part
+                - angle:float rotation of the part, in radians
+        '''
+        x = float(point[0])
+        y = float(point[1])
+        return [origin[0] + x * math.cos(angle) - y * math.sin(angle), origin[1] + x * math.sin(angle) + y * math.cos(angle)]
+
+    def transform_gcode(self, gcode, origin, angle):
+        '''
+        Returns the gcode of a part (written by this post-processor) moved to origin and turned by angle : X Y are moved as points, I J (relative to the start of the arc) are turned.
+            arguments:
+                - gcode:str gcode of the part, planned at the origin
+                - origin:[float, float] position of the origin of the part
+                - angle:float rotation of the part, in radians
+        '''
+        number = '{:.' + str(self.post_processor.precision) + 'f}'
+        def point(match):
+            x, y = self.transform_point([match.group(1), match.group(2)], origin, angle)
+            return 'X' + number.format(x) + ' Y' + number.format(y)
+        def vector(match):
+            x, y = self.transform_point([match.group(1), match.group(2)], [0, 0], angle)
+            return 'I' + number.format(x) + ' J' + number.format(y)
+        gcode = re.sub(r'X([-+]?[0-9]*\.?[0-9]+) Y([-+]?[0-9]*\.?[0-9]+)', point, gcode)
+        return re.sub(r'I([-+]?[0-9]*\.?[0-9]+) J([-+]?[0-9]*\.?[0-9]+)', vector, gcode)
+
+    def find_congruent_parts(self):
+        '''
+        Finds the operations which are copies of the same part (same operation, same properties, same contour up to a translation, and a rotation if self.congruent_rotation)
+        and returns {operation index: [key, origin, angle]}. The parts are stored in self.subprograms, with their contour at the origin (cf self.canonical_form).
+        The contours sharing edges with others (cf self.find_common_lines) are left out : they are not whole anymore.
+        '''
+        groups = {}
         for i in self.order:
+            if i in self.common_lines or len(self.contours[i][1]) < 2:
+                continue
+            key, origin, angle, profile = self.canonical_form(self.contours[i][1], self.congruent_rotation)
+            if key is None:
+                continue
+            key = (self.contours[i][0], json.dumps(self.define_properties(self.contours[i][2]), sort_keys = True), key)
+            groups.setdefault(key, []).append([i, origin, angle, profile])
+        result = {}
+        for key in groups:
+            if len(groups[key]) < 2:
+                continue
+            if key not in self.subprograms:
+                self.subprograms[key] = {'profile': groups[key][0][3], 'number': 1001 + len(self.subprograms), 'body': None, 'entry': None, 'end': None, 'feedrate': None, 'tabs': [], 'defined': False}
+            for i, origin, angle, profile in groups[key]:
+                result[i] = [key, origin, angle]
+        return result
+
+    def canonical_form(self, profile, rotation = False):
+        '''
+        Returns [key, origin, angle, local profile] : the same part gives the same key wherever it is, the local profile being the contour moved so that origin is at (0, 0)
+        and turned by -angle (it begins where profile begins). The origin is a point of the contour : the lowest one without rotation, the one giving the smallest key with rotation (the angle being then the direction of its curve).
+        Coordinates are compared on a grid (self.resolution, or a micrometer), and the contour can begin anywhere : a closed contour is read from the origin for the key.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - rotation:bool True to find turned copies too
+        '''
+        grid = self.resolution if self.resolution is not None else 0.001
+        points = [[float(e) for e in self.get_point_from_curve(curve)] for curve in profile]
+        n = len(profile)
+        closed = n > 2 and self.distance(points[0], points[-1]) < grid
+        if closed:
+            # the 'M' is the end of the last curve : each point can begin the contour
+            starts = list(range(1, n))
+            if not rotation:
+                lowest = min([[round(points[k][0] / grid), round(points[k][1] / grid)] for k in starts])
+                starts = [k for k in starts if [round(points[k][0] / grid), round(points[k][1] / grid)] == lowest]
+        else:
+            starts = [0]
+        best = None
+        for k in starts:
+            indexes = [(k + m) % (n - 1) + 1 for m in range(0, n - 1)] if closed else list(range(1, n))
+            origin = points[k]
+            angle = 0
+            if rotation:
+                end = points[indexes[0]]
+                if self.distance(origin, end) == 0:
+                    continue
+                angle = math.atan2(end[1] - origin[1], end[0] - origin[0])
+            key = tuple(self.local_curves(profile, points, indexes, origin, angle, grid)[1])
+            if best is None or key < best[0]:
+                best = [key, origin, angle]
+        if best is None:
+            return [None, points[0], 0, profile]
+        key, origin, angle = best
+        # the local profile keeps the start of the path : the holding tabs are then placed as on the part itself (cf self.add_holding_tabs)
+        x, y = self.transform_point([points[0][0] - origin[0], points[0][1] - origin[1]], [0, 0], -angle)
+        local = [['M', [x, y]]] + self.local_curves(profile, points, range(1, n), origin, angle, grid)[0]
+        return [key, origin, angle, local]
+
+    def local_curves(self, profile, points, indexes, origin, angle, grid):
+        '''
+        Returns [curves, key] : the curves of profile at indexes, moved so that origin is at (0, 0) and turned by -angle, and their rounded form for the key (cf self.canonical_form).
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - points:[[float, float]] end points of the curves of profile
+                - indexes:[int] indexes of the curves, in order
+                - origin:[float, float] origin of the part
+                - angle:float angle of the part, in radians
+                - grid:float size of the grid the coordinates are compared on
+        '''
+        curves = []
+        key = []
+        for j in indexes:
+            x, y = self.transform_point([points[j][0] - origin[0], points[j][1] - origin[1]], [0, 0], -angle)
+            if profile[j][0] == 'A':
+                arc = [float(e) for e in profile[j][1]]
+                phi = (arc[2] - math.degrees(angle)) % 360
+                curves.append(['A', [arc[0], arc[1], phi, arc[3], arc[4], x, y]])
+                key.append(('A', round(x / grid), round(y / grid), round(arc[0] / grid), round(arc[1] / grid), 0 if arc[0] == arc[1] else round(phi % 180, 3), arc[3], arc[4]))
+            else:
+                curves.append(['L', [x, y]])
+                key.append(('L', round(x / grid), round(y / grid)))
+        return [curves, key]
+
+    def calculate_windowed(self, operations, output, window_width = 1000, seam_width = 50, priority = [], index = None):
+        '''
+        Calculates the gcode for very large sheets with a bounded memory, writing it directly to output (self.gcode stays empty).
+        The sheet is cut in vertical strips (windows) of window_width : the operations are first sorted into their window (on disk),
+        then each window is loaded, ordered and written before the next one is loaded.
+        An operation belongs to the window of its right end, so everything inside a contour is in the same window or in a previous one (inner contours stay first).
+        Contours close to the right border of a window and not inside another contour of the window are moved to the next window, to be ordered with their neighbours.
+            arguments:
+                - operations:iterable of [svg_path, operation_type, properties] (same as self.add_operation). Can be a generator
+                - output:file opened text file where the gcode is written
+                - window_width:float width of a window
+                - seam_width:float width of the band, at the right border of a window, where contours can be moved to the next window
+                - priority:[str] same as in self.calculate
+                - index:file opened text file where the index of the program is written as it comes (cf self.save_index). None keeps it in self.program_index
+        '''
+        directory = tempfile.mkdtemp()
+        self.index_stream = index
+        try:
+            # sorting the operations into their window
+            windows = {}
+            operation_id = 0
+            for svg_path, operation_type, properties in operations:
+                self.check_operation(operation_type, properties)
+                box = self.bounding_box(self.flatten_path(self.parse_path(svg_path)))
+                k = int(math.floor(box[2] / window_width))
+                if k not in windows:
+                    windows[k] = open(os.path.join(directory, '{}.json'.format(k)), 'w')
+                windows[k].write(json.dumps([operation_id, operation_type, svg_path, properties]) + '\n')
+                operation_id += 1
+            for k in windows:
+                windows[k].close()
+
+            self.writer = GcodeWriter(output)
+            self.writer.write(self.post_processor.header())
+            # the state of the machine is unknown at the beginning of the program
+            self.current_position = [0, 0]
+            self.current_height = None
+            self.position_known = False
+            self.current_tool = None
+            self.spindle_speed = None
+            self.current_feedrate = None
+            self.program_index = {'operations': [], 'subprograms': []}
+            self.subprograms = {}
+            self.subprogram_definitions = []
+            keys = sorted(windows.keys())
+            carried = []
+            for n in range(0, len(keys)):
+                window = carried
+                with open(os.path.join(directory, '{}.json'.format(keys[n]))) as bucket:
+                    for line in bucket:
+                        window.append(json.loads(line))
+                os.remove(os.path.join(directory, '{}.json'.format(keys[n])))
+                self.contours = [[el[1], self.parse_path(el[2]), el[3]] for el in window]
+                carried = []
+                if n < len(keys) - 1:
+                    # contours near the next window are left for it
+                    parents = self.containment_tree(list(range(0, len(self.contours))))
+                    border = (keys[n] + 1) * window_width - seam_width
+                    kept = []
+                    for i in range(0, len(window)):
+                        if parents[i] == -1 and self.bounding_box(self.flatten_path(self.contours[i][1]))[0] > border:
+                            carried.append(window[i])
+                        else:
+                            kept.append(i)
+                    window = [window[i] for i in kept]
+                    self.contours = [self.contours[i] for i in kept]
+                self.determine_order(priority)
+                self.common_lines = self.find_common_lines() if self.common_line_cutting else {}
+                self.congruent = self.find_congruent_parts() if self.congruent_parts else {}
+                self.holding_tabs = []
+                for i in self.order:
+                    self.machine_operation(i, window[i][0])
+                self.writer.flush()
+            self.writer.write(self.post_processor.footer())
+            self.writer.write("".join(self.subprogram_definitions))
+            self.writer.write(self.post_processor.end_of_file())
+            self.writer.flush()
+            if index is not None:
+                self.write_index_end(index)
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+            self.index_stream = None
+        self.spindle_speed = None
+        self.contours = []
+        self.order = []
+        self.gcode = ""
+
+    def add_to_index(self, kind, entry):
+        '''
+        Adds an entry to the index of the program : to self.program_index, or straight to self.index_stream.
+            arguments:
+                - kind:str 'operations' or 'subprograms'
+                - entry:dict entry (cf self.program_index)
+        '''
+        if self.index_stream is None:
+            self.program_index[kind].append(entry)
+        else:
+            self.index_stream.write(json.dumps(dict(entry, type = kind)) + '\n')
+
+    def write_index_end(self, index):
+        '''
+        Writes the last line of an index : what's needed to write a restart program, and the size of the program, to check that the index matches it.
+            arguments:
+                - index:file opened text file of the index
+        '''
+        index.write(json.dumps({'type': 'program', 'post_processor': self.post_processor.name, 'header': self.post_processor.header(), 'size': self.writer.size}) + '\n')
+
+    def save_index(self, path):
+        '''
+        Writes the index of the last program calculated (cf self.program_index) next to the program. Needed by self.restart_program.
+        The index is a json lines file : one line per operation or subprogram definition, then a last line for the program.
+        The offsets are counted in bytes from the beginning of the program : it must be written as it is (no conversion of the line endings).
+            arguments:
+                - path:str path of the index file (usually the path of the program followed by '.idx')
+        '''
+        with open(path, 'w') as index:
+            for kind in ['operations', 'subprograms']:
+                for entry in self.program_index[kind]:
+                    index.write(json.dumps(dict(entry, type = kind)) + '\n')
+            self.write_index_end(index)
+
+    def restart_program(self, gcode_path, operation, output_path, index_path = None):
+        '''
+        Writes a program restarting the given program at an operation (after a tool break, for instance), without calculating anything again.
+        The new program is the header, the subprograms defined before the operation, the state of the machine at the beginning of the operation
+        (tool, spindle speed, feedrate, position above the stock), and the rest of the program as it is. The program is read through a memory map,
+        so only the bytes copied are read, whatever the size of the program.
+            arguments:
+                - gcode_path:str path of the program
+                - operation:int number of the operation to restart from (as written in the comments of the program)
+                - output_path:str path of the restart program
+                - index_path:str path of the index of the program (cf self.save_index). Default : gcode_path followed by '.idx'
+        '''
+        entry = None
+        subprograms = []
+        program = None
+        with open(gcode_path + '.idx' if index_path is None else index_path) as index:
+            for line in index:
+                item = json.loads(line)
+                if item['type'] == 'operations' and item['operation'] == operation and entry is None:
+                    entry = item
+                elif item['type'] == 'subprograms':
+                    subprograms.append(item)
+                elif item['type'] == 'program':
+                    program = item
+        if program is None:
+            raise ValueError('the index is not complete')
+        if program['post_processor'] != self.post_processor.name:
+            raise ValueError('the program was written for {}, not for {}'.format(program['post_processor'], self.post_processor.name))
+        if entry is None:
+            raise ValueError('operation {} is not in the program'.format(operation))
+        with open(gcode_path, 'rb') as source:
+            data = mmap.mmap(source.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                if len(data) != program['size']:
+                    raise ValueError('the index does not match the program (it was written again, or its line endings changed)')
+                with open(output_path, 'wb') as output:
+                    output.write(program['header'].encode('ascii'))
+                    for subprogram in subprograms:
+                        if subprogram['start'] < entry['offset']:
+                            output.write(data[subprogram['start']:subprogram['end']])
+                    temp = self.post_processor.comment('restart at operation {}'.format(operation))
+                    if entry['tool'] is not None:
+                        temp += self.post_processor.tool_change(entry['tool'])
+                    if entry['spindle_speed'] is not None:
+                        temp += self.post_processor.spindle_on(entry['spindle_speed'])
+                    if entry['feedrate'] is not None:
+                        temp += self.post_processor.feed(entry['feedrate'])
+                    temp += self.post_processor.retract(entry['clearance'])
+                    temp += self.post_processor.rapid(entry['position'][0], entry['position'][1], entry['clearance'])
+                    output.write(temp.encode('ascii'))
+                    # the rest of the program, by pieces of a few megabytes
+                    for start in range(entry['offset'], len(data), 1 << 22):
+                        output.write(data[start:start + (1 << 22)])
+            finally:
+                data.close()
+
+    def determine_order(self, priority = []):
+        '''
+        Determines the order to follow depending of the type of machining and writes it in self.order.
+        Everything lying inside a closed contour is machined before this contour (otherwise the part could be freed too early), a pocket before its rest machining, then the priority classes are followed,
+        and inside these constraints the closest contour is always chosen next.
+        When several tools are used, the operations are grouped by tool and the groups are ordered to minimize tool changes and travelling (cf self.order_tool_groups).
+            arguments:
+                - priority:[str] same as in self.calculate
+        '''
+        for el in self.contours:
+            if isinstance(el[1], str):
+                el[1] = self.parse_path(el[1])
+        indexes = list(range(0, len(self.contours)))
+        parents = self.containment_tree(indexes)
+        # the rest machining of a pocket comes after the pocket cleared by the bigger tool (cf self.rest_pocket)
+        pockets = {}
+        for i in indexes:
             if self.contours[i][0] == 'pocket_inside':
-                self.pocket(self.contours[i][1], self.contours[i][0], self.contours[i][2])
-            if self.contours[i][0] == 'pocket_outside':
-                self.pocket(self.contours[i][1], self.contours[i][0], self.contours[i][2])
-            if self.contours[i][0] == 'profile_inside':
-                self.profile(self.contours[i][1], self.contours[i][0], self.contours[i][2])
-            if self.contours[i][0] == 'profile_outside':
-                self.profile(self.contours[i][1], self.contours[i][0], self.contours[i][2])
-            if self.contours[i][0] == 'engraving':
-                self.engrave(self.contours[i][1], self.contours[i][0], self.contours[i][2])
+                pockets.setdefault((json.dumps(self.contours[i][1]), float(self.define_properties(self.contours[i][2])['drill_radius'])), []).append(i)
+        for i in indexes:
+            if self.contours[i][0] == 'pocket_rest':
+                for j in pockets.get((json.dumps(self.contours[i][1]), float(self.define_properties(self.contours[i][2])['rest_radius'])), []):
+                    parents[j] = i
+        groups = {}
+        for i in indexes:
+            groups.setdefault(self.get_tool(self.contours[i][2]), []).append(i)
+        if len(groups) <= 1:
+            self.order, position = self.schedule(indexes, self.current_position, priority, parents)
+            return
+        self.order = []
+        position = self.current_position
+        for group in self.order_tool_groups(groups, parents, priority):
+            order, position = self.schedule(group, position, priority, parents)
+            self.order += order
+
+    def order_tool_groups(self, groups, parents, priority = []):
+        '''
+        Returns the list of groups of contours to machine one after the other, each group being machined with a single tool (as far as possible).
+        The cost of an order is the time spent in tool changes and in travelling between groups. The best order is found by dynamic programming over the subsets of groups
+        (greedily when there are too many tools), and a group can only come once all the groups holding contours inside its contours are done.
+        If tools depend on each other (a contour of tool 1 in a contour of tool 2, itself in a contour of tool 1), their groups are merged and machined together.
+            arguments:
+                - groups:dict {tool number: [indexes of the contours machined with this tool]}
+                - parents:dict cf self.containment_tree
+                - priority:[str] same as in self.calculate
+        '''
+        tool_of = {}
+        for tool in groups:
+            for i in groups[tool]:
+                tool_of[i] = tool
+        # tool a must come before tool b if a contour of a is inside a contour of b
+        after = dict([(tool, set()) for tool in groups])
+        for i in tool_of:
+            parent = parents.get(i, -1)
+            if parent in tool_of and tool_of[parent] != tool_of[i]:
+                after[tool_of[i]].add(tool_of[parent])
+
+        def reachable(tool):
+            seen = set([tool])
+            stack = [tool]
+            while len(stack) > 0:
+                for other in after[stack.pop()]:
+                    if other not in seen:
+                        seen.add(other)
+                        stack.append(other)
+            return seen
+
+        # tools depending on each other are merged in a single unit
+        reach = dict([(tool, reachable(tool)) for tool in groups])
+        units = []
+        for tool in sorted(groups.keys()):
+            if not any([tool in unit for unit in units]):
+                units.append(sorted([other for other in reach[tool] if tool in reach[other]]))
+        unit_of = {}
+        for u in range(0, len(units)):
+            for tool in units[u]:
+                unit_of[tool] = u
+        before = [set() for unit in units]
+        for tool in groups:
+            for other in after[tool]:
+                if unit_of[other] != unit_of[tool]:
+                    before[unit_of[other]].add(unit_of[tool])
+        members = [[i for tool in unit for i in groups[tool]] for unit in units]
+
+        # estimate the entry and exit points of each unit, with a tour starting from the current position
+        speed = self.rapid_feedrate / 60.0
+        entries = []
+        exits = []
+        for u in range(0, len(units)):
+            order, position = self.schedule(members[u], self.current_position, priority, parents)
+            points = self.entry_points(self.contours[order[0]][1], self.contours[order[0]][0])
+            if self.contours[order[0]][0] != 'engraving' and len(points) > 0:
+                points = [self.closest_point(self.contours[order[0]][1], self.current_position)[1]]
+            entries.append(min(points, key = lambda p: (float(p[0]) - self.current_position[0])**2 + (float(p[1]) - self.current_position[1])**2) if len(points) > 0 else self.current_position)
+            exits.append(position)
+
+        def cost(position, u, first = False):
+            # the tool already in the spindle does not need to be changed for the first group
+            change = sum([self.tool_table[tool]['change_time'] for tool in units[u] if tool != self.current_tool or not first])
+            return change + math.sqrt((float(entries[u][0]) - float(position[0]))**2 + (float(entries[u][1]) - float(position[1]))**2) / speed
+
+        n = len(units)
+        if n <= 12:
+            # dynamic programming : best[(done, last)] = [cost, previous state]
+            best = {}
+            for u in range(0, n):
+                if len(before[u]) == 0:
+                    best[(1 << u, u)] = [cost(self.current_position, u, True), None]
+            for mask in range(1, 1 << n):
+                for u in range(0, n):
+                    if (mask, u) not in best:
+                        continue
+                    for v in range(0, n):
+                        if mask & (1 << v) or any([not mask & (1 << w) for w in before[v]]):
+                            continue
+                        c = best[(mask, u)][0] + cost(exits[u], v)
+                        if (mask | (1 << v), v) not in best or c < best[(mask | (1 << v), v)][0]:
+                            best[(mask | (1 << v), v)] = [c, (mask, u)]
+            full = (1 << n) - 1
+            last = min([u for u in range(0, n) if (full, u) in best], key = lambda u: best[(full, u)][0])
+            sequence = []
+            state = (full, last)
+            while state is not None:
+                sequence.insert(0, state[1])
+                state = best[state][1]
+        else:
+            # too many tools : take the cheapest available group each time
+            sequence = []
+            position = self.current_position
+            while len(sequence) < n:
+                available = [u for u in range(0, n) if u not in sequence and before[u].issubset(sequence)]
+                u = min(available, key = lambda u: cost(position, u, len(sequence) == 0))
+                sequence.append(u)
+                position = exits[u]
+        return [members[u] for u in sequence]
+
+    def schedule(self, indexes, position, priority, parents):
+        '''
+        Returns the order in which the given contours should be machined, and the position of the machining head at the end, as [order, position].
+        This is a nearest neighbour tour with precedence constraints : a contour is only available once all the contours inside it are done,
+        and the closest available contour of the first non empty priority class is chosen each time (cf SpatialIndex). The distance to a closed contour is the distance
+        to its closest point, anywhere along its curves.
+            arguments:
+                - indexes:[int] indexes of the contours to order (in self.contours)
+                - position:[float, float] starting position of the machining head
+                - priority:[str] same as in self.calculate
+                - parents:dict index of the contour directly containing each contour, or -1 (cf self.containment_tree)
+        '''
+        indexes = list(indexes)
+        scheduled = set(indexes)
+        entry_points = {}
+        for i in indexes:
+            entry_points[i] = self.entry_points(self.contours[i][1], self.contours[i][0])
+        cell_size = self.index_cell_size([point for i in indexes for point in entry_points[i]])
+        # one spatial index per priority class, holding the contours which are available
+        classes = {}
+        for i in indexes:
+            classes[self.priority_class(self.contours[i][0], priority)] = SpatialIndex(cell_size)
+        ranks = sorted(classes.keys())
+        # number of contours inside each contour still to be machined
+        waiting = dict([(i, 0) for i in indexes])
+        for i in indexes:
+            if parents.get(i, -1) in scheduled:
+                waiting[parents[i]] += 1
+
+        def make_available(i):
+            index = classes[self.priority_class(self.contours[i][0], priority)]
+            for point in entry_points[i]:
+                index.insert(i, point[0], point[1])
+            if len(entry_points[i]) == 0:
+                index.insert(i, position[0], position[1])
+
+        for i in indexes:
+            if waiting[i] == 0:
+                make_available(i)
+        # the curves of the closed contours : a contour can be entered anywhere along them (cf self.enter_profile), not only at their ends
+        tree = RTree([[box, [i, curve]] for i in indexes if self.contours[i][0] != 'engraving' for box, curve in self.profile_curves(self.contours[i][1])])
+        order = []
+        while len(order) < len(indexes):
+            # look for the closest available contour of the first priority class, and append it index to the list
+            for rank in ranks:
+                if len(classes[rank]) > 0:
+                    index = classes[rank]
+                    break
+            x, y, i, d = index.nearest(position[0], position[1])
+            # only a curve closer than the closest end can hold a closer point
+            for j, curve in tree.query([position[0] - d, position[1] - d, position[0] + d, position[1] + d]):
+                if j in index:
+                    point = self.curve_projection([float(position[0]), float(position[1])], curve)[1]
+                    distance = self.distance([float(position[0]), float(position[1])], point)
+                    if distance < d:
+                        x, y, i, d = point[0], point[1], j, distance
+            index.remove(i)
+            order.append(i)
+            # change the current position
+            position = self.exit_point(self.contours[i][1], self.contours[i][0], self.contours[i][2], [x, y])
+            # the contour containing this one may now be available
+            parent = parents.get(i, -1)
+            if parent in scheduled:
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    make_available(parent)
+        return [order, position]
+
+    def priority_class(self, type, priority = []):
+        '''
+        Returns the rank of an operation type in the priority list (lower is machined first).
+        An element of the list can be a complete operation type ('profile_inside') or a family ('profile').
+        Types which are not listed come after the listed ones, in the default order : engraving -> pockets -> profiles.
+            arguments:
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+                - priority:[str] same as in self.calculate
+        '''
+        default = ['engraving', 'pocket', 'profile']
+        for i in range(0, len(priority)):
+            if type == priority[i] or type.startswith(priority[i] + '_'):
+                return i
+        for i in range(0, len(default)):
+            if type == default[i] or type.startswith(default[i] + '_'):
+                return len(priority) + i
+        return len(priority) + len(default)
+
+    def containment_tree(self, indexes):
+        '''
+        Returns, for each contour, the index of the smallest closed contour containing it (or -1), as a dict.
+        Candidates are found by bounding box with an R-tree (cf RTree), then checked with a point in polygon test.
+        Engravings are open paths : they can be inside a contour, but never contain anything.
+            arguments:
+                - indexes:[int] indexes of the contours to consider (in self.contours)
+        '''
+        polygons = {}
+        boxes = {}
+        for i in indexes:
+            polygons[i] = self.flatten_path(self.contours[i][1])
+            boxes[i] = self.bounding_box(polygons[i])
+        tree = RTree([[boxes[i], i] for i in indexes if self.contours[i][0] != 'engraving' and len(polygons[i]) > 2])
+        parents = {}
+        for i in indexes:
+            parents[i] = -1
+            if len(polygons[i]) == 0:
+                continue
+            box = boxes[i]
+            best_area = -1
+            for j in tree.query(box):
+                other = boxes[j]
+                if j == i or other == box:
+                    continue
+                if other[0] <= box[0] and other[1] <= box[1] and other[2] >= box[2] and other[3] >= box[3]:
+                    area = (other[2] - other[0]) * (other[3] - other[1])
+                    if (best_area == -1 or area < best_area) and self.point_in_polygon(polygons[i][0], polygons[j]):
+                        best_area = area
+                        parents[i] = j
+        return parents
+
+    def find_common_lines(self, tolerance = 0.01):
+        '''
+        Finds the edges shared by neighbouring 'profile_outside' contours (common-line cutting) and returns {operation index: open paths left to machine}.
+        Two edges are shared when the tool goes along the same line for both : coincident edges without compensation, edges one tool diameter apart with the host compensation.
+        The contour machined first (cf self.order) keeps its whole lap and cuts the shared edge, the other one only machines what's left of its tool path, as open paths.
+        The line segments of the tool paths are stored in an R-tree (cf RTree), so that each segment is only compared to its neighbours.
+            arguments:
+                - tolerance:float maximum distance between two tool paths to consider them as one
+        '''
+        paths = {}
+        properties = {}
+        for i in self.order:
+            properties[i] = self.define_properties(self.contours[i][2])
+            if self.contours[i][0] != 'profile_outside' or properties[i]['compensation'] not in ['none', 'host']:
+                continue
+            if properties[i]['compensation'] == 'host':
+                paths[i] = self.offset_curve(self.contours[i][1], properties[i]['drill_radius'], 'outside')
+            else:
+                paths[i] = [self.contours[i][1]]
+        segments = []
+        for i in paths:
+            for loop in paths[i]:
+                for k in range(1, len(loop)):
+                    if loop[k][0] == 'L':
+                        s = [float(e) for e in self.get_point_from_curve(loop[k - 1])]
+                        e = [float(e) for e in loop[k][1]]
+                        box = [min(s[0], e[0]) - tolerance, min(s[1], e[1]) - tolerance, max(s[0], e[0]) + tolerance, max(s[1], e[1]) + tolerance]
+                        segments.append([box, [i, s, e]])
+        tree = RTree(segments)
+        rank = dict([[i, k] for k, i in enumerate(self.order)])
+
+        result = {}
+        for i in paths:
+            # a shared edge can only be left to a contour machined before, with the same tool, at least as deep
+            tool = self.get_tool(properties[i])
+            chains = []
+            shared = False
+            for loop in paths[i]:
+                cuts = {}
+                for k in range(1, len(loop)):
+                    if loop[k][0] != 'L':
+                        continue
+                    s = [float(e) for e in self.get_point_from_curve(loop[k - 1])]
+                    e = [float(e) for e in loop[k][1]]
+                    length = self.distance(s, e)
+                    # under a tool diameter, splitting the lap costs more than it saves
+                    if length < 2 * properties[i]['drill_radius']:
+                        continue
+                    u = [(e[0] - s[0]) / length, (e[1] - s[1]) / length]
+                    intervals = []
+                    for j, a, b in tree.query([min(s[0], e[0]), min(s[1], e[1]), max(s[0], e[0]), max(s[1], e[1])]):
+                        if rank[j] >= rank[i] or self.get_tool(properties[j]) != tool or properties[j]['target_depth'] > properties[i]['target_depth']:
+                            continue
+                        # both ends of the other segment must be on the line of this one
+                        if abs(u[0] * (a[1] - s[1]) - u[1] * (a[0] - s[0])) > tolerance or abs(u[0] * (b[1] - s[1]) - u[1] * (b[0] - s[0])) > tolerance:
+                            continue
+                        ta = (u[0] * (a[0] - s[0]) + u[1] * (a[1] - s[1])) / length
+                        tb = (u[0] * (b[0] - s[0]) + u[1] * (b[1] - s[1])) / length
+                        low = max(min(ta, tb), 0)
+                        high = min(max(ta, tb), 1)
+                        if (high - low) * length >= 2 * properties[i]['drill_radius']:
+                            intervals.append([low, high])
+                    if len(intervals) > 0:
+                        cuts[k] = self.merge_intervals(intervals)
+                if len(cuts) == 0:
+                    chains.append(loop)
+                    continue
+                shared = True
+                chains += self.split_loop(loop, cuts)
+            if shared:
+                result[i] = chains
+        return result
+
+    def merge_intervals(self, intervals):
+        '''
+        Returns the union of a list of intervals, as a sorted list of disjoint intervals.
+            arguments:
+                - intervals:list list of [low, high]
+        '''
+        result = []
+        for low, high in sorted(intervals):
+            if len(result) > 0 and low <= result[-1][1]:
+                result[-1][1] = max(result[-1][1], high)
+            else:
+                result.append([low, high])
+        return result
+
+    def split_loop(self, loop, cuts):
+        '''
+        Returns the open paths left of a closed profile once some parts of its lines are removed.
+            arguments:
+                - loop:list closed profile (cf self.parse_path)
+                - cuts:dict {index of a line or arc in loop: sorted list of [low, high]}, the parts of the curve to remove (0 is its start, 1 its end, cf self.curve_parameter)
+        '''
+        # the loop as a list of curves and gaps, a gap giving the point where the next path starts
+        items = []
+        for k in range(1, len(loop)):
+            if k not in cuts:
+                items.append([loop[k][0], list(loop[k][1])])
+                continue
+            s = [float(e) for e in self.get_point_from_curve(loop[k - 1])]
+            e = [float(e) for e in self.get_point_from_curve(loop[k])]
+            curve = [s, e, self.circle_of_arc(s, loop[k]) if loop[k][0] == 'A' else None]
+            position = 0
+            for low, high in cuts[k]:
+                if low > position:
+                    items.append(self.cut_curve(loop[k], s, self.point_of_curve(curve, position), self.point_of_curve(curve, low)))
+                items.append(['gap', self.point_of_curve(curve, high)])
+                position = high
+            if position < 1:
+                items.append(self.cut_curve(loop[k], s, self.point_of_curve(curve, position), e))
+        # the loop is closed : the paths are read from the first gap, going round
+        first = [item[0] for item in items].index('gap')
+        items = items[first:] + items[:first]
+        chains = []
+        for item in items:
+            if item[0] == 'gap':
+                chains.append([['M', item[1]]])
+            elif not self.same_point(self.get_point_from_curve(chains[-1][-1]), self.get_point_from_curve(item)):
+                chains[-1].append(item)
+        return [chain for chain in chains if len(chain) > 1]
+
+    def flatten_path(self, profile, angle_step = math.pi / 16):
+        '''
+        Returns the list of points of a path, arcs being replaced by small lines. Used for containment tests and bounding boxes.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - angle_step:float maximum angle (in radian) covered by each line replacing an arc
+        '''
+        points = []
+        for i in range(0, len(profile)):
+            if profile[i][0] == 'A' and i > 0:
+                start = self.get_point_from_curve(profile[i - 1])
+                circle = self.arc_to_circle(start[0], start[1], profile[i][1])
+                r = math.sqrt((float(start[0]) - circle['cx'])**2 + (float(start[1]) - circle['cy'])**2)
+                n = max(int(math.ceil(abs(circle['deltaAngle']) / angle_step)), 1)
+                for k in range(1, n):
+                    angle = circle['startAngle'] + circle['deltaAngle'] * k / n
+                    points.append([circle['cx'] + r * math.cos(angle), circle['cy'] + r * math.sin(angle)])
+            point = self.get_point_from_curve(profile[i])
+            points.append([float(point[0]), float(point[1])])
+        return points
+
+    def bounding_box(self, points):
+        '''
+        Returns the bounding box of a list of points, as [min_x, min_y, max_x, max_y].
+            arguments:
+                - points:list list of points in the format [x, y]
+        '''
+        if len(points) == 0:
+            return [0, 0, 0, 0]
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        return [min(xs), min(ys), max(xs), max(ys)]
+
+    def point_in_polygon(self, point, polygon):
+        '''
+        Returns True if the point is inside the polygon (ray casting : count how many edges are crossed by an horizontal ray).
+            arguments:
+                - point:[float, float] coordinates of the point
+                - polygon:list list of points in the format [x, y], the last one being linked to the first one
+        '''
+        x = point[0]
+        y = point[1]
+        inside = False
+        j = len(polygon) - 1
+        for i in range(0, len(polygon)):
+            xi, yi = polygon[i][0], polygon[i][1]
+            xj, yj = polygon[j][0], polygon[j][1]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
+
+    def entry_points(self, profile, type):
+        '''
+        Returns the ends of the curves where the machining of a contour can begin.
+        A closed contour can be entered at the end of any of its curves (and anywhere along them, cf self.enter_profile), an engraving only at one of its two ends.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+        '''
+        if len(profile) == 0:
+            return []
+        if type == 'engraving':
+            return [self.get_point_from_curve(profile[0]), self.get_point_from_curve(profile[-1])]
+        return [self.get_point_from_curve(curve) for curve in profile]
+
+    def exit_point(self, profile, type, properties, entry):
+        '''
+        Returns the position of the machining head once the contour has been machined from the given entry point.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+                - properties:dict contains the machining characteristics (cf self.add_operation)
+                - entry:[float, float] point where the machining begins
+        '''
+        if type != 'engraving':
+            return entry
+        # an engraving is machined back and forth : with an odd number of passes, the head ends at the other end of the path
+        properties = self.define_properties(properties)
+        passes = len(self.depth_passes(properties))
+        start = self.get_point_from_curve(profile[0])
+        end = self.get_point_from_curve(profile[-1])
+        if passes % 2 == 0:
+            return entry
+        if [float(entry[0]), float(entry[1])] == [float(start[0]), float(start[1])]:
+            return end
+        return start
+
+    def depth_passes(self, properties):
+        '''
+        Returns the depths of the laps of an operation, from the stock surface down to the target depth.
+        The depth is shared evenly between the laps, none of them removing more than depth_increment, and the last one is exactly at the target depth : no lap is machined twice.
+        With a finishing_depth, the roughing laps stop this much above the target depth and a last thin lap goes down to it.
+            arguments:
+                - properties:dict properties of the operation, as returned by self.define_properties
+        '''
+        top = properties['stock_surface']
+        bottom = properties['target_depth']
+        if bottom >= top:
+            # nothing to remove above the target depth : one lap there, as asked
+            return [bottom]
+        roughing = bottom + properties['finishing_depth'] if 0 < properties['finishing_depth'] < top - bottom else bottom
+        # the small margin keeps a float error from adding a lap (30 / 3 must give 10 laps)
+        count = max(int(math.ceil((top - roughing) / abs(properties['depth_increment']) - 0.000001)), 1) if properties['depth_increment'] != 0 else 1
+        passes = [top - (top - roughing) * k / count for k in range(1, count)] + [roughing]
+        if roughing != bottom:
+            passes.append(bottom)
+        return passes
+
+    def index_cell_size(self, points):
+        '''
+        Returns a cell size for a SpatialIndex holding the given points (about one point per cell on average).
+            arguments:
+                - points:list list of points in the format [x, y]
+        '''
+        if len(points) == 0:
+            return 1
+        xs = [float(point[0]) for point in points]
+        ys = [float(point[1]) for point in points]
+        area = (max(xs) - min(xs)) * (max(ys) - min(ys))
+        if area <= 0:
+            area = (max(xs) - min(xs) + max(ys) - min(ys))**2
+        return max(math.sqrt(area / len(points)), 1)
+
+    def profile(self, profile, type, properties):
+        '''
+        Determines the gcode string for a profile cut.
+            arguments:
+                - profile:[] list of line / elliptic arc / bezier elements.
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, finishing_depth, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width, compensation, lead_length, spindle_speed, stepover, adaptive_feed
+        '''
+        # profile = self.parse_path(svg_path)
+        properties = self.define_properties(properties)
+
+        # offsetting the path by the drill radius : done here (compensation 'host') or by the controller (compensation 'controller')
+        if properties['compensation'] == 'host':
+            for sub_profile in self.offset_curve(profile, properties['drill_radius'], 'inside' if type == 'profile_inside' else 'outside'):
+                self.profile(sub_profile, type, dict(properties, compensation = 'none'))
+            return
+        if properties['compensation'] == 'controller':
+            self.compensated_profile(profile, type, properties)
+            return
+
+        # integrating the holding tabs in a copy of the path : the contour stays as given, for the next calculations
+        profile = self.add_holding_tabs([[curve[0], list(curve[1])] for curve in profile], properties['holding_tabs_number'], properties['holding_tabs_width'], properties['holding_tabs_height'])
+        self.record_holding_tabs(profile, properties)
+
+        # searching for the closest point from current position, the profile being cut there
+        profile, closest_index = self.enter_profile(profile, self.current_position)
+
+        # bringing the machining head to the closest point
+        if profile[closest_index][0] in ['M', 'L']:
+            temp = self.travel(profile[closest_index][1][0], profile[closest_index][1][1], properties)
+            temp += self.post_processor.rapid(profile[closest_index][1][0], profile[closest_index][1][1], properties['stock_surface'])
+        elif profile[closest_index][0] in ['A']:
+            temp = self.travel(profile[closest_index][1][5], profile[closest_index][1][6], properties)
+            temp += self.post_processor.rapid(profile[closest_index][1][5], profile[closest_index][1][6], properties['stock_surface'])
+        else:
+            raise ValueError('UNEXPECTED CURVE TYPE IN THE SVG - COULD NOT GENERATE GCODE. Sorry bro :-( . Happened while generating a profile')
+        self.writer.write(temp)
+
+        side = self.wall_side(profile, type) if properties['adaptive_feed'] else 0
+        for depth in self.depth_passes(properties):
+            # plunging to the right depth
+            temp = self.feed(properties['plunge_feedrate'])
+            if profile[closest_index][0] in ['M', 'L']:
+                temp += self.post_processor.line(profile[closest_index][1][0], profile[closest_index][1][1], depth)
+            elif profile[closest_index][0] in ['A']:
+                temp += self.post_processor.line(profile[closest_index][1][5], profile[closest_index][1][6], depth)
+            self.writer.write(temp)
+            # go through the profile
+            temp = self.profile_lap(profile, closest_index, depth, properties, side)
+            self.writer.write(temp)
+            temp = ""
+        if profile[closest_index][0] in ['M', 'L']:
+            temp += self.post_processor.rapid(profile[closest_index][1][0], profile[closest_index][1][1], properties['clearance_pane'])
+            self.current_position = [profile[closest_index][1][0], profile[closest_index][1][1]]
+        elif profile[closest_index][0] in ['A']:
+            temp += self.post_processor.rapid(profile[closest_index][1][5], profile[closest_index][1][6], properties['clearance_pane'])
+            self.current_position = [float(profile[closest_index][1][5]), float(profile[closest_index][1][6])]
+        self.current_height = properties['clearance_pane']
+        self.writer.write(temp)
+
+    def profile_lap(self, profile, closest_index, depth, properties, side = 0, engagement = 1):
+        '''
+        Returns the gcode string for one lap of a closed profile at the given depth, beginning and ending at the end of the curve closest_index.
+            arguments:
+                - profile:[] list of line / elliptic arc / bezier elements, holding tabs included.
+                - closest_index:int index of the curve ending at the starting point
+                - depth:float depth of the lap
+                - properties:dict properties of the operation, as returned by self.define_properties
+                - side:int side of the wall, used by the adaptive feedrate (cf self.cutting_move)
+                - engagement:float radial engagement of the tool, used by the adaptive feedrate (cf self.cutting_move)
+        '''
+        temp = ""
+        for index in range(0, len(profile)):
+            # true index to work with : we are going to
+            i = (index + closest_index + 1)%len(profile)
+            if profile[i][0] in ['M', 'L', 'A']:
+                following = self.following_curve(profile, i, True) if properties['adaptive_feed'] else None
+                temp += self.cutting_move(self.get_point_from_curve(profile[i-1]), profile[i], following, depth, properties, side, engagement)
+            elif profile[i][0] == 'HTD':
+                temp += self.feed(properties['cut_feedrate'])
+                temp += self.post_processor.line(profile[i][1][0], profile[i][1][1], depth)
+            elif profile[i][0] == 'HTU':
+                ht_depth = depth if depth > properties['target_depth'] + properties['holding_tabs_height'] else properties['target_depth'] + properties['holding_tabs_height']
+                temp += self.feed(properties['cut_feedrate'])
+                temp += self.post_processor.line(profile[i][1][0], profile[i][1][1], ht_depth)
+                # temp = """G1 X{} Y{} Z{}\n""".format(profile[i][1][5], profile[i][1][6], depth)
+        return temp
+
+    def compensated_profile(self, profile, type, properties):
+        '''
+        Determines the gcode string for a profile cut where the controller offsets the path by the drill radius (cutter radius compensation, G41 / G42).
+        The nominal contour is written. Each lap begins with a lead-in line coming from the waste side, where the compensation is turned on,
+        and ends with a lead-out line going back to it, where the compensation is turned off.
+            arguments:
+                - profile:[] list of line / elliptic arc / bezier elements.
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside'
+                - properties:dict properties of the operation, as returned by self.define_properties
+        '''
+        # integrating the holding tabs in a copy of the path : the contour stays as given, for the next calculations
+        profile = self.add_holding_tabs([[curve[0], list(curve[1])] for curve in profile], properties['holding_tabs_number'], properties['holding_tabs_width'], properties['holding_tabs_height'])
+        self.record_holding_tabs(profile, properties)
+
+        # searching for the closest point from current position, the profile being cut there
+        profile, closest_index = self.enter_profile(profile, self.current_position)
+        entry = [float(e) for e in self.get_point_from_curve(profile[closest_index])]
+
+        # direction of the path when leaving the entry point
+        next_curve = profile[(closest_index + 1) % len(profile)]
+        if next_curve[0] == 'A':
+            target = self.get_point_tangent_arc(next_curve, entry, 'start')
+        else:
+            target = self.get_point_from_curve(next_curve)
+        dx = float(target[0]) - entry[0]
+        dy = float(target[1]) - entry[1]
+        length = math.sqrt(dx**2 + dy**2)
+        if length == 0:
+            dx, dy, length = 1.0, 0.0, 1.0
+        dx, dy = dx / length, dy / length
+
+        # the tool is on the left of the path (G41) when the material to keep is on its right
+        area = self.signed_area(self.flatten_path(profile))
+        left = (area > 0) == (type == 'profile_inside')
+        # the lead-in comes from the side of the tool, which is the waste side
+        lead = properties['lead_length'] if properties['lead_length'] > 0 else 2 * properties['drill_radius']
+        nx, ny = (-dy, dx) if left else (dy, -dx)
+        lead_point = [entry[0] + nx * lead, entry[1] + ny * lead]
+
+        # bringing the machining head to the lead-in point, down to the stock surface
+        temp = self.travel(lead_point[0], lead_point[1], properties)
+        temp += self.post_processor.rapid(lead_point[0], lead_point[1], properties['stock_surface'])
+        self.writer.write(temp)
+
+        tool = self.get_tool(properties)
+        for depth in self.depth_passes(properties):
+            # plunging on the waste side, then joining the contour while turning the compensation on
+            temp = self.feed(properties['plunge_feedrate'])
+            temp += self.post_processor.line(lead_point[0], lead_point[1], depth)
+            temp += self.feed(properties['cut_feedrate'])
+            temp += (self.post_processor.compensation_left if left else self.post_processor.compensation_right)(tool, entry[0], entry[1], depth)
+            # the path written is the wall and not the center of the tool : the arcs keep the cut feedrate
+            temp += self.profile_lap(profile, closest_index, depth, properties, None)
+            # leaving the contour while turning the compensation off
+            temp += self.feed(properties['cut_feedrate'])
+            temp += self.post_processor.compensation_off(lead_point[0], lead_point[1], depth)
+            self.writer.write(temp)
+        self.writer.write(self.post_processor.rapid(lead_point[0], lead_point[1], properties['clearance_pane']))
+        self.current_position = lead_point
+        self.current_height = properties['clearance_pane']
+
+    def signed_area(self, points):
+        '''
+        Returns the signed area of a polygon : positive if its points are given counter-clockwise (with the Y axis going up, as on the machine), negative otherwise.
+            arguments:
+                - points:list list of points in the format [x, y], the last one being linked to the first one
+        '''
+        area = 0
+        j = len(points) - 1
+        for i in range(0, len(points)):
+            area += (float(points[j][0]) * float(points[i][1]) - float(points[i][0]) * float(points[j][1]))
+            j = i
+        return area / 2
+
+    def profile_area(self, profile):
+        '''
+        Returns the signed area of a closed profile (same sign as self.signed_area), arcs included : the area of the chords' polygon plus the circular segment of each arc.
+        When self.resolution is set, the area of the polygon is computed on the grid : the orientation of a profile made of lines is exact.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+        '''
+        area = 0
+        if self.resolution is not None:
+            area = -self.winding(profile) / 2 * self.resolution**2
+        for i in range(0, len(profile)):
+            s = self.get_point_from_curve(profile[i - 1])
+            e = self.get_point_from_curve(profile[i])
+            if self.resolution is None:
+                area += (float(s[0]) * float(e[1]) - float(e[0]) * float(s[1])) / 2
+            if profile[i][0] == 'A' and i > 0 and not self.same_point(s, e):
+                circle = self.circle_of_arc(s, profile[i])
+                # segment between the chord and the arc : on the left of the chord if the arc turns counter-clockwise (delta > 0)
+                area += math.copysign(circle[2]**2 / 2 * (abs(circle[4]) - math.sin(abs(circle[4]))), circle[4])
+        return area
+
+    def pocket(self, profile, type, properties):
+        '''
+        Determines the gcode string for a pocket cut.
+        A 'pocket_inside' is cleared with rings offset from the contour (cf self.offset_family), from the center to the wall, every 2 * drill_radius * stepover.
+        A 'pocket_adaptive' follows the same rings, with loops keeping the radial engagement of the tool under the stepover in the slots and the corners (cf self.adaptive_loop).
+            arguments:
+                - svg_path:[] list of line / elliptic arc / bezier elements.
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, finishing_depth, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width, compensation, lead_length, spindle_speed, stepover, adaptive_feed
+        '''
+        # profile = self.parse_path(svg_path)
+        properties = self.define_properties(properties)
+
+        if type in ['pocket_inside', 'pocket_adaptive']:
+            # the first ring touches the wall, the last ones are the center of the pocket : they are machined first
+            step = 2 * properties['drill_radius'] * properties['stepover']
+            rings = self.offset_family(profile, direction = 'inside', step = step, start = properties['drill_radius'])
+            loops = [loop for offsets in reversed(rings) for loop in offsets]
+            distances = [properties['drill_radius'] + k * step for k in reversed(range(0, len(rings))) for loop in rings[k]]
+        else:
+            loops = [profile]
+        if len(loops) == 0: # the pocket is narrower than the tool
+            return
+        polygons = [self.flatten_path(loop) for loop in loops]
+        # a ring is a slot if nothing is machined inside it before
+        slots = [True] * len(loops)
+        if properties['adaptive_feed'] or type == 'pocket_adaptive':
+            slots = [not any([self.point_in_polygon(polygons[j][0], polygons[k]) for j in range(0, k)]) for k in range(0, len(loops))]
+        # the slots widened with trochoidal circles are entered down around their first circle (cf self.helical_entry)
+        trochoidal = [False] * len(loops)
+        if type == 'pocket_adaptive':
+            adapted = [self.adaptive_loop(loops[k], distances[k], properties, slots[k]) for k in range(0, len(loops))]
+            trochoidal = [slots[k] and adapted[k] is not loops[k] for k in range(0, len(loops))]
+            loops = adapted
+        side = self.wall_side(profile, type) if properties['adaptive_feed'] else 0
+
+        temp = ""
+        previous_depth = properties['stock_surface']
+        for depth in self.depth_passes(properties):
+            up = True
+            for k in range(0, len(loops)):
+                loop = loops[k]
+                if trochoidal[k]:
+                    # entering at the start of the closest circle
+                    closest_index = min([j for j in range(0, len(loop)) if loop[(j + 1) % len(loop)][0] == 'A'], key = lambda j: self.distance(self.get_point_from_curve(loop[j]), self.current_position))
+                else:
+                    loop, closest_index = self.enter_profile(loop, self.current_position)
+                entry = self.get_point_from_curve(loop[closest_index])
+                # the head can go from a ring to the next one without leaving the material only if the next one surrounds it : the tool removes what's in between anyway
+                if up or not self.point_in_polygon(self.current_position, polygons[k]):
+                    temp += self.travel(entry[0], entry[1], properties)
+                    temp += self.post_processor.rapid(entry[0], entry[1], previous_depth)
+                    if trochoidal[k]:
+                        temp += self.helical_entry(loop, closest_index, previous_depth, depth, properties)
+                    else:
+                        temp += self.feed(properties['plunge_feedrate'])
+                        temp += self.post_processor.line(entry[0], entry[1], depth)
+                    up = False
+                else:
+                    temp += self.feed(properties['cut_feedrate'])
+                    temp += self.post_processor.line(entry[0], entry[1], depth)
+                # a ring around an already machined one only takes the stepover, the others are slots (except with the trochoidal loops of the adaptive pockets)
+                engagement = properties['stepover'] if type == 'pocket_adaptive' or not slots[k] else 1
+                temp += self.profile_lap(loop, closest_index, depth, properties, side, engagement)
+                self.current_position = [float(entry[0]), float(entry[1])]
+            temp += self.post_processor.rapid(self.current_position[0], self.current_position[1], properties['clearance_pane'])
+            self.current_height = properties['clearance_pane']
+            self.writer.write(temp)
+            temp = ""
+            previous_depth = depth
+
+    def adaptive_loop(self, loop, distance, properties, slot):
+        '''
+        Returns a ring of an adaptive pocket, with loops keeping the radial engagement of the tool under 2 * drill_radius * stepover (the distance between two rings).
+        A slot (nothing machined inside the ring yet) is widened with trochoidal loops : full circles along the ring, as large as the wall allows (up to the drill radius),
+        close enough to each other for the front half of a circle to take one engagement on the width of the slot, the tool going from one to the next on their side. Other rings only overload the tool in their sharp corners :
+        these are cleared before the ring gets in them, with circles inscribed in the corner, smaller and smaller.
+            arguments:
+                - loop:list closed ring (cf self.offset_family)
+                - distance:float distance between the ring and the wall of the pocket
+                - properties:dict properties of the operation, as returned by self.define_properties
+                - slot:bool True if nothing is machined inside the ring before it
+        '''
+        step = 2 * properties['drill_radius'] * properties['stepover']
+        # the circles turn like the ring, so that the tool cuts on the same side
+        sense = 1 if self.profile_area(loop) > 0 else -1
+        points = [[float(e) for e in self.get_point_from_curve(curve)] for curve in loop]
+        result = [['M', points[0]]]
+        if slot:
+            radius = min(properties['drill_radius'], distance - properties['drill_radius'])
+            if radius < step / 4: # the slot is as wide as the tool
+                return loop
+            # the front half of a circle takes what's between the previous circle and this one, on the whole width of the slot
+            pitch = step * math.pi * radius / (2 * (properties['drill_radius'] + radius))
+            position = 0 # length of ring from the last circle
+            for k in range(1, len(loop)):
+                if self.same_point(points[k - 1], points[k]):
+                    continue
+                curve = [points[k - 1], points[k], self.circle_of_arc(points[k - 1], loop[k]) if loop[k][0] == 'A' else None]
+                length = abs(curve[2][2] * curve[2][4]) if curve[2] is not None else self.distance(points[k - 1], points[k])
+                while position <= length:
+                    t = position / length
+                    if curve[2] is None:
+                        tangent = [(points[k][0] - points[k - 1][0]) / length, (points[k][1] - points[k - 1][1]) / length]
+                    else:
+                        angle = curve[2][3] + t * curve[2][4]
+                        tangent = [-math.sin(angle) * math.copysign(1, curve[2][4]), math.cos(angle) * math.copysign(1, curve[2][4])]
+                    centre = self.point_of_curve(curve, t)
+                    start = [centre[0] + sense * radius * tangent[1], centre[1] - sense * radius * tangent[0]]
+                    if len(result) == 1:
+                        result = [['M', start]]
+                    else:
+                        result.append(['L', start])
+                    result += self.full_circle(centre, start, sense)
+                    position += pitch
+                position -= length
+            result.append(['L', list(result[0][1])])
+            return result
+
+        for k in range(1, len(loop)):
+            following = (k % (len(loop) - 1)) + 1
+            if loop[k][0] != 'L' or loop[following][0] != 'L' or self.same_point(points[k - 1], points[k]) or self.same_point(points[k], points[following]):
+                result.append(loop[k])
+                continue
+            u1 = self.curve_tangents(points[k - 1], loop[k])[0]
+            u2 = self.curve_tangents(points[k], loop[following])[0]
+            cross = u1[0] * u2[1] - u1[1] * u2[0]
+            # half the inner angle of the corner (only the corners turning to the inside of the ring are sharp)
+            half = (math.pi - math.atan2(abs(cross), u1[0] * u2[0] + u1[1] * u2[1])) / 2
+            if cross * sense <= 0 or math.sin(half) > 0.85:
+                result.append(loop[k])
+                continue
+            # the previous ring has its corner one step away from the sides : the inscribed circles get closer to the corner by half a step each time
+            reach = step * (1 / math.sin(half) - 1)
+            room = min(self.distance(points[k - 1], points[k]), self.distance(points[k], points[following])) / 2
+            while reach > 0.000001:
+                radius = reach / (1 / math.sin(half) - 1)
+                along = radius / math.tan(half)
+                if along <= room:
+                    start = [points[k][0] - u1[0] * along, points[k][1] - u1[1] * along]
+                    centre = [start[0] - sense * radius * u1[1], start[1] + sense * radius * u1[0]]
+                    result.append(['L', start])
+                    result += self.full_circle(centre, start, sense)
+                reach -= step / 2
+            result.append(loop[k])
+        return result
+
+    def helical_entry(self, loop, index, top, depth, properties):
+        '''
+        Returns the gcode taking the tool down from top to depth around the trochoidal circle beginning at the end of the curve index (cf self.adaptive_loop), at the plunge feedrate.
+        The tool goes down by drill_radius at most on each turn, and ends where it began, at depth.
+            arguments:
+                - loop:list ring of an adaptive pocket, widened with trochoidal circles
+                - index:int index of the curve ending at the start of the circle
+                - top:float height where the material begins
+                - depth:float depth of the lap
+                - properties:dict properties of the operation, as returned by self.define_properties
+        '''
+        start = [float(e) for e in self.get_point_from_curve(loop[index])]
+        circle = self.arc_to_circle(start[0], start[1], loop[(index + 1) % len(loop)][1])
+        opposite = [2 * circle['cx'] - start[0], 2 * circle['cy'] - start[1]]
+        helix = self.post_processor.helix_ccw if circle['clockwise'] else self.post_processor.helix_cw
+        turns = max(int(math.ceil((top - depth) / properties['drill_radius'] - 0.000001)), 1)
+        temp = self.feed(properties['plunge_feedrate'])
+        for k in range(0, 2 * turns):
+            point = opposite if k % 2 == 0 else start
+            previous = start if k % 2 == 0 else opposite
+            temp += helix(point[0], point[1], top + (depth - top) * (k + 1) / (2 * turns), circle['cx'] - previous[0], circle['cy'] - previous[1])
+        return temp
+
+    def full_circle(self, centre, start, sense):
+        '''
+        Returns the two half circle arcs going round a circle from the given point back to it.
+            arguments:
+                - centre:[float, float] centre of the circle
+                - start:[float, float] starting (and ending) point on the circle
+                - sense:int 1 to go round counter-clockwise, -1 clockwise
+        '''
+        radius = self.distance(centre, start)
+        opposite = [2 * centre[0] - start[0], 2 * centre[1] - start[1]]
+        flag = 1 if sense > 0 else 0
+        return [['A', [radius, radius, 0, 0, flag, opposite[0], opposite[1]]], ['A', [radius, radius, 0, 0, flag, start[0], start[1]]]]
+
+    def rest_pocket(self, profile, type, properties):
+        '''
+        Determines the gcode string for the rest machining of a pocket : only what a bigger tool (of radius rest_radius) left while clearing the pocket (cf self.pocket) is machined.
+        The big tool centre went everywhere inside the contour offset by rest_radius, the small one can go everywhere inside the contour offset by drill_radius :
+        the rings of the small tool are cut where they lie in the area the big tool cleared (the big tool area offset back by rest_radius - drill_radius),
+        and what's left of them (the corners, the narrow parts) is machined like engravings.
+        Without a rest_radius bigger than the drill_radius, the whole pocket is machined.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - operation_type:str description of the operation : 'pocket_rest'
+                - properties:dict contains the machining characteristics (cf self.add_operation)
+        '''
+        properties = self.define_properties(properties)
+        r = properties['drill_radius']
+        R = properties['rest_radius']
+        if R <= r:
+            self.pocket(profile, 'pocket_inside', properties)
+            return
+        # where the centre of the big tool went, as seen by the small tool
+        cleared = [loop for core in self.offset_curve(profile, R, 'inside') for loop in self.offset_curve(core, R - r, 'outside')]
+        polygons = [self.flatten_path(loop) for loop in cleared]
+        tree = RTree([entry for loop in cleared for entry in self.profile_curves(loop)])
+
+        rings = self.offset_family(profile, direction = 'inside', step = 2 * r * properties['stepover'], start = r)
+        for offsets in reversed(rings):
+            paths = []
+            for loop in offsets:
+                cuts = {}
+                for k in range(1, len(loop)):
+                    s = [float(e) for e in self.get_point_from_curve(loop[k - 1])]
+                    e = [float(e) for e in self.get_point_from_curve(loop[k])]
+                    if self.same_point(s, e):
+                        continue
+                    curve = [s, e, self.circle_of_arc(s, loop[k]) if loop[k][0] == 'A' else None]
+                    box = self.arc_box(s, e, curve[2]) if curve[2] is not None else [min(s[0], e[0]), min(s[1], e[1]), max(s[0], e[0]), max(s[1], e[1])]
+                    parameters = [0, 1]
+                    for other in tree.query(box):
+                        parameters += self.crossing_parameters(curve, other)
+                    parameters = sorted(parameters)
+                    # between two crossings, the curve is either all inside the cleared area or all outside
+                    intervals = []
+                    for low, high in zip(parameters[:-1], parameters[1:]):
+                        middle = self.point_of_curve(curve, (low + high) / 2)
+                        if high > low and any([self.point_in_polygon(middle, polygon) for polygon in polygons]):
+                            intervals.append([low, high])
+                    if len(intervals) > 0:
+                        cuts[k] = self.merge_intervals(intervals)
+                if len(cuts) == 0:
+                    paths.append(loop)
+                else:
+                    paths += self.split_loop(loop, cuts)
+            # the rings are machined from the centre, and inside a ring the closest path comes next
+            remaining = list(range(0, len(paths)))
+            while len(remaining) > 0:
+                k = self.closest_path(paths, remaining)
+                remaining.remove(k)
+                self.engrave(paths[k], type, properties)
+
+    def engrave(self, profile, type, properties):
+        '''
+        Determines the gcode string for an engraving cut.
+        An engraving is an open path : it is entered from its closest end, and machined back and forth when several passes are needed, so that the head never travels back to the beginning of the path.
+            arguments:
+                - profile:[] list of line / elliptic arc / bezier elements.
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
+                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, finishing_depth, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width, compensation, lead_length, spindle_speed, stepover, adaptive_feed
+        '''
+        properties = self.define_properties(properties)
+        if len(profile) == 0:
+            return
+
+        # entering the path from its closest end
+        forward = profile
+        backward = self.reverse_path(profile)
+        start = self.get_point_from_curve(profile[0])
+        end = self.get_point_from_curve(profile[-1])
+        if math.sqrt((float(self.current_position[0]) - float(end[0]))**2 + (float(self.current_position[1]) - float(end[1]))**2) < math.sqrt((float(self.current_position[0]) - float(start[0]))**2 + (float(self.current_position[1]) - float(start[1]))**2):
+            forward, backward = backward, forward
+
+        # bringing the machining head to the beginning of the path, down to the stock surface : only the material is cut at the plunge feedrate
+        start = self.get_point_from_curve(forward[0])
+        temp = self.travel(start[0], start[1], properties)
+        temp += self.post_processor.rapid(start[0], start[1], properties['stock_surface'])
+        self.writer.write(temp)
+
+        path = forward
+        for depth in self.depth_passes(properties):
+            # plunging to the right depth, from the stock surface or where the previous pass ended
+            position = self.get_point_from_curve(path[0])
+            temp = self.feed(properties['plunge_feedrate'])
+            temp += self.post_processor.line(position[0], position[1], depth)
+            # go through the path
+            for i in range(1, len(path)):
+                if path[i][0] in ['HTU', 'HTD']:
+                    # holding tabs of the open paths of a common line profile (cf self.common_line_profile)
+                    ht_depth = depth if path[i][0] == 'HTD' or depth > properties['target_depth'] + properties['holding_tabs_height'] else properties['target_depth'] + properties['holding_tabs_height']
+                    temp += self.feed(properties['cut_feedrate'])
+                    temp += self.post_processor.line(path[i][1][0], path[i][1][1], ht_depth)
+                else:
+                    following = self.following_curve(path, i, False) if properties['adaptive_feed'] else None
+                    temp += self.cutting_move(position, path[i], following, depth, properties)
+                position = self.get_point_from_curve(path[i])
+            self.writer.write(temp)
+            # the next pass goes the other way
+            path = backward if path is forward else forward
+
+        self.writer.write(self.post_processor.rapid(position[0], position[1], properties['clearance_pane']))
+        self.current_position = [float(position[0]), float(position[1])]
+        self.current_height = properties['clearance_pane']
+
+    def common_line_profile(self, chains, properties):
+        '''
+        Determines the gcode string for what's left of a profile sharing edges with contours machined before it (cf self.find_common_lines) : a few open paths, each machined like an engraving.
+        The holding tabs of the profile are shared between the paths, in proportion to their length (the shared edges keep the tabs of the other contour).
+            arguments:
+                - chains:list open tool paths (cf self.parse_path)
+                - properties:dict contains the machining characteristics (cf self.add_operation)
+        '''
+        properties = self.define_properties(properties)
+        lengths = [sum([abs(self.curve_length(chain[k], chain[k - 1])) for k in range(1, len(chain))]) for chain in chains]
+        total = sum(lengths)
+        remaining = list(range(0, len(chains)))
+        while len(remaining) > 0:
+            k = self.closest_path(chains, remaining)
+            remaining.remove(k)
+            chain = chains[k]
+            number = int(round(properties['holding_tabs_number'] * lengths[k] / total)) if total > 0 else 0
+            if number > 0:
+                chain = self.add_holding_tabs([[curve[0], list(curve[1])] for curve in chain], number, properties['holding_tabs_width'], properties['holding_tabs_height'])
+                self.record_holding_tabs(chain, properties)
+            self.engrave(chain, 'profile_outside', properties)
+
+    def closest_path(self, paths, indexes):
+        '''
+        Returns the index of the open path (machined from either end, cf self.engrave) the closest to the current position.
+            arguments:
+                - paths:list open paths (cf self.parse_path)
+                - indexes:[int] indexes of the paths to choose from
+        '''
+        position = [float(e) for e in self.current_position]
+        return min(indexes, key = lambda n: min(self.distance(position, [float(e) for e in self.get_point_from_curve(paths[n][0])]), self.distance(position, [float(e) for e in self.get_point_from_curve(paths[n][-1])])))
+
+    def reverse_path(self, profile):
+        '''
+        Returns the same path, travelled the other way : the first point becomes the last one, and arcs are swept the other way.
+        Holding tabs stay holding tabs : going back, the tool goes up where it used to go down (HTD becomes HTU) and the other way round.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+        '''
+        result = [['M', self.get_point_from_curve(profile[-1])]]
+        for i in range(len(profile) - 1, 0, -1):
+            point = self.get_point_from_curve(profile[i - 1])
+            if profile[i][0] == 'A':
+                arc = profile[i][1]
+                result.append(['A', [arc[0], arc[1], arc[2], arc[3], 0 if float(arc[4]) == 1 else 1, point[0], point[1]]])
+            elif profile[i][0] == 'HTU':
+                result.append(['HTD', [point[0], point[1]]])
+            elif profile[i][0] == 'HTD':
+                result.append(['HTU', [point[0], point[1]]])
+            else:
+                result.append(['L', [point[0], point[1]]])
+        return result
 
-    def determine_order(self, priority = []):
+    def arc_move(self, start, arc):
         '''
-        Determines the order to follow depending of the type of machining and writes it in self.order.
+        Returns the gcode line (G2 or G3) for an arc beginning at the given point.
             arguments:
-                - priority:[str] same as in self.calculate
+                - start:[float, float] coordinates of the starting point of the arc
+                - arc:list list of arguments defining the arc [rx, ry, phi, fA, fS, x2, y2]
         '''
-        position = self.current_position
-        for el in self.contours:
-            el[1] = self.parse_path(el[1])
-        # WARNING : does not take count of priority yet
-        while len(self.order) < len(self.contours):
-            # look for the closest contour not already queued, and append it index to the list
-            min_d = -1
-            index = 0
-            for i in range(0, len(self.contours)):
-                if i not in self.order:
-                    if min_d == -1:
-                        min_d = self.min_distance(self.contours[i][1], position)
-                        index = i
-                    elif min_d > self.min_distance(self.contours[i][1], position):
-                        min_d = self.min_distance(self.contours[i][1], position)
-                        index = i
-            self.order.append(index)
-            # change the current position
-            closest_index = self.closest_index(self.contours[index][1], position)
-            if self.contours[index][1][closest_index][0] in ['M', 'L']:
-                position = [self.contours[index][1][closest_index][1][0], self.contours[index][1][closest_index][1][1]]
-            elif self.contours[index][1][closest_index][0] in ['A']:
-                position = [self.contours[index][1][closest_index][1][5], self.contours[index][1][closest_index][1][6]]
+        circle = self.arc_to_circle(start[0], start[1], arc)
+        cx = circle['cx'] - float(start[0])
+        cy = circle['cy'] - float(start[1])
+        return (self.post_processor.arc_ccw if circle['clockwise'] else self.post_processor.arc_cw)(arc[5], arc[6], cx, cy)
 
-    def profile(self, profile, type, properties):
+    def feed(self, feedrate):
         '''
-        Determines the gcode string for a profile cut.
+        Returns the gcode line setting the feedrate, limited to self.max_feedrate. F is modal : nothing is written if the controller is already set to it,
+        nor for a feedrate of 0 (not given), the controller then keeps its own.
             arguments:
-                - profile:[] list of line / elliptic arc / bezier elements.
-                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
-                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width
+                - feedrate:float feedrate in mm/min
         '''
-        # profile = self.parse_path(svg_path)
-        properties = self.define_properties(properties)
-
-        # modifying the path to integrate holding tabs
-        profile = self.add_holding_tabs(profile, properties['holding_tabs_number'], properties['holding_tabs_width'], properties['holding_tabs_height'])
-
-        # searching for the closest point from current position
-        closest_index = self.closest_index(profile, self.current_position)
-
-        # bringing the machining head to the closest point
-        temp = """G0 X{} Y{} Z{}\n""".format(self.current_position[0], self.current_position[1], properties['clearance_pane'])
-        if profile[closest_index][0] in ['M', 'L']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['clearance_pane'])
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['depth_increment'] if properties['depth_increment'] > properties['target_depth'] else properties['target_depth'])
-        elif profile[closest_index][0] in ['A']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['clearance_pane'])
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['depth_increment'] if properties['depth_increment'] > properties['target_depth'] else properties['target_depth'])
-        else:
-            raise ValueError('UNEXPECTED CURVE TYPE IN THE SVG - COULD NOT GENERATE GCODE. Sorry bro :-( . Happened while generating a profile')
-        self.gcode += temp
-
-        increment = 1
-        for increment in range(1, int(properties['target_depth']/properties['depth_increment']) + 2):
-            depth = increment * properties['depth_increment'] if increment * properties['depth_increment'] > properties['target_depth'] else properties['target_depth']
-            # plunging to the right depth
-            if profile[closest_index][0] in ['M', 'L']:
-                temp = """G1 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], depth)
-            elif profile[closest_index][0] in ['A']:
-                temp = """G1 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], depth)
-            self.gcode += temp
-            # go through the profile
-            temp = ""
-            for index in range(0, len(profile)):
-                # true index to work with : we are going to
-                i = (index + closest_index + 1)%len(profile)
-                if profile[i][0] in ['M', 'L', 'HTD']:
-                    temp += """G1 X{} Y{} Z{}\n""".format(profile[i][1][0], profile[i][1][1], depth)
-                if profile[i][0] == 'A':
-                    if profile[i-1][0] == 'A':
-                        arc = self.arc_to_circle(profile[i-1][1][5], profile[i-1][1][6], profile[i][1])
-                        cx = arc['cx'] - float(profile[i-1][1][5])
-                        cy = arc['cy'] - float(profile[i-1][1][6])
-                    elif profile[i-1][0] in ['M', 'L', 'HTD']:
-                        arc = self.arc_to_circle(profile[i-1][1][0], profile[i-1][1][1], profile[i][1])
-                        cx = arc['cx'] - float(profile[i-1][1][0])
-                        cy = arc['cy'] - float(profile[i-1][1][1])
-                    temp += """G{} X{} Y{} I{} J{}\n""".format(3 if arc['clockwise'] else 2,profile[i][1][5], profile[i][1][6], cx, cy)
-                elif profile[i][0] == 'HTU':
-                    ht_depth = depth if depth > properties['target_depth'] + properties['holding_tabs_height'] else properties['target_depth'] + properties['holding_tabs_height']
-                    temp += """G1 X{} Y{} Z{}\n""".format(profile[i][1][0], profile[i][1][1], ht_depth)
-                    # temp = """G1 X{} Y{} Z{}\n""".format(profile[i][1][5], profile[i][1][6], depth)
-            self.gcode += temp
-            temp = ""
-        if profile[closest_index][0] in ['M', 'L']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['clearance_pane'])
-            self.current_position = [profile[closest_index][1][0], profile[closest_index][1][1]]
-        elif profile[closest_index][0] in ['A']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['clearance_pane'])
-            self.current_position = [float(profile[closest_index][1][5]), float(profile[closest_index][1][6])]
-        self.gcode += temp
-
-    def pocket(self, profile, type, properties):
+        if feedrate <= 0:
+            return ""
+        if self.max_feedrate is not None:
+            feedrate = min(feedrate, self.max_feedrate)
+        feedrate = round(feedrate, 1)
+        if feedrate == self.current_feedrate:
+            return ""
+        self.current_feedrate = feedrate
+        return self.post_processor.feed(feedrate)
+
+    def cutting_move(self, start, curve, following, depth, properties, side = 0, engagement = 1):
         '''
-        Determines the gcode string for a pocket cut.
+        Returns the gcode for a cutting move along a line or an arc at the given depth, preceded by its feedrate.
+        With the adaptive_feed property, the cut_feedrate (the feedrate of a straight slot) is adapted to the move :
+        - on an arc whose center is away from the wall, the edge of the tool goes faster than its center : the feedrate is multiplied by radius / (radius + drill_radius)
+        - the end of a line before a sharp corner (up to a drill diameter) is slowed down, the more so that the corner is sharp
+        - under half the diameter of radial engagement, the chips get thinner and the feedrate is increased to keep their thickness
+        The feedrate never goes under a fifth of the cut_feedrate, nor above self.max_feedrate.
             arguments:
-                - svg_path:[] list of line / elliptic arc / bezier elements.
-                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
-                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width
+                - start:[float, float] starting point of the move
+                - curve:list line or arc (cf self.parse_path)
+                - following:list curve machined after this one, None at the end of the path
+                - depth:float depth of the move
+                - properties:dict properties of the operation, as returned by self.define_properties
+                - side:int side of the material kept : 1 on the left of the path, -1 on the right, 0 on both (slot), None if the path is not the center of the tool
+                - engagement:float radial engagement of the tool, as a fraction of its diameter (1 for a slot)
         '''
-        # profile = self.parse_path(svg_path)
-        properties = self.define_properties(properties)
-
-        # searching for the closest point from current position
-        closest_index = self.closest_index(profile, self.current_position)
-
-        # bringing the machining head to the closest point
-        temp = """G0 X{} Y{} Z{}\n""".format(self.current_position[0], self.current_position[1], properties['clearance_pane'])
-        if profile[closest_index][0] in ['M', 'L']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['clearance_pane'])
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['depth_increment'] if properties['depth_increment'] > properties['target_depth'] else properties['target_depth'])
-        elif profile[closest_index][0] in ['A']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['clearance_pane'])
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['depth_increment'] if properties['depth_increment'] > properties['target_depth'] else properties['target_depth'])
+        end = self.get_point_from_curve(curve)
+        # a move of null length (like the 'M' closing a profile) leaves the head where it is : nothing is written, not even its feedrate (and an arc would be a whole circle)
+        if self.null_move(start, end):
+            return ""
+        if curve[0] == 'A':
+            move = self.arc_move(start, curve[1])
         else:
-            raise ValueError('UNEXPECTED CURVE TYPE IN THE SVG - COULD NOT GENERATE GCODE. Sorry bro :-( . Happened while generating a profile')
-        self.gcode += temp
-
-        increment = 1
-        for increment in range(1, int(properties['target_depth']/properties['depth_increment']) + 2):
-            depth = increment * properties['depth_increment'] if increment * properties['depth_increment'] > properties['target_depth'] else properties['target_depth']
-            # plunging to the right depth
-            if profile[closest_index][0] in ['M', 'L']:
-                temp = """G1 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], depth)
-            elif profile[closest_index][0] in ['A']:
-                temp = """G1 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], depth)
-            self.gcode += temp
-            # go through the profile
-            temp = ""
-            for index in range(0, len(profile)):
-                # true index to work with : we are going to
-                i = (index + closest_index + 1)%len(profile)
-                if profile[i][0] in ['M', 'L']:
-                    temp += """G1 X{} Y{} Z{}\n""".format(profile[i][1][0], profile[i][1][1], depth)
-                if profile[i][0] == 'A':
-                    if profile[i-1][0] == 'A':
-                        arc = self.arc_to_circle(profile[i-1][1][5], profile[i-1][1][6], profile[i][1])
-                        cx = arc['cx'] - float(profile[i-1][1][5])
-                        cy = arc['cy'] - float(profile[i-1][1][6])
-                    elif profile[i-1][0] in ['M', 'L']:
-                        arc = self.arc_to_circle(profile[i-1][1][0], profile[i-1][1][1], profile[i][1])
-                        cx = arc['cx'] - float(profile[i-1][1][0])
-                        cy = arc['cy'] - float(profile[i-1][1][1])
-                    temp += """G{} X{} Y{} I{} J{}\n""".format(3 if arc['clockwise'] else 2, profile[i][1][5], profile[i][1][6], cx, cy)
-            self.gcode += temp
-            temp = ""
-        if profile[closest_index][0] in ['M', 'L']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][0], profile[closest_index][1][1], properties['clearance_pane'])
-            self.current_position = [profile[closest_index][1][0], profile[closest_index][1][1]]
-        elif profile[closest_index][0] in ['A']:
-            temp += """G0 X{} Y{} Z{}\n""".format(profile[closest_index][1][5], profile[closest_index][1][6], properties['clearance_pane'])
-            self.current_position = [profile[closest_index][1][5], profile[closest_index][1][6]]
-        self.gcode += temp
+            move = self.post_processor.line(end[0], end[1], depth)
+        if not properties['adaptive_feed'] or properties['cut_feedrate'] <= 0:
+            return self.feed(properties['cut_feedrate']) + move
+
+        feedrate = properties['cut_feedrate']
+        minimum = properties['cut_feedrate'] / 5
+        if 0 < engagement < 0.5:
+            feedrate /= 2 * math.sqrt(engagement * (1 - engagement))
+        if curve[0] == 'A':
+            if side is not None and not self.same_point(start, end):
+                circle = self.circle_of_arc(start, curve)
+                # the center is on the left of the path when the arc turns counter-clockwise
+                if side != (1 if circle[4] > 0 else -1):
+                    feedrate *= circle[2] / (circle[2] + properties['drill_radius'])
+            return self.feed(max(feedrate, minimum)) + move
+
+        tangents = self.curve_tangents(start, curve)
+        next_tangents = None if following is None or tangents is None else self.curve_tangents(end, following)
+        if next_tangents is None:
+            return self.feed(max(feedrate, minimum)) + move
+        # 1 for a straight continuation, 0.5 for a right angle, 0 for a U-turn
+        corner = (1 + tangents[1][0] * next_tangents[0][0] + tangents[1][1] * next_tangents[0][1]) / 2
+        if corner > 0.9:
+            return self.feed(max(feedrate, minimum)) + move
+        slow = min(2 * properties['drill_radius'], self.distance([float(start[0]), float(start[1])], [float(end[0]), float(end[1])]) / 2)
+        split = [float(end[0]) - tangents[1][0] * slow, float(end[1]) - tangents[1][1] * slow]
+        temp = self.feed(max(feedrate, minimum))
+        temp += self.post_processor.line(split[0], split[1], depth)
+        temp += self.feed(max(feedrate * corner, minimum))
+        return temp + move
+
+    def curve_tangents(self, start, curve):
+        '''
+        Returns the unit tangents [[dx, dy] at the start, [dx, dy] at the end] of a line or an arc, in the direction of the path. None for a curve of null length.
+            arguments:
+                - start:[float, float] starting point of the curve
+                - curve:list line, holding tab or arc (cf self.parse_path)
+        '''
+        end = self.get_point_from_curve(curve)
+        if self.same_point(start, end):
+            return None
+        if curve[0] == 'A':
+            circle = self.circle_of_arc(start, curve)
+            turn = 1 if circle[4] > 0 else -1
+            a = circle[3]
+            b = circle[3] + circle[4]
+            return [[-math.sin(a) * turn, math.cos(a) * turn], [-math.sin(b) * turn, math.cos(b) * turn]]
+        length = self.distance([float(start[0]), float(start[1])], [float(end[0]), float(end[1])])
+        if length == 0:
+            return None
+        tangent = [(float(end[0]) - float(start[0])) / length, (float(end[1]) - float(start[1])) / length]
+        return [tangent, tangent]
+
+    def following_curve(self, profile, i, closed):
+        '''
+        Returns the first curve of non null length after the curve i (the 'M' closing a profile is skipped), None at the end of an open path.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - i:int index of the curve
+                - closed:bool True if the path is a closed profile, going on with its first curve
+        '''
+        for k in range(1, len(profile)):
+            if not closed and i + k >= len(profile):
+                return None
+            j = (i + k) % len(profile)
+            if not self.null_move(self.get_point_from_curve(profile[j - 1]), self.get_point_from_curve(profile[j])):
+                return profile[j]
+        return None
+
+    def null_move(self, start, end):
+        '''
+        Returns True if a move from start to end has a null length once written in the gcode (cf PostProcessor.precision) : the offsets leave closing curves of a few nanometers.
+            arguments:
+                - start:[float, float] starting point of the move
+                - end:[float, float] end point of the move
+        '''
+        if self.same_point(start, end):
+            return True
+        precision = self.post_processor.precision
+        return round(float(start[0]), precision) == round(float(end[0]), precision) and round(float(start[1]), precision) == round(float(end[1]), precision)
 
-    def engraving(self, profile, type, properties):
+    def wall_side(self, profile, type):
         '''
-        Determines the gcode string for an engraving cut.
+        Returns the side of the material kept along a closed profile : 1 on the left of the path, -1 on the right.
             arguments:
-                - profile:[] list of line / elliptic arc / bezier elements.
-                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside', 'engraving'
-                - properties:dict contains the machining characteristics : target_depth, cut_feedrate, plunge_feedrate, drill_type, drill_radius, depth_increment, stock_surface, clearance_pane, holding_tabs_height, holding_tabs_number, holding_tabs_width
+                - profile:list parsed svg path (cf self.parse_path)
+                - operation_type:str description of the operation : 'profile_inside', 'profile_outside', 'pocket_inside', 'pocket_outside'
         '''
-        self.current_position = [1, 1]
+        # the inside of a counter-clockwise profile is on its left. The part is inside the profile, except for the inside operations
+        left = (self.profile_area(profile) > 0) == (type in ['profile_outside', 'pocket_outside'])
+        return 1 if left else -1
 
     def parse_path(self, svg_path):
         '''
@@ -227,59 +2467,105 @@ class Machining:
         temp2 = ""
         for char in svg_path:
             if char in ['M', 'L', 'A']:
-                if temp1 is not '':
+                if temp1 != '':
                     data.append([temp1, temp2])
                 temp1 = char
                 temp2 = ""
             else:
                 temp2 += char
+        if temp1 != '':
+            data.append([temp1, temp2])
         for el in data:
-            el[1] = el[1][1:-2].split(' ')
-            for e in el[1]:
-                e = float(e)
+            el[1] = [float(e) for e in el[1].replace(',', ' ').split()]
         result = data
         return result
 
     def closest_index(self, profile, position):
         '''
-        Returns the index of the curve finishing to the closest point to the indicated position.
+        Returns the index of the curve holding the closest point to the indicated position (cf self.closest_point).
             arguments:
                 - profile:list parsed svg path (cf self.parse_path)
                 - position:[float, float] coordinates in 2D or a point
         '''
-        closest_index = 0
-        min_d = -1
-        for i in range(0, len(profile)):
-            if profile[i][0] in ['M', 'L']:
-                d = math.sqrt((float(position[0]) - float(profile[i][1][0]))**2 + (float(position[1]) - float(profile[i][1][1]))**2)
-            elif profile[i][0] == 'A':
-                d = math.sqrt((float(position[0]) - float(profile[i][1][5]))**2 + (float(position[1]) - float(profile[i][1][6]))**2)
-            if min_d == -1:
-                min_d = d
-                closest_index = i
-            elif d < min_d:
-                min_d = d
-                closest_index = i
-        return closest_index
+        return self.closest_point(profile, position)[0]
 
     def min_distance(self, profile, position):
         '''
-        Returns the minimal distance between the given position and the given contour.
+        Returns the minimal distance between the given position and the given contour, -1 for an empty contour.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - position:[float, float] coordinates in 2D or a point
+        '''
+        if len(profile) == 0:
+            return -1
+        return self.closest_point(profile, position)[2]
+
+    def closest_point(self, profile, position):
+        '''
+        Returns [index, point, distance] for the closest point of a profile to the given position. The position is projected on every line and arc, so the point
+        can be anywhere along a curve, not only at its end. index is the curve holding the point. Holding tabs are only entered at their ends.
             arguments:
                 - profile:list parsed svg path (cf self.parse_path)
                 - position:[float, float] coordinates in 2D or a point
         '''
-        min_d = -1
+        position = [float(position[0]), float(position[1])]
+        best = None
+        previous = None
         for i in range(0, len(profile)):
-            if profile[i][0] in ['M', 'L']:
-                d = math.sqrt((float(position[0]) - float(profile[i][1][0]))**2 + (float(position[1]) - float(profile[i][1][1]))**2)
-            elif profile[i][0] == 'A':
-                d = math.sqrt((float(position[0]) - float(profile[i][1][5]))**2 + (float(position[1]) - float(profile[i][1][6]))**2)
-            if min_d == -1:
-                min_d = d
-            elif d < min_d:
-                min_d = d
-        return min_d
+            end = [float(e) for e in self.get_point_from_curve(profile[i])]
+            if profile[i][0] in ['M', 'L', 'A']:
+                point = end
+                if previous is not None and profile[i][0] != 'M' and not self.same_point(previous, end):
+                    point = self.curve_projection(position, [previous, end, self.circle_of_arc(previous, profile[i]) if profile[i][0] == 'A' else None])[1]
+                d = self.distance(position, point)
+                if best is None or d < best[2]:
+                    best = [i, point, d]
+            previous = end
+        return best
+
+    def profile_curves(self, profile):
+        '''
+        Returns the lines and arcs of a profile as [box, [start, end, circle]] (circle = None for a line, cf self.circle_of_arc), the way an RTree takes them.
+        Curves of null length are left out.
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+        '''
+        result = []
+        for k in range(1, len(profile)):
+            if profile[k][0] not in ['L', 'A']:
+                continue
+            s = [float(e) for e in self.get_point_from_curve(profile[k - 1])]
+            e = [float(e) for e in self.get_point_from_curve(profile[k])]
+            if self.same_point(s, e):
+                continue
+            if profile[k][0] == 'A':
+                circle = self.circle_of_arc(s, profile[k])
+                result.append([self.arc_box(s, e, circle), [s, e, circle]])
+            else:
+                result.append([[min(s[0], e[0]), min(s[1], e[1]), max(s[0], e[0]), max(s[1], e[1])], [s, e, None]])
+        return result
+
+    def enter_profile(self, profile, position):
+        '''
+        Returns [profile, index] : the closed profile cut at its closest point to the given position (cf self.closest_point), and the index of the curve now ending there.
+        The machining of the profile begins and ends at this point (cf self.profile_lap).
+            arguments:
+                - profile:list parsed svg path (cf self.parse_path)
+                - position:[float, float] coordinates in 2D or a point
+        '''
+        index, point, d = self.closest_point(profile, position)
+        if index == 0:
+            return [profile, index]
+        start = self.get_point_from_curve(profile[index - 1])
+        end = self.get_point_from_curve(profile[index])
+        if self.same_point(point, start) and profile[index - 1][0] in ['M', 'L', 'A']:
+            return [profile, index - 1]
+        # the end of a holding tab is not an entry point : the curve after it is entered at its end
+        if self.same_point(point, end) or self.same_point(point, start):
+            return [profile, index]
+        start = [float(e) for e in start]
+        end = [float(e) for e in end]
+        return [profile[:index] + [self.cut_curve(profile[index], start, start, point), self.cut_curve(profile[index], start, point, end)] + profile[index + 1:], index]
 
     def define_properties(self, properties):
         '''
@@ -298,7 +2584,20 @@ class Machining:
         'clearance_pane' : 20 if 'clearance_pane' not in properties.keys() else properties['clearance_pane'],
         'holding_tabs_width' : 10 if 'holding_tabs_width' not in properties.keys() else properties['holding_tabs_width'],
         'holding_tabs_height' : 10 if 'holding_tabs_height' not in properties.keys() else properties['holding_tabs_height'],
-        'holding_tabs_number' : 3 if 'holding_tabs_number' not in properties.keys() else properties['holding_tabs_number']
+        'holding_tabs_number' : 3 if 'holding_tabs_number' not in properties.keys() else properties['holding_tabs_number'],
+        # 'none' : the tool follows the contour, 'host' : the contour is offset by the drill radius (cf self.offset_curve), 'controller' : G41 / G42 cutter radius compensation
+        'compensation' : 'none' if 'compensation' not in properties.keys() else properties['compensation'],
+        # thickness left by the roughing laps and removed by a last thin lap at the target depth. 0 means no finishing lap
+        'finishing_depth' : 0 if 'finishing_depth' not in properties.keys() else abs(properties['finishing_depth']),
+        # length of the lead-in / lead-out lines used with the controller compensation. 0 means twice the drill radius
+        'lead_length' : 0 if 'lead_length' not in properties.keys() else properties['lead_length'],
+        'spindle_speed' : 12000 if 'spindle_speed' not in properties.keys() else properties['spindle_speed'],
+        # distance between two pocket rings, as a fraction of the drill diameter
+        'stepover' : 0.5 if 'stepover' not in properties.keys() else properties['stepover'],
+        # radius of the bigger tool which cleared the pocket before a 'pocket_rest' (cf self.rest_pocket)
+        'rest_radius' : 0 if 'rest_radius' not in properties.keys() else properties['rest_radius'],
+        # True to adapt the cut feedrate to the curvature of the path, its corners and the engagement of the tool (cf self.cutting_move)
+        'adaptive_feed' : False if 'adaptive_feed' not in properties.keys() else properties['adaptive_feed']
         }
 
         # target depth should always be negative
@@ -307,6 +2606,9 @@ class Machining:
         # depth increment should always be negative
         if result['depth_increment'] > 0:
             result['depth_increment'] = -1 * result['depth_increment']
+        # without a plunge feedrate, the tool plunges at the cut feedrate
+        if result['plunge_feedrate'] <= 0:
+            result['plunge_feedrate'] = result['cut_feedrate']
         return result
 
     def arc_to_circle(self, x1, y1, profile):
@@ -401,7 +2703,7 @@ class Machining:
         '''
         dot = ux * vx + uy * vy
         mod = math.sqrt(( ux**2 + uy**2) * (vx**2 + vy**2))
-        rad = math.acos( dot / mod)
+        rad = math.acos(max(-1, min(1, dot / mod))) # float precision can put the cosine slightly out of [-1, 1]
         if ux * vy - uy * vx < 0.0:
             rad = -rad
         return rad
@@ -504,6 +2806,31 @@ class Machining:
 
         return profile
 
+    def record_holding_tabs(self, profile, properties):
+        '''
+        Stores the holding tabs of a profile in self.holding_tabs as [operation, x, y, top, plateau] : the middle of the tab (its HTU element), the height of its top,
+        and the ends of the part of the tab left at this height, shrunk by the drill radius (None when there is none, cf Simulator.find_gouges).
+            arguments:
+                - profile:list parsed svg path, holding tabs included (cf self.add_holding_tabs)
+                - properties:dict properties of the operation, as returned by self.define_properties
+        '''
+        # the path goes up to the middle of the tab and down again : the tab is flat only where the path goes over the stock surface
+        summit = properties['target_depth'] + properties['holding_tabs_height']
+        top = min(properties['stock_surface'], summit)
+        for k in range(1, len(profile) - 1):
+            if profile[k][0] != 'HTU':
+                continue
+            start = [float(e) for e in self.get_point_from_curve(profile[k - 1])]
+            middle = [float(e) for e in profile[k][1]]
+            end = [float(e) for e in self.get_point_from_curve(profile[k + 1])]
+            plateau = None
+            if properties['holding_tabs_height'] > 0 and not self.same_point(start, middle) and not self.same_point(middle, end):
+                # half length of the plateau, shrunk by the drill radius : the tool on the ramps cuts up to there
+                half = self.distance(start, middle) * (summit - top) / properties['holding_tabs_height'] - properties['drill_radius']
+                if half > 0:
+                    plateau = [[middle[0] + (point[0] - middle[0]) * half / self.distance(point, middle), middle[1] + (point[1] - middle[1]) * half / self.distance(point, middle)] for point in [start, end]]
+            self.holding_tabs.append([self.current_operation, middle[0], middle[1], top, plateau])
+
     def curve_length(self, curve, previousCurve):
         length = 0
 
@@ -535,29 +2862,86 @@ class Machining:
                 - distance:float distance from the profile to the result
                 - direction:str can be 'inside' or 'outside'
         """
-        r = distance
+        # a single offset is a family of one : both give the same result
+        return self.offset_family(input_profile, [distance], direction)[0]
+
+    def offset_family(self, input_profile, distances = None, direction = 'inside', step = None, start = None):
+        """
+        Returns the offsets of a profile for several distances at once, as a list with one offset_curve result per distance.
+        The profile is analysed once (clean-up, direction, bisectors of every node, the curves themselves) and each distance only rebuilds the points from it.
+        When too many curves collapse to offset the profile in one go, the next offsets are computed from the last good one instead (offsetting by a then by b is offsetting by a + b).
+        Without distances, the profile is offset every step (from start, default : step) until the offset vanishes, which is what pockets need.
+            Arguments:
+                - input_profile:list svg path (defined as [['type', [coordinates]]])
+                - distances:list distances from the profile to the results
+                - direction:str can be 'inside' or 'outside'
+                - step:float distance between two offsets when no distances are given
+                - start:float distance of the first offset when no distances are given
+        """
+        analysis = self.offset_analysis(input_profile, direction)
+        if distances is None:
+            if step is None or step <= 0:
+                raise ValueError('offset_family needs either a list of distances or a positive step')
+            if direction != 'inside':
+                raise ValueError('an outside offset never vanishes : give a list of distances')
+            # an inside offset can't go further than half the bounding box : this bounds the loop even if the offsets don't vanish cleanly
+            box = self.bounding_box([corner for support in analysis['supports'] for corner in [support[3][:2], support[3][2:]]])
+            limit = min(box[2] - box[0], box[3] - box[1]) / 2
+            distance = step if start is None else start
+            distances = []
+            while distance <= limit:
+                distances.append(distance)
+                distance += step
+            vanish = True
+        else:
+            vanish = False
+        results = {}
+        # the offsets are offsets of a base : the profile itself, then the last good offset
+        bases = [[analysis, 0]]
+        previous = None
+        for distance in sorted(set(distances)):
+            offsets = []
+            rejected = 0
+            for base in bases:
+                loops, count = self.offset_loops(base[0], distance - base[1])
+                offsets += loops
+                rejected += count
+            if rejected > 0 and previous is not None:
+                bases = [[self.offset_analysis(profile, direction), previous] for profile in results[previous]]
+                offsets = []
+                for base in bases:
+                    offsets += self.offset_from_analysis(base[0], distance - previous)
+            elif rejected > 0:
+                # nothing good to start from : the offset is reached in a few steps, each one from the last (as if more distances had been asked)
+                offsets = self.offset_from_analysis(analysis, distance / 8)
+                for k in range(1, 8):
+                    offsets = [loop for profile in offsets for loop in self.offset_from_analysis(self.offset_analysis(profile, direction), distance / 8)]
+            if vanish and len(offsets) == 0:
+                break
+            results[distance] = offsets
+            previous = distance
+        return [results[distance] for distance in distances if distance in results]
+
+    def offset_analysis(self, input_profile, direction):
+        """
+        Does the distance independent part of an offset : removes the zero length elements, finds the direction of the profile and, for each node, the unit vectors the offset points move along.
+        Returns a dict {'cw', 'direction', 'nodes'} used by offset_from_analysis.
+            Arguments:
+                - input_profile:list svg path (defined as [['type', [coordinates]]])
+                - direction:str can be 'inside' or 'outside'
+        """
         # the first element of the path should be 'M' (which means Move: used to set the beginning of the path.)
         # this point is also the end of the last path element, if the path is closed. As we always consider paths to be closed, we delete this element.
-        profile = input_profile[1:] if input_profile[0][0] == 'M' else input_profile
+        profile = input_profile[1:] if input_profile[0][0] == 'M' else list(input_profile)
 
-        # determine the direction of the path (clockwise or counter-clockwise)
-        cw = 0
-        calc_cw = 0
-        for i in range(1, len(profile)): # first element is M, not to be considered...
-            j = (i - 1) % len(profile)
-            sx = profile[j][1][0] if profile[j][0] in ['M', 'L'] else profile[j][1][5]
-            sy = profile[j][1][1] if profile[j][0] in ['M', 'L'] else profile[j][1][6]
-            ex = profile[i][1][0] if profile[i][0] in ['M', 'L'] else profile[i][1][5]
-            ey = profile[i][1][1] if profile[i][0] in ['M', 'L'] else profile[i][1][6]
-            calc_cw += (ex - sx) * (ey + sy)
-        cw = True if calc_cw > 0 else False
+        # determine the direction of the path (clockwise or counter-clockwise), from its area with the arcs : the chords of a circle or a half disc have no direction
+        cw = self.profile_area([['M', self.get_point_from_curve(profile[-1])]] + profile) < 0
         od = 1 # od means offset direction
         if cw:
             od = -od
         if direction == "inside":
             od = -od
-        raw_offset = []
-        # for i in range(0, len(profile)):
+        nodes = []
         i = 0
         while i < len(profile):
             # for each node, determine the angle between both incoming and outing tangent
@@ -568,11 +2952,11 @@ class Machining:
             # for the next points, it's a bit different : if the curve is a line, we just have to use its ending point.
             # However, if the curve is an arc, we have to use the tangent of the curve...
             # (for pc : the qestion is if the current curve is an arc or a line) (this paragraph is a pure mindf**k)
-            if self.get_point_from_curve(c) == self.get_point_from_curve(nc): # the next line / arc is of length 0 -> drop it like it's hot (or it's gonna inject a huge pile of shit in the system)
+            if self.same_point(self.get_point_from_curve(c), self.get_point_from_curve(nc)): # the next line / arc is of length 0 -> drop it like it's hot (or it's gonna inject a huge pile of shit in the system)
                 del profile[(i + 1) % len(profile)]
                 nc = profile[(i + 1)%len(profile)] # next curve
 
-            if self.get_point_from_curve(c) == self.get_point_from_curve(pc): # the line / arc is of length 0
+            if self.same_point(self.get_point_from_curve(c), self.get_point_from_curve(pc)): # the line / arc is of length 0
                 del profile[i]
                 if i < len(profile):
                     # we directly go to the next element
@@ -596,137 +2980,616 @@ class Machining:
             v = [np[0] - p[0], np[1] - p[1]]
             u_len = math.sqrt(u[0]**2 + u[1]**2)
             v_len = math.sqrt(v[0]**2 + v[1]**2)
-            if (u[0] * v[0] + u[1] * v[1]) / (u_len * v_len) > 1: # avoid the case when float precision puts this value above 1 (not in the definition domain of acos)
-                angle = 0
-            if (u[0] * v[0] + u[1] * v[1]) / (u_len * v_len) < -1: # same, but for the case when float precision puts this value below -1
-                angle = math.pi
-            else:
-                angle = math.acos((u[0] * v[0] + u[1] * v[1]) / (u_len * v_len))
+            # float precision can put this value out of the definition domain of acos
+            angle = math.acos(max(-1, min(1, (u[0] * v[0] + u[1] * v[1]) / (u_len * v_len))))
             # now we have the angle between the two vectors. To know if the oriented angle is this one or 2*PI - angle, we have to check for this sub_profile's direction.
             # easy my friend : we calculate its clockwise value and check if it's equal to cw.
-            # sub_cw = (p[0] - cpp[0]) * (p[1] + cpp[1]) + (cnp[0] - p[0]) * (cnp[1] + p[1]) + (cpp[0] - cnp[0]) * (cpp[1] + cnp[1])
             sub_cw = (p[0] - pp[0]) * (p[1] + pp[1]) + (np[0] - p[0]) * (np[1] + p[1]) + (pp[0] - np[0]) * (pp[1] + np[1])
             if (sub_cw > 0) == cw and direction == 'outside':
                 angle = 2 * math.pi - angle
             if (sub_cw > 0) != cw and direction == 'inside':
                 angle = 2 * math.pi - angle
-            # add a new point and the corresponding curve.
             # anyway, we need the angle between the previous line and the X axis. We'll call it beta
             p_len = math.sqrt((p[0] - pp[0])**2 + (p[1] - pp[1])**2)
             beta = self.guess_angle((p[1] - pp[1]) / p_len, (p[0] - pp[0]) / p_len)
-            if angle > math.pi:
+            p_len2 = math.sqrt((np[0] - p[0])**2 + (np[1] - p[1])**2)
+            beta2 = self.guess_angle((np[1] - p[1]) / p_len2, (np[0] - p[0]) / p_len2)
+            node = {'curve': c, 'p': p, 'convex': angle > math.pi or math.sin(angle / 2) == 0}
+            if c[0] == 'A':
+                node['radius_dir'] = self.radius_dir(c[1][4], direction, cw)
+            if node['convex']:
                 # endpoint is the original offset of the point.
-                ax = p[0] + math.cos(beta - od * math.pi / 2) * r
-                ay = p[1] + math.sin(beta - od * math.pi / 2) * r
-                if c[0] == 'A':
-                    radius_dir = self.radius_dir(c[1][4], direction, cw)
-                    raw_offset.append(['A', [abs(c[1][0] + radius_dir * r), abs(c[1][1] + radius_dir * r), c[1][2], c[1][3], c[1][4], ax, ay]])
-                else:
-                    raw_offset.append([c[0], [ax, ay]])
-                # Then insert a new point orthogonally offset from the same point to the second tangent
-                p_len2 = math.sqrt((np[0] - p[0])**2 + (np[1] - p[1])**2)
-                beta2 = self.guess_angle((np[1] - p[1]) / p_len2, (np[0] - p[0]) / p_len2)
-                bx = p[0] + math.cos(beta2 - od * math.pi / 2) * r
-                by = p[1] + math.sin(beta2 - od * math.pi / 2) * r
-                arc_dir = 1
+                node['a'] = [math.cos(beta - od * math.pi / 2), math.sin(beta - od * math.pi / 2)]
+                # Then a new point orthogonally offset from the same point to the second tangent, joined by an arc
+                node['b'] = [math.cos(beta2 - od * math.pi / 2), math.sin(beta2 - od * math.pi / 2)]
+                node['arc_dir'] = 1
                 if cw and direction == 'outside':
-                    arc_dir = 0
+                    node['arc_dir'] = 0
                 if cw == False and direction == 'inside':
-                    arc_dir = 0
-                raw_offset.append(['A', [r, r, 0, 0, arc_dir, bx, by]])
+                    node['arc_dir'] = 0
             else:
                 # endpoint is the offset of p on the bisectrix of the two vectors
-                ax = p[0] - math.cos(beta + od * angle / 2) * r / math.sin(angle / 2)
-                ay = p[1] - math.sin(beta + od * angle / 2) * r / math.sin(angle / 2)
-                if c[0] == 'A':
-                    radius_dir = self.radius_dir(c[1][4], direction, cw)
-                    raw_offset.append(['A', [abs(c[1][0] + radius_dir * r), abs(c[1][1] + radius_dir * r), c[1][2], c[1][3], c[1][4], ax, ay]])
-                else:
-                    raw_offset.append([c[0], [ax, ay]])
+                node['a'] = [-math.cos(beta + od * angle / 2) / math.sin(angle / 2), -math.sin(beta + od * angle / 2) / math.sin(angle / 2)]
+                # the bisectrix is only right between two lines : next to an arc, the point is where both offset curves meet (cf self.offset_corner)
+                if c[0] == 'A' or nc[0] == 'A':
+                    node['in'] = self.offset_support(c, self.get_point_from_curve(pc), direction, cw, [math.cos(beta - od * math.pi / 2), math.sin(beta - od * math.pi / 2)])
+                    node['out'] = self.offset_support(nc, p, direction, cw, [math.cos(beta2 - od * math.pi / 2), math.sin(beta2 - od * math.pi / 2)])
+            nodes.append(node)
             i += 1
+        # the curves themselves, to check the distance of the offsets to the profile (cf self.offset_is_valid)
+        supports = []
+        for k in range(0, len(nodes)):
+            s = nodes[k - 1]['p']
+            e = nodes[k]['p']
+            if nodes[k]['curve'][0] == 'A':
+                circle = self.circle_of_arc(s, nodes[k]['curve'])
+                supports.append([s, e, circle, [circle[0] - circle[2], circle[1] - circle[2], circle[0] + circle[2], circle[1] + circle[2]]])
+            else:
+                supports.append([s, e, None, [min(s[0], e[0]), min(s[1], e[1]), max(s[0], e[0]), max(s[1], e[1])]])
+        return {'cw': cw, 'direction': direction, 'nodes': nodes, 'supports': supports}
+
+    def offset_from_analysis(self, analysis, distance, depth = 0):
+        """
+        Returns the list of svg paths offseted by distance from the profile described by analysis (see offset_analysis).
+            Arguments:
+                - analysis:dict result of offset_analysis
+                - distance:float distance from the profile to the result
+                - depth:int number of times the distance has already been halved (cf below)
+        """
+        loops, rejected = self.offset_loops(analysis, distance)
+        if rejected == 0 or depth >= 4:
+            return loops
+        # too many curves collapsed at once to be solved in one go : the offset is done in two halves (offsetting by a then by b is offsetting by a + b)
+        result = []
+        for profile in self.offset_from_analysis(analysis, distance / 2, depth + 1):
+            result += self.offset_from_analysis(self.offset_analysis(profile, analysis['direction']), distance / 2, depth + 1)
+        return result
+
+    def offset_loops(self, analysis, distance):
+        """
+        Returns [offset profiles, number of rejected loops] for the profile described by analysis (see offset_analysis).
+        A loop is rejected when it gets too close to the profile : some collapsed curves couldn't be removed.
+            Arguments:
+                - analysis:dict result of offset_analysis
+                - distance:float distance from the profile to the result
+        """
+        r = distance
+        # each offset curve is kept with what it lies on (line or circle) until the collapsed ones are removed
+        # pieces : ['L', end, [point, direction]] or ['A', end, [center, radius], sweep flag, maximum sweep, phi]
+        pieces = []
+        nodes = analysis['nodes']
+        for k in range(0, len(nodes)):
+            node = nodes[k]
+            c = node['curve']
+            p = node['p']
+            support = analysis['supports'][k]
+            ax = p[0] + node['a'][0] * r
+            ay = p[1] + node['a'][1] * r
+            if 'in' in node:
+                ax, ay = self.offset_corner(node, r, [ax, ay])
+            if c[0] == 'A' and support[2][2] + node['radius_dir'] * r > 0:
+                pieces.append(['A', [ax, ay], [support[2][:2], support[2][2] + node['radius_dir'] * r], c[1][4], abs(support[2][4]), c[1][2]])
+            else:
+                # a collapsed arc goes backwards, like a line going against the chord : it's removed with the other collapsed curves
+                length = self.distance(support[0], support[1])
+                pieces.append(['L', [ax, ay], [[ax, ay], [(support[1][0] - support[0][0]) / length, (support[1][1] - support[0][1]) / length]]])
+            if node['convex']:
+                pieces.append(['A', [p[0] + node['b'][0] * r, p[1] + node['b'][1] * r], [p, r], node['arc_dir'], math.pi, 0])
+        count = len(pieces)
+        pieces = self.collapse_pieces(pieces)
+        collapsed = len(pieces) < count
+        # two curves only make a loop if one of them is an arc (a half disc)
+        if len(pieces) < 2 or len(pieces) == 2 and pieces[0][0] == 'L' and pieces[1][0] == 'L':
+            return [[], 0]
+        raw_offset = []
+        for k in range(0, len(pieces)):
+            piece = pieces[k]
+            if piece[0] == 'L':
+                raw_offset.append(['L', piece[1]])
+            else:
+                sweep = self.piece_sweep(piece, pieces[k - 1][1])
+                raw_offset.append(['A', [piece[2][1], piece[2][1], piece[5], 1 if sweep > math.pi else 0, piece[3], piece[1][0], piece[1][1]]])
         # we defined a closed loop. to use it as an SVG, we have to add a 'M' element at the beginning, that will point to the last point
         raw_offset.insert(0, ['M', self.get_point_from_curve(raw_offset[-1])])
         # now, we break the profile in several sub_profile, breaking points are each auto-intersection point
-        raw_offset = self.break_profile(raw_offset, cw)
+        raw_offset = self.break_profile(raw_offset, analysis['cw'])
         # we go through the list of sub_profiles and we remove the ones that don't have the same clockwise direction
-        raw_offset = self.remove_inverted_profiles(raw_offset, cw)
+        raw_offset = self.remove_inverted_profiles(raw_offset, analysis['cw'])
+        # some loops have the right direction but come from collapsed curves (swallowtails) : they get too close to the profile
+        # (a single loop, without any collapsed curve, can't be one of them, unless it's made of two curves : they can't collapse, cf self.collapse_pieces)
+        valid = raw_offset
+        if collapsed or len(raw_offset) > 1 or len(pieces) == 2:
+            valid = [profile for profile in raw_offset if self.offset_is_valid(profile, analysis, r)]
+        rejected = len(raw_offset) - len(valid)
+        raw_offset = valid
         # we clean the profiles (technically, we round every float to avoid scientific notation...)
         raw_offset = [self.clean(profile) for profile in raw_offset]
-        return raw_offset
+        # the splits can leave elements of length 0 (an arc from a point to itself can't even be machined) : they go away
+        result = []
+        for profile in raw_offset:
+            temp = [profile[0]]
+            for curve in profile[1:]:
+                if curve[0] == 'A' and float(curve[1][0]) == 0: # an arc whose radius was rounded to 0 is just a (very short) line
+                    curve = ['L', curve[1][5:7]]
+                if not self.same_point(self.get_point_from_curve(temp[-1]), self.get_point_from_curve(curve)):
+                    temp.append(curve)
+            if len(temp) > 2:
+                result.append(temp)
+        return [result, rejected]
+
+    def collapse_pieces(self, pieces):
+        '''
+        Removes the offset curves going backwards (a line shorter than the offset distance, a corner arc once its neighbours cross...) and joins their neighbours where they meet.
+        Without this, each collapsed curve leaves a small loop that doesn't cross anything, so self.break_profile can't remove it.
+            arguments:
+                - pieces:list offset curves, as built by self.offset_from_analysis
+        '''
+        k = 0
+        while len(pieces) > 2 and k < len(pieces):
+            piece = pieces[k]
+            start = pieces[k - 1][1]
+            if piece[0] == 'L':
+                inverted = (piece[1][0] - start[0]) * piece[2][1][0] + (piece[1][1] - start[1]) * piece[2][1][1] < 0
+            else:
+                inverted = self.piece_sweep(piece, start) > piece[4] + 0.000001
+            if not inverted:
+                k += 1
+                continue
+            previous = pieces[k - 1]
+            following = pieces[(k + 1) % len(pieces)]
+            joint = self.pieces_joint(previous, following, [(start[0] + piece[1][0]) / 2, (start[1] + piece[1][1]) / 2])
+            if joint is None:
+                k += 1
+                continue
+            previous[1] = joint
+            if previous[0] == 'L':
+                previous[2] = [joint, previous[2][1]]
+            del pieces[k]
+            # the neighbours changed : they are checked again
+            k = max(k - 2, 0)
+        return pieces
+
+    def piece_sweep(self, piece, start):
+        '''
+        Returns the angle covered by an arc piece (cf self.offset_from_analysis) from start to its end, in its direction.
+            arguments:
+                - piece:list arc piece
+                - start:[float, float] starting point of the arc
+        '''
+        center = piece[2][0]
+        a1 = math.atan2(start[1] - center[1], start[0] - center[0])
+        a2 = math.atan2(piece[1][1] - center[1], piece[1][0] - center[0])
+        return (a2 - a1) % (2 * math.pi) if float(piece[3]) == 1 else (a1 - a2) % (2 * math.pi)
+
+    def pieces_joint(self, first, second, guess):
+        '''
+        Returns the point where the line / circle of both pieces meet, the closest to guess, or None.
+            arguments:
+                - first:list piece (cf self.offset_from_analysis)
+                - second:list piece
+                - guess:[float, float] approximate position of the point
+        '''
+        if first[0] == 'L' and second[0] == 'L':
+            p1, d1 = first[2]
+            p2, d2 = second[2]
+            cross = d1[0] * d2[1] - d1[1] * d2[0]
+            if abs(cross) < 0.000000001:
+                return None
+            t = ((p2[0] - p1[0]) * d2[1] - (p2[1] - p1[1]) * d2[0]) / cross
+            return [p1[0] + t * d1[0], p1[1] + t * d1[1]]
+        if first[0] == 'L' or second[0] == 'L':
+            line, arc = (first, second) if first[0] == 'L' else (second, first)
+            candidates = self.line_circle_points(line[2][0], [line[2][0][0] + line[2][1][0], line[2][0][1] + line[2][1][1]], [arc[2][0][0], arc[2][0][1], arc[2][1]])
+        else:
+            candidates = self.circle_circle_points([first[2][0][0], first[2][0][1], first[2][1]], [second[2][0][0], second[2][0][1], second[2][1]])
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key = lambda point: self.distance(point, guess))
+
+    def offset_support(self, curve, start, direction, cw, normal):
+        '''
+        Returns what offset_corner needs to offset a curve : ['line', start, end, normal] or ['circle', [cx, cy], radius, radius_dir].
+            arguments:
+                - curve:list line or arc defined like this : ['type', [properties]]
+                - start:[float, float] starting point of the curve
+                - direction:str can be 'inside' or 'outside'
+                - cw:bool direction of the whole profile
+                - normal:[float, float] unit vector the line moves along (ignored for arcs)
+        '''
+        if curve[0] == 'A':
+            circle = self.circle_of_arc(start, curve)
+            return ['circle', circle[:2], circle[2], self.radius_dir(curve[1][4], direction, cw)]
+        return ['line', start, self.get_point_from_curve(curve), normal]
+
+    def offset_corner(self, node, r, guess):
+        '''
+        Returns the point where the offsets of both curves around a concave node meet, the closest to guess (the bisectrix point, returned if they don't meet).
+            arguments:
+                - node:dict node of offset_analysis, with its 'in' and 'out' supports (cf self.offset_support)
+                - r:float offset distance
+                - guess:[float, float] approximate position of the point
+        '''
+        shapes = []
+        for support in [node['in'], node['out']]:
+            if support[0] == 'line':
+                shapes.append([[support[1][0] + support[3][0] * r, support[1][1] + support[3][1] * r], [support[2][0] + support[3][0] * r, support[2][1] + support[3][1] * r], None])
+            else:
+                radius = support[2] + support[3] * r
+                if radius <= 0:
+                    return guess
+                shapes.append([None, None, [support[1][0], support[1][1], radius]])
+        if shapes[0][2] is None and shapes[1][2] is None:
+            return guess
+        if shapes[0][2] is None:
+            candidates = self.line_circle_points(shapes[0][0], shapes[0][1], shapes[1][2])
+        elif shapes[1][2] is None:
+            candidates = self.line_circle_points(shapes[1][0], shapes[1][1], shapes[0][2])
+        else:
+            candidates = self.circle_circle_points(shapes[0][2], shapes[1][2])
+        if len(candidates) == 0:
+            return guess
+        return min(candidates, key = lambda point: self.distance(point, guess))
+
+    def offset_is_valid(self, profile, analysis, distance):
+        '''
+        Returns False if a node of the offset profile is closer to the original profile than the offset distance, or on the wrong side of it.
+            arguments:
+                - profile:list offset profile
+                - analysis:dict result of offset_analysis for the original profile
+                - distance:float offset distance
+        '''
+        limit = distance * 0.999
+        # when the offsets of a corner don't meet, the node is pushed away along its bisector (cf self.offset_corner) : the loop can then end up far from the profile, on the wrong side
+        if 'polygon' not in analysis:
+            analysis['polygon'] = self.flatten_path([['M', analysis['nodes'][-1]['p']]] + [node['curve'] for node in analysis['nodes']])
+        if self.point_in_polygon(self.get_point_from_curve(profile[0]), analysis['polygon']) != (analysis['direction'] == 'inside'):
+            return False
+        for curve in profile:
+            q = self.get_point_from_curve(curve)
+            for support in analysis['supports']:
+                box = support[3]
+                if q[0] < box[0] - limit or q[0] > box[2] + limit or q[1] < box[1] - limit or q[1] > box[3] + limit:
+                    continue
+                if self.curve_distance(q, support) < limit:
+                    return False
+        return True
+
+    def curve_distance(self, point, curve):
+        '''
+        Returns the distance from a point to a line or a circular arc.
+            arguments:
+                - point:[float, float] the point
+                - curve:list [start, end, circle] with circle = None for a line (cf self.curves_intersection)
+        '''
+        return self.distance(point, self.curve_projection(point, curve)[1])
+
+    def curve_projection(self, point, curve):
+        '''
+        Returns [t, projection] for the closest point of a line or a circular arc to the given point, t being its parameter on the curve (cf self.curve_parameter).
+            arguments:
+                - point:[float, float] the point
+                - curve:list [start, end, circle] with circle = None for a line (cf self.curves_intersection)
+        '''
+        s = curve[0]
+        e = curve[1]
+        if curve[2] is None:
+            length = (e[0] - s[0])**2 + (e[1] - s[1])**2
+            t = 0 if length == 0 else max(0, min(1, ((point[0] - s[0]) * (e[0] - s[0]) + (point[1] - s[1]) * (e[1] - s[1])) / length))
+            return [t, [s[0] + t * (e[0] - s[0]), s[1] + t * (e[1] - s[1])]]
+        t = self.curve_parameter(curve, point)
+        if t is not None:
+            d = self.distance(point, curve[2])
+            if d == 0: # the centre : every point of the arc is as close
+                return [t, self.point_of_curve(curve, t)]
+            return [t, [curve[2][0] + (point[0] - curve[2][0]) * curve[2][2] / d, curve[2][1] + (point[1] - curve[2][1]) * curve[2][2] / d]]
+        return [0, list(s)] if self.distance(point, s) <= self.distance(point, e) else [1, list(e)]
 
     def break_profile(self, input_profile, cw):
         """
         Returns a list of non_autosecant profiles produced from the given profile. Each sub_profile that doesn't have the same clockwise value as cw is deleted
-        WARNING : ONLY WORKS FOR LINES INTERSECTION FOR NOW. if an arc intersects with anything else, I don't know yet how to catch it.
+        Lines and circular arcs are split at their intersections (cf self.first_intersection).
             Arguments:
                 - profile:list profile svg path defined like this : [['type', [properties]]]
         """
-        result = []
-        collision = True
-        # i = 0
-        # j = 0
-        # k = 0
-        result.append(input_profile)
-        while collision == True:
-            collision = False
-            k = 0
-            while k < len(result):
-                profile = result[k]
-                i = 0
-                j = 0
-                while collision == False and i < len(profile):
-                    if profile[i][0] in ['L']:
-                        j = i + 1
-                        while j < len(profile) and collision == False:
-                            if profile[j][0] in ['L']:
-                                previous_i = (i - 1) % len(profile)
-                                previous_j = (j - 1) % len(profile)
-                                s1 = self.get_point_from_curve(profile[previous_i])
-                                e1 = self.get_point_from_curve(profile[i])
-                                s2 = self.get_point_from_curve(profile[previous_j])
-                                e2 = self.get_point_from_curve(profile[j])
-                                intersect = self.do_they_intersect(s1, e1, s2, e2)
-                                if intersect != []: # the two lines intersect, and we have the coordinates of the intersection point
-                                    collision = True
-                                    # first : add the current path, just remove the other range and change the line at the i index to make it end at the intersection point
-                                    temp = profile[:i + 1] + profile[j:]
-                                    temp[i][1] = [intersect[0], intersect[1]]
-                                    result[k] = temp
-                                    # second : add an 'M' movement to the beginning of the path, and end the last element at the intersection point
-                                    temp2 = profile[i:j + 1]
-                                    temp2[-1] = temp2[-1].copy() # Necessary, to avoid modifying the other profile (python works with references, not copies of the lists) (man, it took me so long to spot this s**t...)
-                                    temp2[-1][1] = [intersect[0], intersect[1]]
-                                    temp2.insert(0, ['M', [intersect[0], intersect[1]]])
-                                    result.append(temp2)
-                            j += 1
-                    i += 1
+        result = [input_profile]
+        k = 0
+        # each split gives two sub_profiles that are checked again, the ones without intersection are done
+        while k < len(result):
+            profile = result[k]
+            collision = self.first_intersection(profile)
+            if collision is None:
                 k += 1
+                continue
+            i, j, intersect = collision
+            x = [intersect[0], intersect[1]]
+            start_i = self.get_point_from_curve(profile[i - 1])
+            start_j = self.get_point_from_curve(profile[j - 1])
+            end_i = self.get_point_from_curve(profile[i])
+            end_j = self.get_point_from_curve(profile[j])
+            # first : the current path without the loop between both curves : the i curve ends at the intersection point, the j curve begins there
+            # (new curves, the other profile still uses the original ones)
+            result[k] = profile[:i] + [self.cut_curve(profile[i], start_i, start_i, x), self.cut_curve(profile[j], start_j, x, end_j)] + profile[j + 1:]
+            # second : the loop, with an 'M' movement to the intersection point at its beginning
+            result.append([['M', x], self.cut_curve(profile[i], start_i, x, end_i)] + profile[i + 1:j] + [self.cut_curve(profile[j], start_j, start_j, x)])
+        return result
+
+    def first_intersection(self, profile):
+        '''
+        Returns [i, j, point] for the first pair of intersecting curves of the profile (i < j, by index), or None.
+        The end points are read once, and only the pairs whose bounding boxes overlap (found by sweeping the boxes sorted along X) are really tested.
+            arguments:
+                - profile:list profile svg path defined like this : [['type', [properties]]]
+        '''
+        points = [self.get_point_from_curve(curve) for curve in profile]
+        curves = []
+        for i in range(1, len(profile)):
+            s = points[i - 1]
+            e = points[i]
+            if profile[i][0] == 'L':
+                curves.append([i, s, e, min(s[0], e[0]), min(s[1], e[1]), max(s[0], e[0]), max(s[1], e[1]), None])
+            elif profile[i][0] == 'A' and not self.same_point(s, e):
+                circle = self.circle_of_arc(s, profile[i])
+                curves.append([i, s, e] + self.arc_box(s, e, circle) + [circle])
+        order = sorted(range(0, len(curves)), key = lambda a: curves[a][3])
+        pairs = []
+        for k in range(0, len(order)):
+            a = order[k]
+            y1, X1, Y1 = curves[a][4:7]
+            for b in order[k + 1:]:
+                if curves[b][3] > X1: # the next boxes begin even further
+                    break
+                if curves[b][4] <= Y1 and curves[b][6] >= y1:
+                    pairs.append((a, b) if a < b else (b, a))
+        # the pairs are tested in the order of the profile, so the result doesn't depend on the boxes
+        pairs.sort()
+        for a, b in pairs:
+            first = curves[a]
+            second = curves[b]
+            if first[7] is None and second[7] is None:
+                intersect = self.do_they_intersect(first[1], first[2], second[1], second[2])
+            else:
+                intersect = self.curves_intersection([first[1], first[2], first[7]], [second[1], second[2], second[7]])
+            if intersect != []: # the two curves intersect, and we have the coordinates of the intersection point
+                return [first[0], second[0], intersect]
+        return None
+
+    def circle_of_arc(self, start, arc):
+        '''
+        Returns [cx, cy, radius, start_angle, delta_angle] for a circular arc : its points are c + radius * (cos(start_angle + t * delta_angle), sin(...)), t in [0, 1]
+            arguments:
+                - start:[float, float] starting point of the arc
+                - arc:list arc curve ['A', [rx, ry, phi, fA, fS, x, y]]
+        '''
+        x1 = float(start[0])
+        y1 = float(start[1])
+        x2 = float(arc[1][5])
+        y2 = float(arc[1][6])
+        radius = float(arc[1][0])
+        chord = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+        if radius != float(arc[1][1]) or chord == 0:
+            circle = self.arc_to_circle(x1, y1, arc[1])
+            cx = circle['cx']
+            cy = circle['cy']
+        else:
+            # circular arc (the usual case, and the only one the offsets produce) : the center is on the bisector of the chord, on the side given by the flags
+            radius = max(abs(radius), chord / 2)
+            h = math.sqrt(max(0, radius**2 - (chord / 2)**2))
+            side = -1 if float(arc[1][3]) == float(arc[1][4]) else 1
+            cx = (x1 + x2) / 2 + side * h * (y1 - y2) / chord
+            cy = (y1 + y2) / 2 + side * h * (x2 - x1) / chord
+        radius = math.sqrt((x1 - cx)**2 + (y1 - cy)**2)
+        start_angle = math.atan2(y1 - cy, x1 - cx)
+        end_angle = math.atan2(y2 - cy, x2 - cx)
+        delta = (end_angle - start_angle) % (2 * math.pi)
+        # the sweep flag gives the direction, the size of the arc is the one between both ends in this direction
+        if float(arc[1][4]) != 1:
+            delta -= 2 * math.pi
+        return [cx, cy, radius, start_angle, delta]
+
+    def arc_box(self, s, e, circle):
+        '''
+        Returns the bounding box [min x, min y, max x, max y] of a circular arc : its ends, and the extreme points of the circle it goes through.
+            arguments:
+                - s:[float, float] starting point of the arc
+                - e:[float, float] ending point of the arc
+                - circle:list circle of the arc (cf self.circle_of_arc)
+        '''
+        xs = [s[0], e[0]]
+        ys = [s[1], e[1]]
+        for k, point in enumerate([[circle[2], 0], [0, circle[2]], [-circle[2], 0], [0, -circle[2]]]):
+            # angle travelled from the start of the arc to this extreme point, in the direction of the arc
+            angle = (k * math.pi / 2 - circle[3]) % (2 * math.pi) if circle[4] > 0 else (circle[3] - k * math.pi / 2) % (2 * math.pi)
+            if angle <= abs(circle[4]):
+                xs.append(circle[0] + point[0])
+                ys.append(circle[1] + point[1])
+        return [min(xs), min(ys), max(xs), max(ys)]
+
+    def curves_intersection(self, first, second, tolerance = 0.00001):
+        '''
+        Returns the intersection point of two curves (line or circular arc) the closest to the beginning of the first one, or [] if they don't cross.
+        Points closer than tolerance to an end of the curves don't count : consecutive curves always share one.
+            arguments:
+                - first:list [start, end, circle] with circle = None for a line, or the result of self.circle_of_arc
+                - second:list same for the second curve
+                - tolerance:float distance under which a point is considered as an end of the curves
+        '''
+        candidates = []
+        if first[2] is None:
+            candidates = self.line_circle_points(first[0], first[1], second[2])
+        elif second[2] is None:
+            candidates = self.line_circle_points(second[0], second[1], first[2])
+        else:
+            candidates = self.circle_circle_points(first[2], second[2], tolerance)
+        result = []
+        best = None
+        for point in candidates:
+            t1 = self.curve_parameter(first, point)
+            t2 = self.curve_parameter(second, point)
+            if t1 is None or t2 is None:
+                continue
+            if min(self.distance(point, end) for end in [first[0], first[1], second[0], second[1]]) < tolerance:
+                continue
+            if best is None or t1 < best:
+                best = t1
+                result = point
+        return result
+
+    def line_circle_points(self, s, e, circle):
+        '''
+        Returns the points where the infinite line (s, e) meets the circle (cf self.circle_of_arc).
+            arguments:
+                - s:[float, float] first point of the line
+                - e:[float, float] second point of the line
+                - circle:list circle, as returned by self.circle_of_arc
+        '''
+        dx = e[0] - s[0]
+        dy = e[1] - s[1]
+        fx = s[0] - circle[0]
+        fy = s[1] - circle[1]
+        a = dx**2 + dy**2
+        b = 2 * (fx * dx + fy * dy)
+        c = fx**2 + fy**2 - circle[2]**2
+        discriminant = b**2 - 4 * a * c
+        if a == 0 or discriminant < 0:
+            return []
+        root = math.sqrt(discriminant)
+        return [[s[0] + t * dx, s[1] + t * dy] for t in [(-b - root) / (2 * a), (-b + root) / (2 * a)]]
+
+    def circle_circle_points(self, c1, c2, tolerance = 0.00001):
+        '''
+        Returns the points where two circles (cf self.circle_of_arc) meet. Circles with the same center (closer than tolerance) give no point.
+            arguments:
+                - c1:list first circle [cx, cy, radius, ...]
+                - c2:list second circle
+                - tolerance:float distance under which both centers are the same
+        '''
+        d = math.sqrt((c2[0] - c1[0])**2 + (c2[1] - c1[1])**2)
+        if d <= tolerance or not abs(c1[2] - c2[2]) <= d <= c1[2] + c2[2]:
+            return []
+        a = (c1[2]**2 - c2[2]**2 + d**2) / (2 * d)
+        h = math.sqrt(max(0, c1[2]**2 - a**2))
+        mx = c1[0] + a * (c2[0] - c1[0]) / d
+        my = c1[1] + a * (c2[1] - c1[1]) / d
+        return [[mx + h * (c2[1] - c1[1]) / d, my - h * (c2[0] - c1[0]) / d], [mx - h * (c2[1] - c1[1]) / d, my + h * (c2[0] - c1[0]) / d]]
+
+    def curve_parameter(self, curve, point):
+        '''
+        Returns t in [0, 1] locating the point on the curve (line or circular arc, cf self.curves_intersection), or None if it's not between both ends.
+            arguments:
+                - curve:list [start, end, circle] with circle = None for a line
+                - point:[float, float] point on the line / circle
+        '''
+        s = curve[0]
+        e = curve[1]
+        if curve[2] is None:
+            length = (e[0] - s[0])**2 + (e[1] - s[1])**2
+            if length == 0:
+                return None
+            t = ((point[0] - s[0]) * (e[0] - s[0]) + (point[1] - s[1]) * (e[1] - s[1])) / length
+        else:
+            circle = curve[2]
+            if circle[4] == 0:
+                return None
+            angle = math.atan2(point[1] - circle[1], point[0] - circle[0]) - circle[3]
+            # angle travelled from the start of the arc, in the direction of the arc
+            angle = angle % (2 * math.pi) if circle[4] > 0 else (-angle) % (2 * math.pi)
+            t = angle / abs(circle[4])
+        return t if 0 <= t <= 1 else None
+
+    def point_of_curve(self, curve, t):
+        '''
+        Returns the point of a curve (line or circular arc) at the parameter t, the reverse of self.curve_parameter.
+            arguments:
+                - curve:list [start, end, circle] with circle = None for a line
+                - t:float 0 for the start of the curve, 1 for its end
+        '''
+        if t <= 0:
+            return list(curve[0])
+        if t >= 1:
+            return list(curve[1])
+        if curve[2] is None:
+            return [curve[0][0] + (curve[1][0] - curve[0][0]) * t, curve[0][1] + (curve[1][1] - curve[0][1]) * t]
+        circle = curve[2]
+        angle = circle[3] + t * circle[4]
+        return [circle[0] + circle[2] * math.cos(angle), circle[1] + circle[2] * math.sin(angle)]
+
+    def crossing_parameters(self, first, second):
+        '''
+        Returns the parameters (cf self.curve_parameter) of all the points where the first curve meets the second one, unlike self.curves_intersection which only gives the first one.
+        Overlapping curves (same line, same circle) have no crossing point.
+            arguments:
+                - first:list [start, end, circle] with circle = None for a line, or the result of self.circle_of_arc
+                - second:list same for the second curve
+        '''
+        if first[2] is None and second[2] is None:
+            d1 = [first[1][0] - first[0][0], first[1][1] - first[0][1]]
+            d2 = [second[1][0] - second[0][0], second[1][1] - second[0][1]]
+            cross = d1[0] * d2[1] - d1[1] * d2[0]
+            if abs(cross) < 0.000000001:
+                return []
+            w = [second[0][0] - first[0][0], second[0][1] - first[0][1]]
+            t = (w[0] * d2[1] - w[1] * d2[0]) / cross
+            u = (w[0] * d1[1] - w[1] * d1[0]) / cross
+            return [t] if 0 <= t <= 1 and 0 <= u <= 1 else []
+        if first[2] is None:
+            candidates = self.line_circle_points(first[0], first[1], second[2])
+        elif second[2] is None:
+            candidates = self.line_circle_points(second[0], second[1], first[2])
+        else:
+            candidates = self.circle_circle_points(first[2], second[2])
+        result = []
+        for point in candidates:
+            t = self.curve_parameter(first, point)
+            if t is not None and self.curve_parameter(second, point) is not None:
+                result.append(t)
         return result
 
+    def cut_curve(self, curve, origin, start, end):
+        '''
+        Returns a new curve following the given curve from start to end (both on it).
+            arguments:
+                - curve:list line or arc defined like this : ['type', [properties]]
+                - origin:[float, float] starting point of the original curve
+                - start:[float, float] starting point of the new curve
+                - end:[float, float] ending point of the new curve
+        '''
+        if curve[0] != 'A':
+            return [curve[0], [end[0], end[1]]]
+        circle = self.circle_of_arc(origin, curve)
+        a1 = math.atan2(start[1] - circle[1], start[0] - circle[0])
+        a2 = math.atan2(end[1] - circle[1], end[0] - circle[0])
+        sweep = (a2 - a1) % (2 * math.pi) if circle[4] > 0 else (a1 - a2) % (2 * math.pi)
+        return ['A', [circle[2], circle[2], curve[1][2], 1 if sweep > math.pi else 0, curve[1][4], end[0], end[1]]]
+
+    def distance(self, p, q):
+        '''
+        Returns the distance between two points.
+            arguments:
+                - p:[float, float] first point
+                - q:[float, float] second point
+        '''
+        return math.sqrt((q[0] - p[0])**2 + (q[1] - p[1])**2)
+
     def remove_inverted_profiles(self, raw_offset, cw):
         result = []
         for profile in raw_offset:
-            calc_cw = 0
-            for i in range(1, len(profile)): # first element is M, not to be considered...
-                j = (i - 1) % len(profile)
-                sx = profile[j][1][0] if profile[j][0] in ['M', 'L'] else profile[j][1][5]
-                sy = profile[j][1][1] if profile[j][0] in ['M', 'L'] else profile[j][1][6]
-                ex = profile[i][1][0] if profile[i][0] in ['M', 'L'] else profile[i][1][5]
-                ey = profile[i][1][1] if profile[i][0] in ['M', 'L'] else profile[i][1][6]
-                calc_cw += (ex - sx) * (ey + sy)
-            if (calc_cw > 0) == cw:
+            # the direction is taken from the area with the arcs : a loop made of arcs can be inverted while its chords aren't
+            if (self.profile_area(profile) < 0) == cw:
                 result.append(profile)
         return result
 
     def do_they_intersect(self, s1, e1, s2, e2):
         """
         Returns the coordinates of the intersection point if the segments [s1, e1] and [s2, e2] intersect, [either]
+        When self.resolution is set, the test is exact (integer orientations on the grid) and the intersection point is rounded to the grid.
             Arguments:
             - s1:list coordinates of the first segment's starting point in the format [x, y]
             - e1:list coordinates of the first segment's ending point in the format [x, y]
             - s2:list coordinates of the second segment's starting point in the format [x, y]
             - e2:list coordinates of the second segment's ending point in the format [x, y]
         """
+        if self.resolution is not None:
+            return self.exact_intersection(s1, e1, s2, e2)
         result = []
         if (self.ccw(s1,s2,e2) != self.ccw(e1,s2,e2) and self.ccw(s1,e1,s2) != self.ccw(s1,e1,e2)) and e1 != s2 and s1 != e2: # in this case, the segments intersect (don't ask me why, ask this guy : https://stackoverflow.com/questions/3838329/how-can-i-check-if-two-segments-intersect)
             # we calculate the intersection's coordinates
@@ -740,6 +3603,49 @@ class Machining:
             result = [x, y]
         return result
 
+    def exact_intersection(self, s1, e1, s2, e2):
+        """
+        Same as do_they_intersect, computed with integer coordinates on the grid (cf self.snap_point) : no epsilon, no float rounding in the decision.
+        Segments sharing an end are not considered as intersecting, a segment ending on the other one is.
+            Arguments:
+            - s1:list coordinates of the first segment's starting point in the format [x, y]
+            - e1:list coordinates of the first segment's ending point in the format [x, y]
+            - s2:list coordinates of the second segment's starting point in the format [x, y]
+            - e2:list coordinates of the second segment's ending point in the format [x, y]
+        """
+        a = self.snap_point(s1)
+        b = self.snap_point(e1)
+        c = self.snap_point(s2)
+        d = self.snap_point(e2)
+        if b == c or a == d or a == b or c == d:
+            return []
+        o1 = self.orientation(a, b, c)
+        o2 = self.orientation(a, b, d)
+        o3 = self.orientation(c, d, a)
+        o4 = self.orientation(c, d, b)
+        if o1 == 0 and o2 == 0:
+            # collinear segments : they overlap, but there is no single crossing point
+            return []
+        if o1 * o2 > 0 or o3 * o4 > 0:
+            return []
+        # intersection point a + t * (b - a), with t = num / den
+        num = (c[0] - a[0]) * (d[1] - c[1]) - (c[1] - a[1]) * (d[0] - c[0])
+        den = (b[0] - a[0]) * (d[1] - c[1]) - (b[1] - a[1]) * (d[0] - c[0])
+        if den < 0:
+            num, den = -num, -den
+        x = a[0] + self.rounded_division(num * (b[0] - a[0]), den)
+        y = a[1] + self.rounded_division(num * (b[1] - a[1]), den)
+        return [self.unsnap(x), self.unsnap(y)]
+
+    def rounded_division(self, num, den):
+        """
+        Returns the integer closest to num / den, computed on integers only (den must be positive).
+            Arguments:
+                - num:int numerator
+                - den:int denominator
+        """
+        return (2 * num + den) // (2 * den)
+
     def ccw(self, A, B, C):
         """
         measure whereas the shape is counterlclockwise or not. only used for the line intersection detection
@@ -748,7 +3654,80 @@ class Machining:
                 - B:list point in the format [x, y]
                 - C:list point in the format [x, y]
         """
-        return (C[1]-A[1]) * (B[0]-A[0]) > (B[1]-A[1]) * (C[0]-A[0])
+        return self.orientation(A, B, C) > 0
+
+    def orientation(self, A, B, C):
+        """
+        Returns the cross product of AB and AC : positive if A, B, C turn counter-clockwise, negative if they turn clockwise, 0 if they are aligned.
+        When self.resolution is set, the points are snapped to the grid and the result is an exact integer.
+            Arguments:
+                - A:list point in the format [x, y]
+                - B:list point in the format [x, y]
+                - C:list point in the format [x, y]
+        """
+        if self.resolution is not None:
+            A = self.snap_point(A)
+            B = self.snap_point(B)
+            C = self.snap_point(C)
+        return (B[0] - A[0]) * (C[1] - A[1]) - (B[1] - A[1]) * (C[0] - A[0])
+
+    def winding(self, profile):
+        """
+        Returns the sum of (ex - sx) * (ey + sy) over the curves of a closed profile : positive if the profile is clockwise, negative otherwise.
+        When self.resolution is set, the sum is computed on the grid and is exact.
+            Arguments:
+                - profile:list profile defined as : [[type, [properties]]]
+        """
+        calc_cw = 0
+        for i in range(0, len(profile)):
+            s = self.get_point_from_curve(profile[(i - 1) % len(profile)])
+            e = self.get_point_from_curve(profile[i])
+            if self.resolution is not None:
+                s = self.snap_point(s)
+                e = self.snap_point(e)
+            calc_cw += (e[0] - s[0]) * (e[1] + s[1])
+        return calc_cw
+
+    def snap(self, value):
+        """
+        Returns the integer coordinate of a value on the grid defined by self.resolution.
+            Arguments:
+                - value:float coordinate to snap
+        """
+        return int(round(float(value) / self.resolution))
+
+    def unsnap(self, value):
+        """
+        Returns the float coordinate corresponding to an integer coordinate on the grid defined by self.resolution.
+            Arguments:
+                - value:int coordinate on the grid
+        """
+        return round(value * self.resolution, self.resolution_digits())
+
+    def resolution_digits(self):
+        """
+        Returns the number of decimals needed to write a coordinate of the grid (3 for 0.001).
+        """
+        return max(int(math.ceil(-math.log10(self.resolution) - 1e-9)), 0)
+
+    def snap_point(self, point):
+        """
+        Returns the point snapped to the grid defined by self.resolution, as a tuple of integers (cheap to compare, hash and index).
+            Arguments:
+                - point:list point in the format [x, y]
+        """
+        return (self.snap(point[0]), self.snap(point[1]))
+
+    def same_point(self, p, q):
+        """
+        Returns True if both points are the same (on the grid when self.resolution is set).
+            Arguments:
+                - p:list point in the format [x, y]
+                - q:list point in the format [x, y]
+        """
+        if self.resolution is not None:
+            return self.snap_point(p) == self.snap_point(q)
+        return p == q
 
     def guess_angle(self, sin, cos):
         """
@@ -841,10 +3820,16 @@ class Machining:
     def clean(self, profile):
         """
         Returns a clean version on profile, which means a version where every float is rounded to the 5th decimal, in order to avoid scientific writing
+        (or snapped to the grid when self.resolution is set)
             Arguments:
                 - profile:list profile defined as : [[type, [properties]]]
         """
         result = []
+        if self.resolution is not None:
+            # snapping to the grid
+            for el in profile:
+                result.append([el[0], [self.unsnap(self.snap(e)) for e in el[1]]])
+            return result
         for el in profile:
             result.append([el[0], [round(e, 6) for e in el[1]]])
         return result
@@ -1,2 +1,356 @@
 # test.py
 
+# run with pytest from the root of the repository, or with python -m svgpygcode.test
+
+import io
+import math
+import os
+import tempfile
+from xml.dom import minidom
+
+from svgpygcode import svgpygcode as spg
+
+# the sample drawing shipped with the package
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TeamDesk_pied_35.svg')
+
+def rectangle(x, y, w, h):
+    return "M {} {} L {} {} L {} {} L {} {} L {} {}".format(x, y, x + w, y, x + w, y + h, x, y + h, x, y)
+
+def test_no_gouges():
+    # a program freshly calculated should never cut into its own holding tabs
+    for drill_radius, width, height in [[3, 10, 10], [3, 30, 10], [1, 40, 10], [3, 20, 3], [3, 40, 8]]:
+        machining = spg.Machining()
+        machining.add_operation(rectangle(0, 0, 200, 100), 'profile_outside', {'target_depth': -6, 'depth_increment': -2, 'drill_radius': drill_radius, 'holding_tabs_width': width, 'holding_tabs_height': height})
+        machining.add_operation(rectangle(40, 30, 80, 40), 'profile_inside', {'target_depth': -6, 'depth_increment': -2, 'drill_radius': drill_radius, 'holding_tabs_width': width, 'holding_tabs_height': height, 'holding_tabs_number': 2})
+        machining.calculate()
+        gouges = spg.Simulator(machining, 0.25).run()['gouges']
+        assert gouges == [], (drill_radius, width, height, gouges)
+
+def test_offsets_of_arc_loops():
+    # a circle or a half disc has no direction from its chords alone : both orientations must be offset the same way
+    machining = spg.Machining()
+    for path, area in [['M 0 0 A 50 50 0 0 {0} 100 0 A 50 50 0 0 {0} 0 0', math.pi * 50**2], ['M 0 0 L 100 0 A 50 50 0 0 {0} 0 0', math.pi * 50**2 / 2]]:
+        for sweep in [0, 1]:
+            profile = machining.parse_path(path.format(sweep))
+            inside = machining.offset_curve(profile, 5, 'inside')
+            outside = machining.offset_curve(profile, 5, 'outside')
+            assert len(inside) == 1 and len(outside) == 1, (path, sweep)
+            assert 0 < abs(machining.profile_area(inside[0])) < area < abs(machining.profile_area(outside[0])), (path, sweep)
+
+def test_offset_curve_is_a_family_of_one():
+    # offsetting at one distance or at many must give the same curves
+    machining = spg.Machining()
+    path = minidom.parse(SAMPLE).getElementsByTagName('path')[0].getAttribute('d')
+    profile = machining.parse_path(path)
+    family = machining.offset_family(profile, step = 1, start = 1)
+    for distance in [10, 66, 70, 88, 89]:
+        assert len(machining.offset_curve(profile, distance, 'inside')) == len(family[distance - 1]), distance
+
+def test_unsupported_compensation_writes_nothing():
+    # the operations are checked before any gcode is written
+    machining = spg.Machining()
+    machining.post_processor = spg.GrblPostProcessor()
+    machining.add_operation(rectangle(0, 0, 50, 50), 'engraving', {'target_depth': -1})
+    machining.add_operation(rectangle(0, 0, 50, 50), 'profile_outside', {'target_depth': -6, 'compensation': 'controller'})
+    try:
+        machining.calculate()
+    except ValueError:
+        assert machining.writer.getvalue() == ''
+    else:
+        assert False, 'grbl has no cutter radius compensation'
+
+def test_engraving_plunges_from_the_stock_surface():
+    # the head comes down to the stock surface in rapid, only the material is cut at the plunge feedrate
+    machining = spg.Machining()
+    machining.add_operation("M 0 0 L 50 0 L 50 30", 'engraving', {'target_depth': -3, 'depth_increment': -1, 'stock_surface': 2})
+    machining.calculate()
+    lines = machining.gcode.splitlines()
+    plunge = [k for k in range(0, len(lines)) if lines[k].startswith('G1')][0]
+    assert lines[plunge - 1].startswith('G0') and lines[plunge - 1].endswith('Z2.0000'), lines[plunge - 1]
+
+def test_tool_changes():
+    # each calculation starts from an unknown machine, and the head never travels twice to the same point
+    machining = spg.Machining()
+    machining.add_operation("M 0 0 L 50 0 L 50 30", 'engraving', {'target_depth': -3, 'depth_increment': -1})
+    machining.add_operation(rectangle(60, 0, 30, 30), 'pocket_inside', {'target_depth': -2, 'depth_increment': -1, 'drill_radius': 3})
+    machining.add_operation(rectangle(60, 0, 30, 30), 'profile_outside', {'target_depth': -2, 'depth_increment': -1, 'drill_radius': 1})
+    machining.calculate()
+    first = machining.gcode
+    machining.calculate()
+    assert machining.gcode == first
+    rapids = [line for line in first.splitlines() if line.startswith('G0') or line.startswith('G1')]
+    assert all([rapids[k] != rapids[k - 1] for k in range(1, len(rapids)) if rapids[k].startswith('G0')])
+    assert first.count('M6') == 3
+
+def test_no_null_moves():
+    # the offsets leave closing curves of a few nanometers : they are not written, nor their feedrate (an arc would be a whole circle)
+    machining = spg.Machining()
+    for path in [element.getAttribute('d') for element in minidom.parse(SAMPLE).getElementsByTagName('path')][:3]:
+        machining.add_operation(path, 'profile_outside', {'target_depth': -2, 'depth_increment': -1, 'drill_radius': 2, 'cut_feedrate': 900, 'adaptive_feed': True, 'compensation': 'host'})
+        machining.add_operation(path, 'pocket_inside', {'target_depth': -2, 'depth_increment': -1, 'drill_radius': 2, 'cut_feedrate': 900, 'adaptive_feed': True})
+    machining.calculate()
+    position = None
+    for line in machining.gcode.splitlines():
+        if line[:2] in ['G0', 'G1', 'G2', 'G3']:
+            words = [word for word in line.split() if word[0] in 'XYZ']
+            assert words != position, line
+            position = words
+
+def test_holes_before_their_profile():
+    # a part is freed by its outer profile : everything inside it comes first, down to the parts nested in its holes
+    machining = spg.Machining()
+    machining.add_operation(rectangle(0, 0, 200, 100), 'profile_outside', {'target_depth': -6})
+    machining.add_operation(rectangle(20, 20, 60, 60), 'profile_inside', {'target_depth': -6})
+    machining.add_operation(rectangle(30, 30, 20, 20), 'profile_outside', {'target_depth': -6})
+    machining.add_operation(rectangle(120, 20, 60, 60), 'profile_inside', {'target_depth': -6})
+    machining.add_operation(rectangle(300, 0, 50, 50), 'profile_outside', {'target_depth': -6})
+    machining.determine_order()
+    assert machining.containment_tree(range(0, 5)) == {0: -1, 1: 0, 2: 1, 3: 0, 4: -1}
+    order = machining.order
+    assert sorted(order) == [0, 1, 2, 3, 4]
+    assert order.index(2) < order.index(1) < order.index(0) and order.index(3) < order.index(0)
+
+def test_priority_classes():
+    # the classes are served in order (engraving -> pockets -> profiles by default), the closest contour first inside a class
+    types = ['profile_outside', 'engraving', 'pocket_inside', 'profile_outside', 'engraving', 'pocket_inside']
+    for priority, expected in [[[], ['engraving', 'pocket', 'profile']], [['profile', 'engraving'], ['profile', 'engraving', 'pocket']]]:
+        machining = spg.Machining()
+        for k in range(0, len(types)):
+            machining.add_operation(rectangle(60 * k, 0, 40, 40), types[k], {'target_depth': -2})
+        machining.determine_order(priority)
+        ranks = [expected.index(machining.contours[i][0].split('_')[0]) for i in machining.order]
+        assert ranks == sorted(ranks), (priority, machining.order)
+
+def test_calculate_twice():
+    # the holding tabs (on the curves longer than 30 mm) are added to a copy of the contour : a second calculation gives the same program
+    machining = spg.Machining()
+    machining.add_operation(rectangle(0, 0, 200, 100), 'profile_outside', {'target_depth': -6, 'depth_increment': -2})
+    machining.add_operation(rectangle(20, 20, 60, 60), 'profile_inside', {'target_depth': -6, 'depth_increment': -2, 'compensation': 'controller'})
+    machining.calculate()
+    first = machining.gcode
+    contours = [[contour[0], [[curve[0], list(curve[1])] for curve in contour[1]]] for contour in machining.contours]
+    assert len(machining.holding_tabs) > 0
+    machining.calculate()
+    assert machining.gcode == first
+    assert [[contour[0], contour[1]] for contour in machining.contours] == contours
+
+def test_exact_orientation_on_the_grid():
+    # a sliver 1 micrometer thick, far from the origin : the float area is 0, the area on the grid keeps its orientation
+    machining = spg.Machining()
+    machining.resolution = 0.001
+    for offset in [0.001, -0.001]:
+        profile = [['M', [3e7, 3e7]], ['L', [3e7 + 100, 3e7 + 100]], ['L', [3e7 + 50, 3e7 + 50 + offset]], ['L', [3e7, 3e7]]]
+        assert abs(machining.profile_area(profile) - 50 * offset) < 1e-9
+
+def test_dialects():
+    # each dialect writes its own header and footer, and the program begins with a rapid along Z only (the head can be anywhere)
+    for post, first, last in [[spg.LinuxCncPostProcessor(), 'G21 G90 G17 G40 G49', 'M2'], [spg.GrblPostProcessor(), 'G21 G90 G17', 'M2'], [spg.FanucPostProcessor(), '%', '%']]:
+        machining = spg.Machining()
+        machining.post_processor = post
+        machining.add_operation("M 10 10 L 50 10 L 50 30", 'engraving', {'target_depth': -1})
+        machining.add_operation(rectangle(60, 0, 30, 30), 'profile_outside', {'target_depth': -1, 'drill_radius': 2})
+        machining.calculate()
+        lines = machining.gcode.splitlines()
+        assert lines[0] == first and lines[-1] == last, post.name
+        assert lines[len(post.header().splitlines())] == 'G0 Z20.0000', post.name
+        # the spindle is stopped before the second tool change only
+        assert machining.gcode.count('M5') == 2, post.name
+        assert machining.gcode.index('M3') < machining.gcode.index('M5'), post.name
+        # grbl has no tool changer : the program stops for the operator
+        assert ('M6' in machining.gcode) == (post.name != 'grbl'), post.name
+
+def test_windowed_planner():
+    # the sheet planned window by window removes the same material as the whole sheet planned at once, each operation being written once
+    operations = []
+    for k in range(0, 12):
+        operations.append([rectangle(45 * k, 0, 40, 40), 'profile_outside', {'target_depth': -3, 'depth_increment': -3, 'drill_radius': 1}])
+        operations.append([rectangle(45 * k + 10, 10, 20, 20), 'pocket_inside', {'target_depth': -2, 'depth_increment': -2, 'drill_radius': 1}])
+    machining = spg.Machining()
+    for operation in operations:
+        machining.add_operation(*operation)
+    machining.calculate()
+    reference = spg.Simulator(machining, 0.5).run()['removed_volume']
+    windowed = spg.Machining()
+    output = io.StringIO()
+    windowed.calculate_windowed(iter(operations), output, window_width = 100, seam_width = 10)
+    windowed.gcode = output.getvalue()
+    removed = spg.Simulator(windowed, 0.5).run()['removed_volume']
+    assert sorted([entry['operation'] for entry in windowed.program_index['operations']]) == list(range(0, len(operations)))
+    assert all([abs(reference[k] - removed.get(k, 0)) < 1e-6 for k in reference])
+
+def test_depth_passes():
+    # 30 mm at 3 mm : 10 laps, evenly spread, the last one exactly at the target depth
+    machining = spg.Machining()
+    passes = machining.depth_passes(machining.define_properties({'target_depth': -30, 'depth_increment': -3}))
+    assert len(passes) == 10 and passes[-1] == -30
+    assert all([abs(passes[k] - passes[k - 1] + 3) < 1e-9 for k in range(1, len(passes))])
+    # no lap over the depth increment, a thin finishing lap at the end
+    passes = machining.depth_passes(machining.define_properties({'target_depth': -10, 'depth_increment': -4, 'finishing_depth': 0.5, 'stock_surface': 2}))
+    assert passes[-2:] == [-9.5, -10] and len(passes) == 4
+    assert all([0 < passes[k - 1] - passes[k] <= 4 for k in range(1, len(passes))]) and 0 < 2 - passes[0] <= 4
+    # the program cuts these laps
+    machining.add_operation(rectangle(0, 0, 20, 20), 'profile_outside', {'target_depth': -30, 'depth_increment': -3})
+    machining.calculate()
+    depths = set([line.split('Z')[1] for line in machining.gcode.splitlines() if line.startswith('G1')])
+    assert depths == set(['{:.4f}'.format(-3.0 * k) for k in range(1, 11)])
+
+def cut_length(gcode):
+    # length of the feed moves (G1, G2, G3) of a program
+    position = [0.0, 0.0, 0.0]
+    length = 0
+    for line in gcode.splitlines():
+        if line[:2] in ['G0', 'G1', 'G2', 'G3']:
+            words = dict([[word[0], float(word[1:])] for word in line.split()[1:] if word[0] in 'XYZIJ'])
+            end = [words.get('X', position[0]), words.get('Y', position[1]), words.get('Z', position[2])]
+            if line.startswith('G1'):
+                length += math.sqrt(sum([(end[k] - position[k])**2 for k in range(0, 3)]))
+            elif line[:2] in ['G2', 'G3']:
+                # arcs in the XY plane, the center relative to the start
+                center = [position[0] + words.get('I', 0), position[1] + words.get('J', 0)]
+                sweep = math.atan2(end[1] - center[1], end[0] - center[0]) - math.atan2(position[1] - center[1], position[0] - center[0])
+                sweep = sweep % (2 * math.pi) if line.startswith('G3') else -sweep % (2 * math.pi)
+                if sweep == 0:
+                    sweep = 2 * math.pi
+                length += math.hypot(sweep * math.hypot(words.get('I', 0), words.get('J', 0)), end[2] - position[2])
+            position = end
+    return length
+
+def test_common_lines():
+    # the edge shared by two neighbouring parts is cut once, and the same material is removed
+    results = []
+    for common in [False, True]:
+        machining = spg.Machining()
+        machining.common_line_cutting = common
+        for x in [0, 100]:
+            machining.add_operation(rectangle(x, 0, 100, 50), 'profile_outside', {'target_depth': -3, 'depth_increment': -3, 'drill_radius': 2, 'holding_tabs_height': 0})
+        machining.calculate()
+        results.append([cut_length(machining.gcode), sum(spg.Simulator(machining, 0.25).run()['removed_volume'].values())])
+    assert abs(results[0][0] - results[1][0] - 50) < 1e-6, results
+    assert abs(results[0][1] - results[1][1]) < 1e-6, results
+
+def test_congruent_parts():
+    # turned copies of a part, called as a subprogram or written inline, remove the same material as the parts planned one by one (up to the rounding of the coordinates)
+    def part(x, y, angle):
+        points = [[x + u * math.cos(angle) - v * math.sin(angle), y + u * math.sin(angle) + v * math.cos(angle)] for u, v in [[-30, -20], [30, -20], [30, 20], [-10, 35], [-30, -20]]]
+        return 'M ' + ' L '.join(['{} {}'.format(*point) for point in points])
+    results = []
+    for congruent, call in [[False, True], [True, True], [True, False]]:
+        machining = spg.Machining()
+        machining.post_processor = spg.FanucPostProcessor()
+        if not call:
+            machining.post_processor.call = None
+        machining.congruent_parts = congruent
+        machining.congruent_rotation = True
+        for k in range(0, 6):
+            machining.add_operation(part(100 * k + 50, 50, 0.4 * k), 'profile_outside', {'target_depth': -6, 'depth_increment': -3, 'drill_radius': 2, 'holding_tabs_height': 2})
+        machining.calculate()
+        result = spg.Simulator(machining, 0.25).run()
+        assert result['gouges'] == [], (congruent, call)
+        results.append(result['removed_volume'])
+        # the head goes straight to the entry of each copy : the part begins with its plunge
+        for subprogram in machining.subprograms.values():
+            assert not subprogram['body'].splitlines()[0].endswith('Z20.0000')
+    assert machining.gcode.count('M98') == 0
+    assert all([abs(results[1][k] - results[2][k]) < 0.01 and abs(results[0][k] - results[1][k]) < 0.01 for k in results[0]]), results
+
+def test_restart_program():
+    # a program restarted at an operation removes what the full program removes from this operation on, and nothing before
+    for post in [spg.LinuxCncPostProcessor(), spg.FanucPostProcessor(), spg.GrblPostProcessor()]:
+        machining = spg.Machining()
+        machining.post_processor = post
+        machining.congruent_parts = True
+        for k in range(0, 6):
+            machining.add_operation(rectangle(50 * k, 0, 40, 40), 'profile_outside', {'target_depth': -3, 'depth_increment': -3, 'drill_radius': 1})
+            machining.add_operation(rectangle(50 * k + 10, 10, 20, 20), 'pocket_inside', {'target_depth': -2, 'depth_increment': -2, 'drill_radius': 1})
+        machining.calculate()
+        full = spg.Simulator(machining, 0.5).run()['removed_volume']
+        operations = [entry['operation'] for entry in machining.program_index['operations']]
+        restart = operations[len(operations) // 2]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.nc')
+            with open(path, 'w', newline = '') as program:
+                program.write(machining.gcode)
+            machining.save_index(path + '.idx')
+            machining.restart_program(path, restart, os.path.join(directory, 'restart.nc'))
+            with open(os.path.join(directory, 'restart.nc')) as program:
+                machining.gcode = program.read()
+        removed = spg.Simulator(machining, 0.5).run()['removed_volume']
+        later = operations[operations.index(restart):]
+        assert all([abs(full[k] - removed.get(k, 0)) < 1e-6 for k in later]), post.name
+        assert all([k in later for k in removed]), post.name
+
+def test_rest_machining():
+    # after a big tool, the rest with a small one cuts less than a quarter of what the small tool alone cuts, and clears most of the corners left by the big tool
+    shape = "M 0 0 L 120 0 L 120 30 L 60 40 L 120 50 L 120 100 L 80 100 L 70 60 L 60 100 L 0 100 L 0 60 L 30 50 L 0 40 L 0 0"
+    results = []
+    for operations in [[['pocket_inside', {'drill_radius': 6}]], [['pocket_inside', {'drill_radius': 1.5}]], [['pocket_rest', {'drill_radius': 1.5, 'rest_radius': 6}], ['pocket_inside', {'drill_radius': 6}]]]:
+        machining = spg.Machining()
+        for type, properties in operations:
+            machining.add_operation(shape, type, dict({'target_depth': -6, 'depth_increment': -3}, **properties))
+        machining.calculate()
+        result = spg.Simulator(machining, 0.5).run()
+        assert result['gouges'] == [], operations
+        results.append([cut_length(machining.gcode), max(result['uncut_area'].values())])
+    big, small, rest = results
+    assert rest[0] < big[0] + small[0] / 4, results
+    assert rest[1] < big[1] / 4, results
+
+def test_adaptive_pocket_entry():
+    # the adaptive pocket goes down into the material around a trochoidal circle, at the plunge feedrate, and removes what the plain pocket removes
+    results = []
+    for type in ['pocket_inside', 'pocket_adaptive']:
+        machining = spg.Machining()
+        machining.add_operation(rectangle(0, 0, 100, 60), type, {'target_depth': -6, 'depth_increment': -3, 'drill_radius': 3, 'cut_feedrate': 1000, 'plunge_feedrate': 300})
+        machining.calculate()
+        result = spg.Simulator(machining, 0.25).run()
+        assert result['gouges'] == [], type
+        results.append(result['removed_volume'][0])
+    position = [0.0, 0.0, 0.0]
+    feedrate = None
+    helices = 0
+    for line in machining.gcode.splitlines():
+        words = dict([[word[0], float(word[1:])] for word in line.split() if word[0] in 'XYZF'])
+        feedrate = words.get('F', feedrate)
+        end = [words.get('X', position[0]), words.get('Y', position[1]), words.get('Z', position[2])]
+        if line[:2] in ['G1', 'G2', 'G3'] and end[2] < position[2] - 1e-9:
+            assert line[:2] in ['G2', 'G3'] and feedrate == 300, line
+            helices += 1
+        if line[:2] in ['G0', 'G1', 'G2', 'G3']:
+            position = end
+    assert helices == 4
+    assert abs(results[0] - results[1]) < 1e-6, results
+
+def test_entry_on_a_segment():
+    # the head enters a contour at its closest point, in the middle of a line or of an arc, and the contour cut there stays whole
+    machining = spg.Machining()
+    machining.add_operation(rectangle(-100, 10, 300, 20), 'profile_outside', {'target_depth': -1, 'depth_increment': -1, 'holding_tabs_height': 0})
+    machining.calculate()
+    assert 'G0 X0.0000 Y10.0000 Z0.0000' in machining.gcode
+    assert abs(cut_length(machining.gcode) - 641) < 1e-6
+    circle = machining.parse_path("M 100 80 A 20 20 0 0 1 140 80 A 20 20 0 0 1 100 80")
+    profile, index = machining.enter_profile(circle, [120, 120])
+    assert machining.same_point(machining.get_point_from_curve(profile[index]), [120, 100])
+    assert abs(machining.profile_area(profile) - machining.profile_area(circle)) < 1e-6
+
+if __name__ == '__main__':
+    test_no_gouges()
+    test_offsets_of_arc_loops()
+    test_offset_curve_is_a_family_of_one()
+    test_unsupported_compensation_writes_nothing()
+    test_engraving_plunges_from_the_stock_surface()
+    test_tool_changes()
+    test_no_null_moves()
+    test_holes_before_their_profile()
+    test_priority_classes()
+    test_calculate_twice()
+    test_exact_orientation_on_the_grid()
+    test_dialects()
+    test_windowed_planner()
+    test_depth_passes()
+    test_common_lines()
+    test_congruent_parts()
+    test_restart_program()
+    test_rest_machining()
+    test_adaptive_pocket_entry()
+    test_entry_on_a_segment()
+    print('ok')
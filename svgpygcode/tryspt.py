@@ -108,7 +108,7 @@ for el in svg_path1:
 #     for e in el[1]:
 #         svg2 += "{} ".format(e)
 
-svg_paths = [machining.offset_curve(svg_path1, 5 * i, 'inside') for i in range(1, 4)]
+svg_paths = machining.offset_family(svg_path1, [5 * i for i in range(1, 4)], 'inside')
 for paths in svg_paths:
     print(len(paths))
     for profile in paths: